@@ -4,10 +4,35 @@ DB_PORT=5432
 DB_NAME=khsm
 DB_USER=
 DB_PASS=
+# read replica, see docker-compose.replica.yml
+DB_REPLICA_HOST=
+DB_REPLICA_PORT=
+REPLICA_LAG_SECONDS=5
 
 BOT_TOKEN=
 CONSOLE_PORT=
 BOT_WORKERS=4
+# threads sending replies of the threaded runtime and their limits, messages per second and seconds between messages to a chat
+OUTBOX_WORKERS=8
+OUTBOX_RATE=30
+OUTBOX_CHAT_INTERVAL=1
+OUTBOX_MAX_ATTEMPTS=3
+# threaded or asyncio
+BOT_RUNTIME=threaded
+DB_POOL_SIZE=5
+# polling or webhook
+BOT_UPDATE_MODE=polling
+WEBHOOK_URL=
+WEBHOOK_PORT=8443
+WEBHOOK_SECRET_TOKEN=
+LEASE_TTL_SECONDS=6
 TG_PROXY_URL=
 CONSOLE_USERNAME=
 CONSOLE_PASSWORD=
+BOT_METRICS_PORT=9101
+# file to record anonymised updates to for replay.py, empty - not recorded
+BOT_RECORD_UPDATES=
+BOT_RECORD_SALT=
+LOG_LEVEL=INFO
+# share of SQL statements to log, 0..1
+SQL_LOG_SAMPLE_RATE=0
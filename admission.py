@@ -0,0 +1,76 @@
+# coding=utf-8
+# admission control in front of the handlers: updates over the rate of their user or over the global concurrency limit
+# are shed in memory before they reach the database
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import service
+
+BOT_USER_RATE = 'bot_user_rate'
+BOT_USER_BURST = 'bot_user_burst'
+BOT_MAX_CONCURRENT_UPDATES = 'bot_max_concurrent_updates'
+# updates per second a user gets back, 0 turns the per user limit off
+_DEFAULT_USER_RATE = 1
+_DEFAULT_USER_BURST = 5
+# updates queued or handled at once, 0 turns the limit off
+_DEFAULT_MAX_CONCURRENT_UPDATES = 1000
+_BUCKET_CACHE_SIZE = 100000
+
+SHED_USER_RATE = 'user_rate'
+SHED_CONCURRENCY = 'concurrency'
+
+
+def _get_limit(property_key, default_value):
+    try:
+        return max(float(service.get_property(property_key, default_value)), 0)
+    except ValueError:
+        return default_value
+
+
+class Admission(object):
+    """
+    Token bucket per user refilled at bot_user_rate up to bot_user_burst updates and a bot_max_concurrent_updates cap,
+    both read from the property table
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (tokens, updated_time), least recently seen first
+        self._buckets = OrderedDict()
+        self._in_flight = 0
+
+    def enter(self, user_id):
+        """
+        Takes a token of the user and a slot of the concurrency limit, an admitted update must be followed by leave()
+        :param user_id: None for updates without a user, they are only limited by concurrency
+        :return: None if the update is admitted, otherwise the reason it is shed
+        """
+        rate = _get_limit(BOT_USER_RATE, _DEFAULT_USER_RATE)
+        burst = _get_limit(BOT_USER_BURST, _DEFAULT_USER_BURST)
+        max_concurrent = _get_limit(BOT_MAX_CONCURRENT_UPDATES, _DEFAULT_MAX_CONCURRENT_UPDATES)
+        now = time.monotonic()
+        with self._lock:
+            if max_concurrent and self._in_flight >= max_concurrent:
+                reason = SHED_CONCURRENCY
+            elif rate and user_id is not None and not self._take_token(user_id, rate, max(burst, 1), now):
+                reason = SHED_USER_RATE
+            else:
+                self._in_flight += 1
+                return None
+        metrics.SHED_UPDATES.inc(reason=reason)
+        return reason
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _take_token(self, user_id, rate, burst, now):
+        tokens, updated_time = self._buckets.pop(user_id, (burst, now))
+        tokens = min(burst, tokens + (now - updated_time) * rate)
+        admitted = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if admitted else tokens, now)
+        while len(self._buckets) > _BUCKET_CACHE_SIZE:
+            self._buckets.popitem(last=False)
+        return admitted
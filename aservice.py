@@ -0,0 +1,139 @@
+# coding=utf-8
+# asyncio flavour of service: the same functions as coroutines over asyncpg with a bounded connection pool,
+# bodies of service functions are reused as they are through AsyncSession.run_sync
+import asyncio
+import os
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import loggers
+import metrics
+import service
+
+logger = loggers.logging.getLogger(__name__)
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 30)
+
+_AsyncSession = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+_AsyncReplicaSession = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+# asyncpg errors of connecting are not wrapped into DBAPIError
+_REPLICA_CONNECT_ERRORS = (OSError, asyncio.TimeoutError)
+
+
+def with_async_session(service_function):
+    func = service_function.__wrapped__
+    read_only = getattr(service_function, 'read_only', False)
+    player_id = getattr(service_function, 'player_id', None)
+
+    async def wrapper(*args, **kwargs):
+        with metrics.SERVICE_SECONDS.time(function=func.__name__):
+            try:
+                if read_only and _AsyncReplicaSession.kw.get('bind') is not None \
+                        and service._is_replica_readable(player_id(*args, **kwargs) if player_id else None):
+                    try:
+                        return await _run_in_session(_AsyncReplicaSession, func, args, kwargs)
+                    except DBAPIError as ex:
+                        if not service.is_replica_failure(ex):
+                            raise
+                        service._on_replica_failure()
+                    except _REPLICA_CONNECT_ERRORS:
+                        service._on_replica_failure()
+                return await _run_in_session(_AsyncSession, func, args, kwargs)
+            except Exception:
+                logger.error('Error', exc_info=True)
+                raise
+
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+async def _run_in_session(session_factory, func, args, kwargs):
+    async with session_factory() as session:
+        try:
+            async with session.begin():
+                try:
+                    return await session.run_sync(func, *args, **kwargs)
+                except Exception:
+                    # before the rollback releases the row locks
+                    service._run_rollback_callbacks(session.sync_session)
+                    raise
+        except Exception:
+            # the commit failed, cache changes of the transaction have to be undone as well
+            service._run_rollback_callbacks(session.sync_session)
+            raise
+
+
+def in_memory(service_function):
+    """
+    For service functions answered from process caches, they never wait for the database as init() makes
+    service.start_cache_refresher reload the caches
+    """
+
+    async def wrapper(*args, **kwargs):
+        return service_function(*args, **kwargs)
+
+    wrapper.__name__ = service_function.__name__
+    return wrapper
+
+
+add_player = with_async_session(service.add_player)
+enter_game = with_async_session(service.enter_game)
+submit_answer = with_async_session(service.submit_answer)
+use_hint = with_async_session(service.use_hint)
+is_overdrafted = with_async_session(service.is_overdrafted)
+get_max_passed_question_id = with_async_session(service.get_max_passed_question_id)
+get_available_hints = with_async_session(service.get_available_hints)
+add_answer = with_async_session(service.add_answer)
+add_hint = with_async_session(service.add_hint)
+get_answer_stats = with_async_session(service.get_answer_stats)
+get_user_place = with_async_session(service.get_user_place)
+get_top = with_async_session(service.get_top)
+get_player = with_async_session(service.get_player)
+
+get_property = in_memory(service.get_property)
+get_question = in_memory(service.get_question)
+get_max_question_id = in_memory(service.get_max_question_id)
+get_question_count = in_memory(service.get_question_count)
+
+
+class _TimedAsyncPool(AsyncAdaptedQueuePool):
+    _pool_name = 'async'
+
+    def _do_get(self):
+        with metrics.POOL_WAIT_SECONDS.time(pool=self._pool_name):
+            return super()._do_get()
+
+
+class _TimedAsyncReplicaPool(_TimedAsyncPool):
+    _pool_name = 'async_replica'
+
+
+def init():
+    """
+    service.init() must be called first, it maps relations and warms up property and question caches
+    """
+    service.start_cache_refresher()
+    engine = create_async_engine('postgresql+asyncpg://{user}:{passwd}@{host}:{port}/{db}'.format(**service._build_parameters()),
+                                 isolation_level='READ COMMITTED',
+                                 pool_size=DB_POOL_SIZE,
+                                 max_overflow=0,
+                                 pool_timeout=DB_POOL_TIMEOUT,
+                                 poolclass=_TimedAsyncPool)
+    service.instrument_engine(engine.sync_engine)
+    _AsyncSession.configure(bind=engine)
+    if service.DB_REPLICA_HOST:
+        replica_engine = create_async_engine('postgresql+asyncpg://{user}:{passwd}@{host}:{port}/{db}'.format(
+            **service._build_replica_parameters()),
+            isolation_level='READ COMMITTED',
+            pool_size=DB_POOL_SIZE,
+            max_overflow=0,
+            pool_timeout=DB_POOL_TIMEOUT,
+            poolclass=_TimedAsyncReplicaPool,
+            connect_args={'timeout': service._REPLICA_CONNECT_TIMEOUT_SECONDS})
+        service.instrument_engine(replica_engine.sync_engine)
+        _AsyncReplicaSession.configure(bind=replica_engine)
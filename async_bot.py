@@ -0,0 +1,305 @@
+# coding=utf-8
+import asyncio
+import datetime
+import os
+
+import aiohttp
+from aiohttp import web
+from aiohttp_socks import ProxyConnector
+from telegram import Update
+from telegram.error import TelegramError, RetryAfter
+
+import admission
+import aservice
+import dispatch
+import khsm_bot
+import lease
+import loggers
+import metrics
+import recording
+import service
+import webhook
+
+logger = loggers.logging.getLogger(__name__)
+
+BOT_MAX_IN_FLIGHT = int(os.environ.get('BOT_MAX_IN_FLIGHT') or 1000)
+BOT_HTTP_CONNECTIONS = int(os.environ.get('BOT_HTTP_CONNECTIONS') or 100)
+_POLL_TIMEOUT_SECONDS = 30
+
+
+class AsyncBot(object):
+    """
+    Telegram Bot API client over aiohttp with just the methods handlers use
+    """
+
+    def __init__(self, token, proxy_url=None, connections=BOT_HTTP_CONNECTIONS):
+        self._base_url = 'https://api.telegram.org/bot{}/'.format(token)
+        self._proxy_url = proxy_url
+        self._connections = connections
+        self._session = None
+
+    async def start(self):
+        connector = ProxyConnector.from_url(self._proxy_url, limit=self._connections) if self._proxy_url \
+            else aiohttp.TCPConnector(limit=self._connections)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=_POLL_TIMEOUT_SECONDS + 10))
+
+    async def close(self):
+        await self._session.close()
+
+    async def call(self, method, **params):
+        params = {key: value for key, value in params.items() if value is not None}
+        try:
+            with metrics.TELEGRAM_SECONDS.time(method=method):
+                async with self._session.post(self._base_url + method, json=params) as response:
+                    result = await response.json()
+        except Exception:
+            metrics.TELEGRAM_ERRORS.inc(method=method)
+            raise
+        if not result.get('ok'):
+            metrics.TELEGRAM_ERRORS.inc(method=method)
+            retry_after = result.get('parameters', {}).get('retry_after')
+            if retry_after:
+                raise RetryAfter(retry_after)
+            raise TelegramError(result.get('description', 'Unknown error'))
+        return result['result']
+
+    async def get_updates(self, offset, timeout):
+        return await self.call('getUpdates', offset=offset, timeout=timeout)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, parse_mode='HTML',
+                               reply_markup=reply_markup.to_dict() if reply_markup else None)
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup):
+        return await self.call('editMessageReplyMarkup', chat_id=chat_id, message_id=message_id, reply_markup=reply_markup.to_dict())
+
+    async def answer_callback_query(self, callback_query_id, text=None):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id, text=text)
+
+
+async def start_handler(bot, update):
+    user = update.effective_user
+    logger.info('Player id={} wrote {}'.format(user.id, update.effective_message.text))
+    step = await aservice.enter_game(user, update.effective_message.chat_id, datetime.datetime.now())
+    await _handle_step(bot, update, step)
+
+
+async def answer_button_handler(bot, callback_update):
+    _, question_id, variant_id = dispatch.parse_callback_data(callback_update.callback_query.data)
+    step = await aservice.submit_answer(callback_update.effective_user, question_id, variant_id, datetime.datetime.now())
+    if step.status in service.QUESTION_CLOSED_STATUSES:
+        dispatch.remember_passed(callback_update.effective_user.id, question_id)
+    await _handle_step(bot, callback_update, step)
+
+
+async def hint_button_handler(bot, callback_update):
+    _, hint_key, question_id = dispatch.parse_callback_data(callback_update.callback_query.data)
+    step = await aservice.use_hint(callback_update.effective_user, hint_key, question_id)
+    if step.status in service.QUESTION_CLOSED_STATUSES:
+        dispatch.remember_passed(callback_update.effective_user.id, question_id)
+    if step.status == service.HINT_UNAVAILABLE:
+        await _show_notification_if_possible(bot, callback_update, khsm_bot._hint_unavailable_text())
+        return
+    if step.status != service.HINT_USED:
+        await _release_inline_button(bot, callback_update)
+        return
+
+    if service.FIFTY_HINT_KEY == hint_key:
+        keyboard = khsm_bot._build_fifty_keyboard(step)
+        if not keyboard:
+            await _show_notification_if_possible(bot, callback_update, khsm_bot._fifty_for_two_text())
+            return
+        await _edit_reply_markup(bot, callback_update, keyboard)
+        await _release_inline_button(bot, callback_update)
+        return
+    if service.PUBLIC_HELP_HINT_KEY == hint_key:
+        await _edit_reply_markup(bot, callback_update, khsm_bot._build_public_help_keyboard(step))
+        await _release_inline_button(bot, callback_update)
+
+
+async def _handle_step(bot, update, step):
+    if step.status == service.GAME_RETRY:
+        await _show_notification_if_possible(bot, update, khsm_bot._retry_text())
+        return
+
+    if step.status == service.GAME_LOSE:
+        await _reply(bot, update, khsm_bot._lose_text(step))
+    elif step.status == service.GAME_WIN:
+        await _reply(bot, update, khsm_bot._win_text(step))
+    elif step.status == service.GAME_NEXT:
+        await _reply(bot, update, step.question.text_value, reply_markup=khsm_bot._build_question_keyboard(step))
+    await _release_inline_button(bot, update)
+
+
+async def place_handler(bot, update):
+    user = update.effective_user
+    await aservice.add_player(user, update.effective_message.chat_id, datetime.datetime.now())
+    place = await aservice.get_user_place(user)
+    if place:
+        await _reply(bot, update, khsm_bot._place_text(place))
+    else:
+        await start_handler(bot, update)
+
+
+async def help_handler(bot, update):
+    await _reply(bot, update, khsm_bot._help_text())
+
+
+async def _reply(bot, update, text, reply_markup=None):
+    await bot.send_message(update.effective_message.chat_id, khsm_bot._to_telegram_text(text), reply_markup=reply_markup)
+
+
+async def _edit_reply_markup(bot, update, reply_markup):
+    message = update.effective_message
+    await bot.edit_message_reply_markup(message.chat_id, message.message_id, reply_markup)
+
+
+async def _show_notification_if_possible(bot, update, text):
+    if update.callback_query:
+        await bot.answer_callback_query(update.callback_query.id, text=khsm_bot._to_telegram_text(text))
+        return True
+    return False
+
+
+async def _release_inline_button(bot, update):
+    # to release inline button
+    if update.callback_query:
+        await bot.answer_callback_query(update.callback_query.id)
+
+
+_user_lanes = dispatch.AsyncUserLanes()
+_admission = admission.Admission()
+_recorder = None
+
+_COMMAND_HANDLERS = {'help': help_handler, 'start': start_handler, 'place': place_handler}
+_CALLBACK_HANDLERS = {dispatch.ANSWER_CALLBACK: answer_button_handler, dispatch.HINT_CALLBACK: hint_button_handler}
+
+
+def _resolve_handler(update):
+    if update.callback_query:
+        data = dispatch.parse_callback_data(update.callback_query.data)
+        return _CALLBACK_HANDLERS.get(data[0]) if data else None
+    if not update.message:
+        return None
+    text = update.message.text or ''
+    if text.startswith('/'):
+        command = text[1:].split(maxsplit=1)[0].split('@')[0] if len(text) > 1 else ''
+        return _COMMAND_HANDLERS.get(command.lower(), start_handler)
+    return start_handler
+
+
+async def _timed_handle(handler, bot, update):
+    with metrics.counting_queries(), metrics.HANDLER_SECONDS.time(handler=handler.__name__):
+        await handler(bot, update)
+
+
+async def process_update(bot, data):
+    if _recorder:
+        _recorder.record(data)
+    update = Update.de_json(data, None)
+    handler = _resolve_handler(update)
+    if not handler:
+        return
+    if _admission.enter(update.effective_user.id if update.effective_user else None):
+        try:
+            await _release_inline_button(bot, update)
+        except Exception as ex:
+            khsm_bot.error(bot, update, ex)
+        return
+    try:
+        if update.effective_user:
+            handled = await _user_lanes.run(update.effective_user.id, dispatch.callback_key(update),
+                                            lambda: _timed_handle(handler, bot, update))
+            if not handled:
+                await _release_inline_button(bot, update)
+        else:
+            await _timed_handle(handler, bot, update)
+    except Exception as ex:
+        khsm_bot.error(bot, update, ex)
+    finally:
+        _admission.leave()
+
+
+async def _poll(bot):
+    in_flight = asyncio.Semaphore(BOT_MAX_IN_FLIGHT)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset, _POLL_TIMEOUT_SECONDS)
+        except RetryAfter as ex:
+            await asyncio.sleep(ex.retry_after)
+            continue
+        except Exception:
+            logger.warning('Error getting updates', exc_info=True)
+            await asyncio.sleep(1)
+            continue
+        for data in updates:
+            offset = data['update_id'] + 1
+            # stops reading updates while too many are processed
+            await in_flight.acquire()
+            task = asyncio.ensure_future(process_update(bot, data))
+            task.add_done_callback(lambda _: in_flight.release())
+
+
+async def _serve_webhook(bot):
+    in_flight = asyncio.Semaphore(BOT_MAX_IN_FLIGHT)
+    loop = asyncio.get_event_loop()
+    coordinator = lease.Coordinator()
+    await loop.run_in_executor(None, coordinator.start)
+
+    async def route_and_process(data, forwarded):
+        # lease lookups and forwarding are blocking, they stay off the event loop
+        if await loop.run_in_executor(None, coordinator.route, data, forwarded):
+            await process_update(bot, data)
+
+    async def handle(request):
+        if not webhook.is_authorized(request.headers.get(webhook.SECRET_TOKEN_HEADER)):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        forwarded = bool(request.headers.get(webhook.FORWARDED_HEADER))
+        if not webhook.WEBHOOK_ACK_FIRST:
+            await route_and_process(data, forwarded)
+            return web.Response()
+        await in_flight.acquire()
+        task = asyncio.ensure_future(route_and_process(data, forwarded))
+        task.add_done_callback(lambda _: in_flight.release())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(webhook.WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, webhook.WEBHOOK_LISTEN, webhook.WEBHOOK_PORT).start()
+    await bot.call('setWebhook', url=webhook.WEBHOOK_URL, max_connections=webhook.WEBHOOK_MAX_CONNECTIONS,
+                   secret_token=webhook.WEBHOOK_SECRET_TOKEN or None)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await loop.run_in_executor(None, coordinator.stop)
+
+
+async def _run(token, proxy_url):
+    bot = AsyncBot(token, proxy_url)
+    await bot.start()
+    try:
+        if webhook.is_webhook_mode():
+            await _serve_webhook(bot)
+        else:
+            await bot.call('deleteWebhook')
+            await _poll(bot)
+    finally:
+        await bot.close()
+
+
+def run(token, proxy_url=None):
+    """
+    Receives updates by polling or webhook and handles each one as a task of a single event loop, service.init() must be called first
+    """
+    global _recorder
+    aservice.init()
+    _recorder = recording.create_recorder()
+    asyncio.get_event_loop().run_until_complete(_run(token, proxy_url))
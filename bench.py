@@ -0,0 +1,250 @@
+# coding=utf-8
+# service benchmarks over synthetic events of growing size, generated into a database of their own:
+#   python bench.py --scales 1000 10000 100000 --output baseline.json
+#   python bench.py --scales 1000 10000 --baseline baseline.json
+# the second run fails if a function got slower or sends more queries than in the baseline
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy import text
+
+import loggers
+import metrics
+import migrations
+import question_pack
+import service
+
+logger = loggers.logging.getLogger(__name__)
+
+BENCH_DB_NAME = os.environ.get('BENCH_DB_NAME') or 'khsm_bench'
+DEFAULT_SCALES = (1000, 10000, 100000)
+DEFAULT_ITERATIONS = 200
+# a function regresses when its p50 grows by more than this factor or it sends more queries
+DEFAULT_THRESHOLD = 1.5
+# random picks make some functions send a fractional number of queries per call, an extra query per call is a regression
+_QUERY_TOLERANCE = 0.5
+
+_QUESTION_COUNT = 15
+_VARIANT_IDS = 'ABCD'
+_FIRST_PLAYER_ID = 1000000
+# players drop out after 1 + exponential(_MEAN_DEPTH) questions, _WIN_SHARE of those reaching the last one answer it
+_MEAN_DEPTH = 4
+_WIN_SHARE = 0.3
+_RETRY_SHARE = 0.15
+_HINT_SHARE = 0.3
+_SEED = 0.42
+
+_BenchUser = namedtuple('_BenchUser', ['id', 'name'])
+Benchmark = namedtuple('Benchmark', ['name', 'call', 'iterations'])
+
+
+def ensure_questions():
+    """
+    Adds synthetic questions to a database without enough of them
+    """
+    if service.get_question_count() >= _QUESTION_COUNT:
+        return
+    service.import_questions(question_pack.validate(
+        [{'question_id': question_id, 'text_value': 'Question {}'.format(question_id),
+          'variants': [{'variant_id': variant_id, 'text_value': 'Variant {}'.format(variant_id),
+                        'correct': variant_id == _VARIANT_IDS[question_id % len(_VARIANT_IDS)]} for variant_id in _VARIANT_IDS]}
+         for question_id in range(1, _QUESTION_COUNT + 1)]))
+    service.reload_catalog()
+
+
+def generate(player_count):
+    """
+    Replaces players of the benchmark database with player_count synthetic ones: most players drop out after a few questions,
+    some retry a question and some use hints, scores and variant stats are built from their answers
+    """
+    season_id = service.get_active_season_id()
+    with service.get_engine().begin() as connection:
+        connection.execute(text('TRUNCATE player, answer, hint, player_score, variant_stat CASCADE'))
+        connection.execute(text('SELECT setseed(:seed)'), seed=_SEED)
+        connection.execute(text(
+            "INSERT INTO player(player_id, player_name, chat_id, registration_time) "
+            "SELECT (:first_player_id + g)::text, 'bench ' || g, :first_player_id + g, now() - random() * interval '3 hours' "
+            "FROM generate_series(1, :player_count) g"), first_player_id=_FIRST_PLAYER_ID, player_count=player_count)
+        connection.execute(text(
+            "CREATE TEMP TABLE bench_depth ON COMMIT DROP AS "
+            "SELECT player_id, registration_time, least(:question_count, 1 + floor(-ln(1 - random()) * :mean_depth))::int AS depth, "
+            "random() < :win_share AS won FROM player"), question_count=_QUESTION_COUNT, mean_depth=_MEAN_DEPTH, win_share=_WIN_SHARE)
+        connection.execute(text(
+            "CREATE TEMP TABLE bench_question ON COMMIT DROP AS "
+            "SELECT question_id, min(variant_id) FILTER (WHERE correct) AS correct_variant_id, "
+            "min(variant_id) FILTER (WHERE NOT correct) AS wrong_variant_id FROM variant GROUP BY question_id"))
+        # every question up to the depth is passed, the one at the depth is lost unless the player won
+        connection.execute(text(
+            "INSERT INTO answer(season_id, player_id, question_id, variant_id, tries, passed, answer_time) "
+            "SELECT :season_id, d.player_id, q.question_id, "
+            "CASE WHEN a.passed AND a.tries = 1 THEN q.correct_variant_id ELSE q.wrong_variant_id END, a.tries, a.passed, "
+            "d.registration_time + q.question_id * interval '20 seconds' "
+            "FROM bench_depth d JOIN bench_question q ON q.question_id <= d.depth "
+            "CROSS JOIN LATERAL (SELECT q.question_id < d.depth OR d.won AS passed, "
+            "CASE WHEN random() < :retry_share THEN 2 ELSE 1 END AS tries) a"),
+            season_id=season_id, retry_share=_RETRY_SHARE)
+        connection.execute(text(
+            "INSERT INTO hint(season_id, player_id, question_id, hint_key, tries) "
+            "SELECT :season_id, d.player_id, 1 + floor(random() * d.depth)::int, k.hint_key, 1 "
+            "FROM bench_depth d CROSS JOIN (VALUES (:fifty), (:public_help)) k(hint_key) WHERE random() < :hint_share"),
+            season_id=season_id, fifty=service.FIFTY_HINT_KEY, public_help=service.PUBLIC_HELP_HINT_KEY, hint_share=_HINT_SHARE)
+    service.add_missing_player_scores()
+    service.rebuild_variant_stats()
+    service.invalidate_player_progress()
+    with service.get_engine().begin() as connection:
+        for table in ('player', 'answer', 'hint', 'player_score', 'variant_stat'):
+            connection.execute(text('ANALYZE {}'.format(table)))
+
+
+def _random_user(player_count):
+    player_id = _FIRST_PLAYER_ID + random.randint(1, player_count)
+    return _BenchUser(player_id, 'bench {}'.format(player_id - _FIRST_PLAYER_ID))
+
+
+def _cold(player_count, call):
+    """
+    Calls with a random player whose progress is not cached, as for the first update of a player on an instance
+    """
+
+    def cold_call():
+        user = _random_user(player_count)
+        service.invalidate_player_progress([str(user.id)])
+        call(user)
+
+    return cold_call
+
+
+def _middle_rating_cursor(player_count):
+    with service.get_engine().connect() as connection:
+        row = connection.execute(text(
+            'SELECT points, tries, hint_count, last_answer_time, player_id FROM player_score WHERE season_id = :season_id '
+            'ORDER BY points DESC, tries, hint_count, last_answer_time NULLS LAST, player_id OFFSET :offset LIMIT 1'),
+            season_id=service.get_active_season_id(), offset=player_count // 2).first()
+    return service._encode_rating_cursor(row)
+
+
+def _build_benchmarks(player_count, iterations):
+    middle_cursor = _middle_rating_cursor(player_count)
+    new_player_ids = iter(range(_FIRST_PLAYER_ID + player_count + 1, sys.maxsize))
+    now = datetime.datetime.now
+
+    def random_question_id():
+        return random.randint(1, _QUESTION_COUNT)
+
+    def export_rating():
+        for _ in service.iter_export_rows(service.EXPORT_RATING):
+            pass
+
+    return [
+        Benchmark('get_top', lambda: service.get_top(), iterations),
+        Benchmark('get_rating_page', lambda: service.get_rating_page(), iterations),
+        Benchmark('get_rating_page_middle', lambda: service.get_rating_page(after=middle_cursor), iterations),
+        Benchmark('get_rating_page_search', lambda: service.get_rating_page(search='bench {}'.format(random.randint(1, player_count))),
+                  iterations),
+        Benchmark('get_user_place', lambda: service.get_user_place(_random_user(player_count)), iterations),
+        Benchmark('get_answer_stats', lambda: service.get_answer_stats(random_question_id()), iterations),
+        Benchmark('is_overdrafted', _cold(player_count, service.is_overdrafted), iterations),
+        Benchmark('get_available_hints', _cold(player_count, service.get_available_hints), iterations),
+        Benchmark('enter_game', _cold(player_count, lambda user: service.enter_game(user, user.id, now())), iterations),
+        Benchmark('submit_answer', _cold(player_count, lambda user: service.submit_answer(
+            user, random_question_id(), random.choice(_VARIANT_IDS), now())), iterations),
+        Benchmark('use_hint', _cold(player_count, lambda user: service.use_hint(
+            user, random.choice([service.FIFTY_HINT_KEY, service.PUBLIC_HELP_HINT_KEY]), random_question_id())), iterations),
+        Benchmark('add_player', lambda: service.add_player(_BenchUser(next(new_player_ids), 'bench new'), 0, now()), iterations),
+        Benchmark('export_rating', export_rating, max(iterations // 50, 3)),
+    ]
+
+
+def percentile(sorted_values, share):
+    return sorted_values[int(round(share * (len(sorted_values) - 1)))]
+
+
+def measure(benchmark):
+    """
+    :return: latency percentiles in milliseconds and SQL statements per call
+    """
+    timings = []
+    statements_before = metrics.SQL_STATEMENTS.get()
+    for _ in range(benchmark.iterations):
+        started = time.perf_counter()
+        benchmark.call()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return OrderedDict([('iterations', benchmark.iterations),
+                        ('p50_ms', round(percentile(timings, 0.5), 3)),
+                        ('p99_ms', round(percentile(timings, 0.99), 3)),
+                        ('mean_ms', round(sum(timings) / len(timings), 3)),
+                        ('queries', round((metrics.SQL_STATEMENTS.get() - statements_before) / float(benchmark.iterations), 2))])
+
+
+def run(scales, iterations, names=None):
+    results = OrderedDict()
+    for player_count in scales:
+        started = time.time()
+        generate(player_count)
+        logger.info('Generated {} players in {:.1f}s'.format(player_count, time.time() - started))
+        random.seed(player_count)
+        scale_results = results[str(player_count)] = OrderedDict()
+        for benchmark in _build_benchmarks(player_count, iterations):
+            if names and benchmark.name not in names:
+                continue
+            scale_results[benchmark.name] = measure(benchmark)
+            logger.info('{} players {}: {}'.format(player_count, benchmark.name, dict(scale_results[benchmark.name])))
+    return results
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    :return: descriptions of functions slower by more than threshold times or sending more queries than in the baseline
+    """
+    regressions = []
+    for scale, scale_results in current.items():
+        for name, result in scale_results.items():
+            base = baseline.get(scale, {}).get(name)
+            if not base:
+                continue
+            if result['p50_ms'] > base['p50_ms'] * threshold:
+                regressions.append('{} players {}: p50 {}ms, was {}ms'.format(scale, name, result['p50_ms'], base['p50_ms']))
+            if result['queries'] > base['queries'] + _QUERY_TOLERANCE:
+                regressions.append('{} players {}: {} queries, was {}'.format(scale, name, result['queries'], base['queries']))
+    return regressions
+
+
+def _print_table(results):
+    print('{:>8} {:<24} {:>10} {:>10} {:>8}'.format('players', 'function', 'p50 ms', 'p99 ms', 'queries'))
+    for scale, scale_results in results.items():
+        for name, result in scale_results.items():
+            print('{:>8} {:<24} {:>10} {:>10} {:>8}'.format(scale, name, result['p50_ms'], result['p99_ms'], result['queries']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Service benchmarks over synthetic data, the {} database is overwritten'.format(BENCH_DB_NAME))
+    parser.add_argument('--scales', type=int, nargs='+', default=list(DEFAULT_SCALES), help='numbers of players')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='calls of each function')
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='file to write results to, e.g. a new baseline')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with, exits with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='allowed p50 growth factor')
+    args = parser.parse_args()
+
+    migrations.ensure_database(BENCH_DB_NAME)
+    os.environ['DB_NAME'] = BENCH_DB_NAME
+    service.init(background=False)
+    ensure_questions()
+    bench_results = run(args.scales, args.iterations, args.only)
+    _print_table(bench_results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(OrderedDict([('created_time', datetime.datetime.now().isoformat()), ('scales', bench_results)]), output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = compare(json.load(baseline_file)['scales'], bench_results, args.threshold)
+        for regression in found:
+            print('REGRESSION {}'.format(regression))
+        sys.exit(1 if found else 0)
@@ -0,0 +1,221 @@
+# coding=utf-8
+import argparse
+import datetime
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, Unauthorized, TelegramError
+from telegram.utils.request import urllib3
+
+import loggers
+import service
+
+logger = loggers.logging.getLogger(__name__)
+
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS') or 8)
+# Telegram allows about 30 messages per second overall and 1 per second to the same chat
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE') or 25)
+BROADCAST_CHAT_INTERVAL = float(os.environ.get('BROADCAST_CHAT_INTERVAL') or 1)
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS') or 5)
+BROADCAST_BATCH_SIZE = 200
+# scratch database of the FakeBot throughput run, see __main__
+BROADCAST_DEMO_DB_NAME = os.environ.get('BROADCAST_DEMO_DB_NAME') or 'khsm_broadcast'
+_MAX_BACKOFF_SECONDS = 30
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to at most `rate` per second overall and one per `chat_interval` seconds for a chat
+    """
+
+    def __init__(self, rate, chat_interval):
+        self._interval = 1.0 / rate
+        self._chat_interval = chat_interval
+        self._lock = threading.Lock()
+        self._next_time = 0
+        self._paused_until = 0
+        self._chat_next_times = {}
+
+    def acquire(self, chat_id):
+        time.sleep(max(0, self.reserve(chat_id) - time.time()))
+
+    def reserve(self, chat_id):
+        """
+        Books the next slot of the chat without waiting for it
+        :return: time the call is due
+        """
+        with self._lock:
+            now = time.time()
+            slot_time = max(now, self._next_time)
+            self._next_time = slot_time + self._interval
+            send_time = max(slot_time, self._chat_next_times.get(chat_id, 0))
+            self._chat_next_times[chat_id] = send_time + self._chat_interval
+            if len(self._chat_next_times) > 10000:
+                self._chat_next_times = {key: value for key, value in self._chat_next_times.items() if value > now}
+        return send_time
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._next_time = max(self._next_time, self._paused_until)
+
+    def paused_until(self):
+        """
+        :return: time the last flood wait ends, slots booked before it was set may fall within it
+        """
+        with self._lock:
+            return self._paused_until
+
+
+class BroadcastEngine(object):
+    """
+    Sends broadcast jobs in the background, progress is kept in broadcast_recipient so jobs survive restarts
+    """
+
+    def __init__(self, bot, workers=BROADCAST_WORKERS, rate=BROADCAST_RATE, chat_interval=BROADCAST_CHAT_INTERVAL,
+                 max_attempts=BROADCAST_MAX_ATTEMPTS):
+        self._bot = bot
+        self._limiter = RateLimiter(rate, chat_interval)
+        self._executor = ThreadPoolExecutor(workers)
+        self._max_attempts = max_attempts
+        self._jobs = queue.Queue()
+
+    def start(self):
+        threading.Thread(target=self._run, name='broadcast', daemon=True).start()
+        for job_id in service.get_unfinished_broadcast_job_ids():
+            self.submit(job_id)
+
+    def submit(self, job_id):
+        self._jobs.put(job_id)
+
+    def _run(self):
+        while True:
+            job_id = self._jobs.get()
+            try:
+                self.run_job(job_id)
+            except Exception:
+                logger.error('Broadcast job_id={} failed'.format(job_id), exc_info=True)
+
+    def run_job(self, job_id):
+        job, _, _ = service.get_broadcast_job(job_id)
+        if job.finished_time:
+            return
+        while True:
+            chat_ids = service.get_pending_broadcast_chat_ids(job_id, BROADCAST_BATCH_SIZE)
+            if not chat_ids:
+                break
+            results = list(self._executor.map(lambda chat_id: self._send(chat_id, job.message), chat_ids))
+            service.save_broadcast_results(job_id, results)
+        service.finish_broadcast_job(job_id, datetime.datetime.now())
+        logger.info('Broadcast job_id={} finished'.format(job_id))
+
+    def _send(self, chat_id, message):
+        error = None
+        for attempt in range(1, self._max_attempts + 1):
+            self._limiter.acquire(chat_id)
+            try:
+                self._bot.send_message(chat_id, message)
+                return _build_result(chat_id, service.BROADCAST_SENT, attempt)
+            except RetryAfter as ex:
+                error = ex
+                self._limiter.pause(ex.retry_after)
+            except (BadRequest, Unauthorized) as ex:
+                return _build_result(chat_id, service.BROADCAST_FAILED, attempt, ex)
+            except (TimedOut, NetworkError) as ex:
+                if not is_unsent(ex):
+                    # the message may have been delivered, sending it again could show it twice
+                    return _build_result(chat_id, service.BROADCAST_FAILED, attempt, ex)
+                error = ex
+                time.sleep(random.uniform(0.5, 1) * min(2 ** attempt, _MAX_BACKOFF_SECONDS))
+            except TelegramError as ex:
+                return _build_result(chat_id, service.BROADCAST_FAILED, attempt, ex)
+            except Exception as ex:
+                # raising would lose the results of the batch already sent and make the next start send it again
+                logger.error('Unexpected error sending to chat_id={}'.format(chat_id), exc_info=True)
+                return _build_result(chat_id, service.BROADCAST_FAILED, attempt, ex)
+        return _build_result(chat_id, service.BROADCAST_FAILED, self._max_attempts, error)
+
+
+def is_unsent(error):
+    """
+    :param error: TimedOut or NetworkError of a Bot API call
+    :return: if the call failed to connect, so Telegram never got it and it is safe to send again
+    """
+    # the urllib3 error the call failed with is the context of the one raised by python-telegram-bot
+    cause = error.__context__
+    if isinstance(cause, urllib3.exceptions.MaxRetryError):
+        cause = cause.reason
+    if isinstance(cause, urllib3.exceptions.ProxyError) and len(cause.args) > 1:
+        cause = cause.args[1]
+    # NewConnectionError is one of them
+    return isinstance(cause, urllib3.exceptions.ConnectTimeoutError)
+
+
+def _build_result(chat_id, status, attempts, error=None):
+    if error:
+        logger.warning('Error sending to chat_id={}, ex={}'.format(chat_id, type(error).__name__))
+    return {'chat_id': chat_id,
+            'status': status,
+            'attempts': attempts,
+            'error': '{}: {}'.format(type(error).__name__, error)[:200] if error else None}
+
+
+class FakeBot(object):
+    """
+    Offline stand-in for telegram.Bot with network latency and Telegram-like flood control
+    """
+
+    def __init__(self, latency=0.05, rate_limit=30, failing_chat_ids=()):
+        self._latency = latency
+        self._rate_limit = rate_limit
+        self._failing_chat_ids = set(failing_chat_ids)
+        self._lock = threading.Lock()
+        self._send_times = deque()
+        self.sent = 0
+        self.flood_errors = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(random.uniform(0.5, 1.5) * self._latency)
+        with self._lock:
+            now = time.time()
+            while self._send_times and self._send_times[0] < now - 1:
+                self._send_times.popleft()
+            if len(self._send_times) >= self._rate_limit:
+                self.flood_errors += 1
+                raise RetryAfter(1)
+            self._send_times.append(now)
+        if chat_id in self._failing_chat_ids:
+            raise Unauthorized('Forbidden: bot was blocked by the user')
+        with self._lock:
+            self.sent += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a broadcast job against FakeBot to measure throughput in the {} database'.format(
+        BROADCAST_DEMO_DB_NAME))
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake Telegram API latency, seconds')
+    parser.add_argument('--rate-limit', type=int, default=30, help='fake Telegram flood limit, messages per second')
+    parser.add_argument('--failing', type=int, default=10, help='number of chats that blocked the bot')
+    args = parser.parse_args()
+
+    # fake jobs and recipients stay out of the game database
+    import migrations
+
+    migrations.ensure_database(BROADCAST_DEMO_DB_NAME)
+    os.environ['DB_NAME'] = BROADCAST_DEMO_DB_NAME
+    service.init(background=False)
+    fake_chat_ids = [-1000000 - i for i in range(args.chats)]
+    fake_bot = FakeBot(args.latency, args.rate_limit, fake_chat_ids[:args.failing])
+    fake_job_id = service.create_broadcast_job('Fake broadcast', fake_chat_ids, datetime.datetime.now())
+    start_time = time.time()
+    BroadcastEngine(fake_bot).run_job(fake_job_id)
+    elapsed = time.time() - start_time
+    _, fake_counts, _ = service.get_broadcast_job(fake_job_id)
+    print('job_id={} chats={} elapsed={:.2f}s throughput={:.1f} msg/s flood_errors={} counts={}'.format(
+        fake_job_id, args.chats, elapsed, args.chats / elapsed, fake_bot.flood_errors, fake_counts))
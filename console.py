@@ -1,12 +1,22 @@
+import datetime
+import gzip
+import hashlib
 import json
 import os
-from flask import Flask, render_template, request
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from flask import Flask, render_template, request, jsonify
 from flask import send_from_directory
 from flask_basicauth import BasicAuth
 from flask import Response
-from flask import redirect, url_for
+from flask import redirect, url_for, abort, stream_with_context
 
+import broadcast
+import export
 import loggers
+import metrics
+import question_pack
 import service
 
 logger = loggers.logging.getLogger(__name__)
@@ -16,20 +26,35 @@ app.config['BASIC_AUTH_USERNAME'] = os.environ['CONSOLE_USERNAME']
 app.config['BASIC_AUTH_PASSWORD'] = os.environ['CONSOLE_PASSWORD']
 basic_auth = BasicAuth(app)
 
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE') or 100)
+
+RATING_REFRESH_SECONDS = float(os.environ.get('RATING_REFRESH_MS') or 1000) / 1000
+RATING_STREAM_HEARTBEAT_SECONDS = 15
+# every open stream holds a console thread: streams end after this long to be reopened by the browser,
+# and pages over the limit are turned away to poll /rating/data.js instead
+RATING_STREAM_MAX_SECONDS = float(os.environ.get('RATING_STREAM_MAX_SECONDS') or 300)
+RATING_MAX_STREAMS = int(os.environ.get('RATING_MAX_STREAMS') or 50)
+RATING_HISTORY_SIZE = 100
+RatingSnapshot = namedtuple('RatingSnapshot', ['built_time', 'etag', 'body', 'gzipped_body', 'version', 'rows'])
+_rating_snapshot = RatingSnapshot(0, None, None, None, None, None)
+_rating_snapshot_lock = threading.Lock()
+# version -> {player_id: row} of recent snapshots to diff stream clients against
+_rating_history = OrderedDict()
+_rating_streams_lock = threading.Lock()
+_rating_stream_count = 0
+
 
 @app.route('/admin', methods=['GET'])
 @basic_auth.required
 def get_admin_page():
-    top = service.get_top(False)
-    return render_template('admin/index.html', top=top)
+    return _stream_template('admin/index.html', **_get_player_page())
 
 
 @app.route('/admin/message', methods=['GET'])
 @basic_auth.required
 def get_message_page():
-    failed_chat_ids = request.args.get('failed_chat_ids', None)
-    top = service.get_top(False)
-    return render_template('admin/message.html', top=top, failed_chat_ids=failed_chat_ids)
+    job_id = request.args.get('job_id', None)
+    return _stream_template('admin/message.html', job_id=job_id, **_get_player_page())
 
 
 @app.route('/admin/message', methods=['POST'])
@@ -37,16 +62,43 @@ def get_message_page():
 def post_message_page():
     # if request.form['username'] != os.environ['CONSOLE_USERNAME'] or request.form['password'] != os.environ['CONSOLE_PASSWORD']:
     #     error = 'Invalid Credentials. Please try again.'
-    chat_ids = request.form.getlist('chat_id')
     message = request.form['message']
-    failed_chat_ids = []
-    for chat_id in chat_ids:
-        try:
-            bot.send_message(chat_id, message)
-        except Exception as ex:
-            failed_chat_ids.append(chat_id)
-            logger.warning('Error sending to chat_id={}, ex={}'.format(chat_id, type(ex).__name__))
-    return redirect(url_for('get_message_page', failed_chat_ids=",".join(failed_chat_ids)))
+    if request.form.get('all_matching'):
+        job_id = service.create_broadcast_job(message, [], datetime.datetime.now(), search=request.form.get('search', '').strip())
+    else:
+        job_id = service.create_broadcast_job(message, request.form.getlist('chat_id'), datetime.datetime.now())
+    broadcaster.submit(job_id)
+    return redirect(url_for('get_message_page', job_id=job_id))
+
+
+def _get_player_page():
+    search = request.args.get('search', '').strip()
+    try:
+        top, next_after = service.get_rating_page(request.args.get('after'), search, ADMIN_PAGE_SIZE)
+    except ValueError:
+        abort(400)
+    return {'top': top, 'search': search, 'next_after': next_after}
+
+
+def _stream_template(template_name, **context):
+    """
+    Sends the page as it is rendered rather than building it whole in memory
+    """
+    app.update_template_context(context)
+    return Response(stream_with_context(app.jinja_env.get_template(template_name).stream(context)))
+
+
+@app.route('/admin/message/jobs/<int:job_id>', methods=['GET'])
+@basic_auth.required
+def get_message_job(job_id):
+    job, counts, failed_chat_ids = service.get_broadcast_job(job_id)
+    return jsonify({'job_id': job.job_id,
+                    'total': sum(counts.values()),
+                    'pending': counts.get(service.BROADCAST_PENDING, 0),
+                    'sent': counts.get(service.BROADCAST_SENT, 0),
+                    'failed': counts.get(service.BROADCAST_FAILED, 0),
+                    'failed_chat_ids': failed_chat_ids,
+                    'finished': job.finished_time is not None})
 
 
 @app.route('/admin/properties', methods=['GET'])
@@ -69,18 +121,68 @@ def post_properties_page():
 @app.route('/admin/clear', methods=['GET'])
 @basic_auth.required
 def get_clear_data_page():
-    top = service.get_top(False)
-    return render_template('admin/clear-data.html', top=top)
+    return _stream_template('admin/clear-data.html', **_get_player_page())
 
 
 @app.route('/admin/clear', methods=['POST'])
 @basic_auth.required
 def post_clear_data_page():
-    player_ids = request.form.getlist('player_id')
-    service.clear_data(player_ids)
+    if request.form.get('all_matching'):
+        player_ids = service.get_matching_player_ids(request.form.get('search', '').strip())
+    else:
+        player_ids = request.form.getlist('player_id')
+    # no ids at all would be taken as every player by the bot caches
+    if player_ids:
+        service.clear_data(player_ids)
     return redirect(url_for('get_clear_data_page'))
 
 
+@app.route('/admin/clear/answer-stats', methods=['POST'])
+@basic_auth.required
+def post_rebuild_answer_stats():
+    service.rebuild_variant_stats()
+    return redirect(url_for('get_clear_data_page'))
+
+
+@app.route('/admin/seasons', methods=['GET'])
+@basic_auth.required
+def get_seasons_page(error=None):
+    return render_template('admin/seasons.html', seasons=service.get_seasons(), active_season_id=service.get_active_season_id(),
+                           error=error)
+
+
+@app.route('/admin/seasons', methods=['POST'])
+@basic_auth.required
+def post_seasons_page():
+    title = request.form.get('title', '').strip()
+    if not title:
+        return get_seasons_page('Season title is empty')
+    service.start_season(title, datetime.datetime.now())
+    # other processes switch on the notification
+    service.reload_active_season()
+    return redirect(url_for('get_seasons_page'))
+
+
+@app.route('/admin/seasons/<int:season_id>/archive', methods=['POST'])
+@basic_auth.required
+def post_archive_season(season_id):
+    try:
+        service.archive_season(season_id)
+    except ValueError as ex:
+        return get_seasons_page(str(ex))
+    return redirect(url_for('get_seasons_page'))
+
+
+@app.route('/admin/seasons/<int:season_id>/drop', methods=['POST'])
+@basic_auth.required
+def post_drop_season(season_id):
+    try:
+        service.drop_season(season_id)
+    except ValueError as ex:
+        return get_seasons_page(str(ex))
+    return redirect(url_for('get_seasons_page'))
+
+
 @app.route('/admin/rename', methods=['GET'])
 @basic_auth.required
 def get_rename_page():
@@ -99,9 +201,39 @@ def post_rename_page():
 
 @app.route('/admin/questions', methods=['GET'])
 @basic_auth.required
-def get_questions_page():
+def get_questions_page(import_errors=None):
+    questions = service.get_questions()
+    return render_template('admin/questions.html', questions=questions, import_errors=import_errors,
+                           imported=request.args.get('imported'))
+
+
+@app.route('/admin/questions/export', methods=['GET'])
+@basic_auth.required
+def get_questions_export():
+    pack_format = request.args.get('format', question_pack.JSON_FORMAT)
+    if pack_format not in question_pack.FORMATS:
+        abort(400)
     questions = service.get_questions()
-    return render_template('admin/questions.html', questions=questions)
+    chunks = question_pack.iter_json(questions) if pack_format == question_pack.JSON_FORMAT else question_pack.iter_csv(questions)
+    return Response(chunks, mimetype='application/json' if pack_format == question_pack.JSON_FORMAT else 'text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=questions.{}'.format(pack_format)})
+
+
+@app.route('/admin/questions/import', methods=['POST'])
+@basic_auth.required
+def post_questions_import():
+    pack_file = request.files.get('pack')
+    if not pack_file or not pack_file.filename:
+        return get_questions_page(['Choose a pack file'])
+    pack_format = pack_file.filename.rsplit('.', 1)[-1].lower()
+    try:
+        questions = question_pack.parse(pack_file.read().decode('utf-8-sig'), pack_format)
+        question_ids = service.import_questions(questions)
+    except question_pack.QuestionPackError as ex:
+        return get_questions_page(ex.errors)
+    except UnicodeDecodeError:
+        return get_questions_page(['The pack should be in UTF-8'])
+    return redirect(url_for('get_questions_page', imported=len(question_ids)))
 
 
 @app.route('/admin/questions', methods=['POST'])
@@ -129,6 +261,17 @@ def post_questions_page():
     return redirect(url_for('get_questions_page'))
 
 
+@app.route('/admin/export/<table>', methods=['GET'])
+@basic_auth.required
+def get_export(table):
+    export_format = request.args.get('format', export.CSV_FORMAT)
+    if table not in service.EXPORT_TABLES or export_format not in export.FORMATS:
+        abort(400)
+    # rows are read while the response is sent, they need no request context
+    return Response(export.iter_export(table, export_format), mimetype=export.MIMETYPES[export_format],
+                    headers={'Content-Disposition': 'attachment; filename={}.{}'.format(table, export_format)})
+
+
 @app.route('/rating/<path:path>', methods=['GET'])
 def get_rating_page(path):
     return send_from_directory('templates/rating', path)
@@ -136,8 +279,37 @@ def get_rating_page(path):
 
 @app.route('/rating/data.js', methods=['GET'])
 def get_rating_json():
+    snapshot = _get_rating_snapshot()
+    gzipped = 'gzip' in request.accept_encodings
+    etag = snapshot.etag + ('-gzip' if gzipped else '')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(snapshot.gzipped_body if gzipped else snapshot.body, mimetype='application/js')
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _get_rating_snapshot():
+    global _rating_snapshot
+    snapshot = _rating_snapshot
+    if time.time() - snapshot.built_time < RATING_REFRESH_SECONDS:
+        return snapshot
+    with _rating_snapshot_lock:
+        # concurrent requests wait for the one rebuilding the snapshot
+        if time.time() - _rating_snapshot.built_time >= RATING_REFRESH_SECONDS:
+            _rating_snapshot = _build_rating_snapshot(_rating_snapshot)
+        return _rating_snapshot
+
+
+def _build_rating_snapshot(previous):
     top = service.get_top()
-    rating_data = json.dumps([{
+    rows = tuple({
+        'id': player[1].player_id,
         'place': player[0],
         'name': player[1].player_name,
         'points': player[2] if player[2] else 0,
@@ -145,8 +317,75 @@ def get_rating_json():
         'hint_count': player[4] if player[4] else 0,
         'latest_answer': player[5].strftime('%Y-%m-%d %H:%M:%S') if player[5] else '',
         'chat_id': player[1].chat_id
-    } for player in top])
-    return Response('window.QUIZ_RESULTS = {}'.format(rating_data), mimetype='application/js')
+    } for player in top)
+    if rows == previous.rows:
+        return previous._replace(built_time=time.time())
+
+    # milliseconds keep versions increasing across console restarts
+    version = max(int(time.time() * 1000), (previous.version or 0) + 1)
+    body = 'window.QUIZ_RESULTS = {};\nwindow.QUIZ_RESULTS_VERSION = {};'.format(json.dumps(rows), version).encode('utf-8')
+    _rating_history[version] = {row['id']: row for row in rows}
+    while len(_rating_history) > RATING_HISTORY_SIZE:
+        _rating_history.popitem(last=False)
+    return RatingSnapshot(time.time(), hashlib.sha1(body).hexdigest(), body, gzip.compress(body), version, rows)
+
+
+@app.route('/rating/stream', methods=['GET'])
+def get_rating_stream():
+    global _rating_stream_count
+    with _rating_streams_lock:
+        if _rating_stream_count >= RATING_MAX_STREAMS:
+            # EventSource does not reconnect after 204, the page polls the rating instead
+            return Response(status=204)
+        _rating_stream_count += 1
+    client_version = request.headers.get('Last-Event-ID') or request.args.get('version')
+    response = Response(_stream_rating_deltas(int(client_version) if client_version and client_version.isdigit() else None),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(_release_rating_stream)
+    return response
+
+
+def _release_rating_stream():
+    global _rating_stream_count
+    with _rating_streams_lock:
+        _rating_stream_count -= 1
+
+
+def _stream_rating_deltas(client_version):
+    # flushes headers right away and sets the browser reconnect delay
+    yield 'retry: {}\n\n'.format(int(RATING_REFRESH_SECONDS * 1000) + 1000)
+    sent_time = time.time()
+    closing_time = sent_time + RATING_STREAM_MAX_SECONDS
+    while time.time() < closing_time:
+        snapshot = _get_rating_snapshot()
+        if snapshot.version != client_version:
+            delta = _build_rating_delta(client_version, snapshot)
+            yield 'id: {}\nevent: delta\ndata: {}\n\n'.format(snapshot.version, json.dumps(delta))
+            client_version = snapshot.version
+            sent_time = time.time()
+        elif time.time() - sent_time > RATING_STREAM_HEARTBEAT_SECONDS:
+            # lets proxies and the server notice gone clients
+            yield ': heartbeat\n\n'
+            sent_time = time.time()
+        time.sleep(RATING_REFRESH_SECONDS)
+
+
+def _build_rating_delta(client_version, snapshot):
+    client_rows = _rating_history.get(client_version)
+    if client_rows is None:
+        return {'version': snapshot.version, 'full': True, 'rows': snapshot.rows, 'removed': []}
+    rows = {row['id']: row for row in snapshot.rows}
+    return {'version': snapshot.version,
+            'full': False,
+            'rows': [row for player_id, row in rows.items() if client_rows.get(player_id) != row],
+            'removed': [player_id for player_id in client_rows if player_id not in rows]}
+
+
+@app.route('/metrics', methods=['GET'])
+@basic_auth.required
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
@@ -159,7 +398,8 @@ if __name__ == "__main__":
         # }
     } if os.environ['TG_PROXY_URL'] else {}
     service.init()
-    updater = service.create_updater(os.environ['BOT_TOKEN'], 2, request_kwargs)
-    global bot
-    bot = updater.bot
-    app.run(host='0.0.0.0', port=int(os.environ['CONSOLE_PORT']))
+    bot = service.create_bot(os.environ['BOT_TOKEN'], broadcast.BROADCAST_WORKERS, request_kwargs)
+    global broadcaster
+    broadcaster = broadcast.BroadcastEngine(bot)
+    broadcaster.start()
+    app.run(host='0.0.0.0', port=int(os.environ['CONSOLE_PORT']), threaded=True)
@@ -0,0 +1,261 @@
+# coding=utf-8
+# updates of one user are handled one after another in arrival order, different users are handled in parallel
+import asyncio
+import json
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import loggers
+import metrics
+
+logger = loggers.logging.getLogger(__name__)
+
+ANSWER_CALLBACK = 'answer'
+HINT_CALLBACK = 'hint'
+# compact callback data prefixes, a:<question_id>:<variant_id> and h:<hint_key>:<question_id>
+_CALLBACK_PREFIXES = {ANSWER_CALLBACK: 'a', HINT_CALLBACK: 'h'}
+_CALLBACK_KINDS = {prefix: kind for kind, prefix in _CALLBACK_PREFIXES.items()}
+ANSWER_CALLBACK_PATTERN = r'^(a:|\["answer")'
+HINT_CALLBACK_PATTERN = r'^(h:|\["hint")'
+
+# a question answered less than this ago makes further taps on its keyboard stale
+_PASSED_TTL_SECONDS = 60
+_PASSED_MAX_SIZE = 10000
+
+SHED_COALESCED = 'coalesced'
+SHED_STALE = 'stale'
+
+_passed_lock = threading.Lock()
+_passed_question_ids = OrderedDict()
+
+
+def encode_answer_callback(question_id, variant_id):
+    return '{}:{}:{}'.format(_CALLBACK_PREFIXES[ANSWER_CALLBACK], question_id, variant_id)
+
+
+def encode_hint_callback(hint_key, question_id):
+    return '{}:{}:{}'.format(_CALLBACK_PREFIXES[HINT_CALLBACK], hint_key, question_id)
+
+
+def parse_callback_data(data):
+    """
+    Reads compact callback data as well as JSON of keyboards sent before it
+    :return: (ANSWER_CALLBACK, question_id, variant_id), (HINT_CALLBACK, hint_key, question_id) or None
+    """
+    if not data:
+        return None
+    if data.startswith('['):
+        try:
+            kind, first, second = json.loads(data)
+        except ValueError:
+            return None
+    else:
+        parts = data.split(':')
+        if len(parts) != 3 or parts[0] not in _CALLBACK_KINDS:
+            return None
+        kind, first, second = _CALLBACK_KINDS[parts[0]], parts[1], parts[2]
+    try:
+        if kind == ANSWER_CALLBACK:
+            return kind, int(first), second
+        if kind == HINT_CALLBACK:
+            return kind, first, int(second)
+    except ValueError:
+        pass
+    return None
+
+
+def callback_key(update):
+    """
+    :return: (kind, variant_id or hint_key, question_id) of an inline keyboard tap, None for other updates
+    """
+    query = update.callback_query
+    data = parse_callback_data(query.data) if query else None
+    if not data:
+        return None
+    kind, first, second = data
+    if kind == ANSWER_CALLBACK:
+        # only taps on the same variant repeat each other, another variant may follow a retry
+        return kind, second, first
+    return kind, first, second
+
+
+def remember_passed(user_id, question_id):
+    """
+    Marks question_id as not answerable any more by the user, keyboards of it and earlier questions become stale
+    """
+    with _passed_lock:
+        _passed_question_ids.pop(user_id, None)
+        _passed_question_ids[user_id] = (question_id, time.time())
+        while len(_passed_question_ids) > _PASSED_MAX_SIZE:
+            _passed_question_ids.popitem(last=False)
+
+
+def forget_passed(player_ids=None):
+    """
+    Makes keyboards of the players answerable again after their game was reset
+    :param player_ids: None to forget all players
+    """
+    with _passed_lock:
+        if player_ids is None:
+            _passed_question_ids.clear()
+            return
+        for player_id in player_ids:
+            _passed_question_ids.pop(int(player_id), None)
+
+
+def is_stale(user_id, key):
+    if not key:
+        return False
+    with _passed_lock:
+        passed = _passed_question_ids.get(user_id)
+    if not passed:
+        return False
+    passed_question_id, passed_time = passed
+    return time.time() - passed_time < _PASSED_TTL_SECONDS and key[-1] <= passed_question_id
+
+
+class _UserQueue(object):
+    def __init__(self):
+        self.pending = deque()
+        self.current_key = None
+
+    def has_key(self, key):
+        return key == self.current_key or any(key == pending_key for pending_key, _, _ in self.pending)
+
+
+class UserDispatcher(object):
+    """
+    Shards updates by effective_user.id onto ordered per-user queues served by a shared thread pool.
+    A tap repeating a pending or running one of the same user is coalesced, a tap on an already passed question is dropped,
+    both are only released with `release`, so are updates shed by `admission`
+    """
+
+    def __init__(self, process, workers, release=None, admission=None):
+        self._process = process
+        self._release = release
+        self._admission = admission
+        self._executor = ThreadPoolExecutor(int(workers), thread_name_prefix='user-dispatch')
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def process_update(self, update):
+        """
+        :return: Future resolved when the update is handled or dropped
+        """
+        future = Future()
+        user = getattr(update, 'effective_user', None)
+        if self._admission:
+            if self._admission.enter(user.id if user else None):
+                self._executor.submit(self._drop, update, future)
+                return future
+            future.add_done_callback(lambda _: self._admission.leave())
+        if not user:
+            self._executor.submit(self._run, update, future)
+            return future
+
+        key = callback_key(update)
+        with self._lock:
+            user_queue = self._queues.get(user.id)
+            coalesced = bool(key and user_queue and user_queue.has_key(key))
+            idle = user_queue is None
+            if idle:
+                user_queue = self._queues[user.id] = _UserQueue()
+            if not coalesced:
+                user_queue.pending.append((key, update, future))
+        if coalesced:
+            logger.debug('Coalesced update_id={} of user id={}'.format(update.update_id, user.id))
+            metrics.SHED_UPDATES.inc(reason=SHED_COALESCED)
+            self._executor.submit(self._drop, update, future)
+        elif idle:
+            self._executor.submit(self._run_next, user.id)
+        return future
+
+    def _run_next(self, user_id):
+        with self._lock:
+            user_queue = self._queues[user_id]
+            key, update, future = user_queue.pending.popleft()
+            user_queue.current_key = key
+        if is_stale(user_id, key):
+            logger.debug('Dropped stale update_id={} of user id={}'.format(update.update_id, user_id))
+            metrics.SHED_UPDATES.inc(reason=SHED_STALE)
+            self._drop(update, future)
+        else:
+            self._run(update, future)
+        with self._lock:
+            user_queue.current_key = None
+            if not user_queue.pending:
+                del self._queues[user_id]
+                return
+        # requeued rather than looped so a busy user does not hold a worker from others
+        self._executor.submit(self._run_next, user_id)
+
+    def _run(self, update, future):
+        try:
+            with metrics.counting_queries():
+                self._process(update)
+        except Exception:
+            logger.error('Error processing update', exc_info=True)
+        finally:
+            future.set_result(None)
+
+    def _drop(self, update, future):
+        try:
+            if self._release:
+                self._release(update)
+        except Exception:
+            logger.warning('Error releasing dropped update', exc_info=True)
+        finally:
+            future.set_result(None)
+
+
+def install(dispatcher, workers, release=None, admission=None):
+    """
+    Makes a telegram.ext.Dispatcher hand updates to a UserDispatcher instead of processing them one by one itself
+    """
+    user_dispatcher = UserDispatcher(dispatcher.process_update, workers, release, admission)
+    dispatcher.process_update = user_dispatcher.process_update
+    return user_dispatcher
+
+
+class _UserLane(object):
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.keys = []
+        self.updates = 0
+
+
+class AsyncUserLanes(object):
+    """
+    asyncio counterpart of UserDispatcher: a FIFO lock per user with the same coalescing and stale dropping
+    """
+
+    def __init__(self):
+        self._lanes = {}
+
+    async def run(self, user_id, key, handle):
+        """
+        Awaits handle() after earlier updates of the user
+        :return: False if the update was coalesced or stale and handle() was not called
+        """
+        lane = self._lanes.get(user_id)
+        if lane and key and key in lane.keys:
+            metrics.SHED_UPDATES.inc(reason=SHED_COALESCED)
+            return False
+        if not lane:
+            lane = self._lanes[user_id] = _UserLane()
+        lane.keys.append(key)
+        lane.updates += 1
+        try:
+            async with lane.lock:
+                if is_stale(user_id, key):
+                    metrics.SHED_UPDATES.inc(reason=SHED_STALE)
+                    return False
+                await handle()
+                return True
+        finally:
+            lane.keys.remove(key)
+            lane.updates -= 1
+            if not lane.updates:
+                del self._lanes[user_id]
@@ -0,0 +1,81 @@
+# coding=utf-8
+# full results after an event: the rating and raw answer and hint rows as CSV or newline-delimited JSON
+import argparse
+import csv
+import datetime
+import io
+import json
+import sys
+
+import service
+
+CSV_FORMAT = 'csv'
+NDJSON_FORMAT = 'ndjson'
+FORMATS = (CSV_FORMAT, NDJSON_FORMAT)
+MIMETYPES = {CSV_FORMAT: 'text/csv', NDJSON_FORMAT: 'application/x-ndjson'}
+# rows are sent in chunks of about this size rather than one by one
+_CHUNK_SIZE = 64 * 1024
+
+
+def iter_export(table, export_format, batch_size=service.EXPORT_BATCH_SIZE):
+    """
+    :return: generator of text chunks of the whole table, rows are read from the database as the chunks are consumed
+    """
+    columns = service.get_export_columns(table)
+    rows = service.iter_export_rows(table, batch_size)
+    if export_format == CSV_FORMAT:
+        return _iter_csv(columns, rows)
+    if export_format == NDJSON_FORMAT:
+        return _iter_ndjson(columns, rows)
+    raise ValueError('Unknown export format {}'.format(export_format))
+
+
+def _iter_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= _CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _iter_ndjson(columns, rows):
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=_to_json)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= _CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+            size = 0
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def _to_json(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports game results')
+    parser.add_argument('table', choices=service.EXPORT_TABLES)
+    parser.add_argument('--format', choices=FORMATS, default=CSV_FORMAT)
+    parser.add_argument('--output', help='file to write, standard output by default')
+    parser.add_argument('--batch-size', type=int, default=service.EXPORT_BATCH_SIZE, help='rows fetched from the database at a time')
+    args = parser.parse_args()
+    service.init(background=False)
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in iter_export(args.table, args.format, args.batch_size):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
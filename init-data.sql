@@ -10,4 +10,7 @@ INSERT INTO property(property_key, property_value) VALUES
     ('bot_place_text', 'Сейчас вы на {player_place}м месте'),
     ('bot_help_text', 'Выиграть очень просто!<br>Один вариант ответа, 2 подсказки, 1 право на ошибку<br>Для повтора вопроса просто поздоровайтесь с ботом'),
     ('bot_hint_unavailable_text', 'Подсказка уже потрачена'),
-    ('bot_fifty_for_two_text', 'Orly ^O,o^');
+    ('bot_fifty_for_two_text', 'Orly ^O,o^'),
+    ('bot_user_rate', '1'),
+    ('bot_user_burst', '5'),
+    ('bot_max_concurrent_updates', '1000');
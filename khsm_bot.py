@@ -1,15 +1,23 @@
 # coding=utf-8
 
+import atexit
 import datetime
 import os
 import random
+import threading
 
-import json
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, Update
 from telegram.ext import CommandHandler, CallbackQueryHandler, MessageHandler, Filters
 
+import admission
+import dispatch
+import lease
 import loggers
+import metrics
+import outbox
+import recording
 import service
+import webhook
 
 logger = loggers.logging.getLogger(__name__)
 
@@ -24,146 +32,102 @@ BOT_HELP_TEXT = 'bot_help_text'
 BOT_HINT_UNAVAILABLE_TEXT = 'bot_hint_unavailable_text'
 BOT_FIFTY_FOR_TWO_TEXT = 'bot_fifty_for_two_text'
 
+BOT_RUNTIME_ASYNCIO = 'asyncio'
+# port of the /metrics endpoint of the bot, 0 turns it off
+BOT_METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT') or 9101)
+
+_KEYBOARD_CACHE_SIZE = 10000
+# (catalog, {(question_id, variant ids, hints, columns): InlineKeyboardMarkup}), dropped when the catalog is reloaded
+_keyboard_cache = (None, {})
+# outbox.Outbox the handlers queue their Telegram calls to, set by register_handlers
+_outbox = None
+
 
 def start_handler(_, update):
     user = update.effective_user
-    player = service.add_player(user, update.effective_message.chat_id, datetime.datetime.now())
-    logger.info('Player id={} wrote {}'.format(player.player_id, update.effective_message.text))
-    overdraft = service.is_overdrafted(user)
-    _handle_message(user, update, overdraft)
+    logger.info('Player id={} wrote {}'.format(user.id, update.effective_message.text))
+    step = service.enter_game(user, update.effective_message.chat_id, datetime.datetime.now())
+    _handle_step(update, step)
 
 
 def answer_button_handler(_, callback_update):
-    user = callback_update.effective_user
-    overdraft = service.is_overdrafted(user)
-    if overdraft:
-        _release_inline_button(callback_update)
-        return
-
-    _, question_id, variant_id = json.loads(callback_update.callback_query.data)
-    max_user_answered_question_id = service.get_max_passed_question_id(user)
-    if max_user_answered_question_id >= question_id:
-        _release_inline_button(callback_update)
-        return
-
-    fail = not service.add_answer(user, question_id, variant_id, datetime.datetime.now())
-    _handle_message(user, callback_update, fail, current_question_id=question_id)
+    _, question_id, variant_id = dispatch.parse_callback_data(callback_update.callback_query.data)
+    step = service.submit_answer(callback_update.effective_user, question_id, variant_id, datetime.datetime.now())
+    if step.status in service.QUESTION_CLOSED_STATUSES:
+        dispatch.remember_passed(callback_update.effective_user.id, question_id)
+    _handle_step(callback_update, step)
 
 
 def hint_button_handler(_, callback_update):
-    user = callback_update.effective_user
-    overdraft = service.is_overdrafted(user)
-    if overdraft:
-        _release_inline_button(callback_update)
+    _, hint_key, question_id = dispatch.parse_callback_data(callback_update.callback_query.data)
+    step = service.use_hint(callback_update.effective_user, hint_key, question_id)
+    if step.status in service.QUESTION_CLOSED_STATUSES:
+        dispatch.remember_passed(callback_update.effective_user.id, question_id)
+    if step.status == service.HINT_UNAVAILABLE:
+        _show_notification_if_possible(callback_update, _hint_unavailable_text())
         return
-
-    _, hint_key, question_id = json.loads(callback_update.callback_query.data)
-    max_user_answered_question_id = service.get_max_passed_question_id(user)
-    if max_user_answered_question_id >= question_id:
+    if step.status != service.HINT_USED:
         _release_inline_button(callback_update)
         return
 
-    hint_available = service.add_hint(user, hint_key, question_id)
-    if not hint_available:
-        already_used = service.get_property(BOT_HINT_UNAVAILABLE_TEXT, "Подсказка уже использована")
-        _show_notification_if_possible(callback_update, already_used)
-        return
-
     if service.FIFTY_HINT_KEY == hint_key:
-        callback_answered = _handle_fifty(callback_update, user, question_id)
+        callback_answered = _handle_fifty(callback_update, step)
         if not callback_answered:
             _release_inline_button(callback_update)
         return
     if service.PUBLIC_HELP_HINT_KEY == hint_key:
-        _handle_public_help(callback_update, user, question_id)
+        _handle_public_help(callback_update, step)
         _release_inline_button(callback_update)
 
 
-def _handle_message(user, update, fail, current_question_id=0):
-    if fail:
-        _handle_lose(update, user)
-        _release_inline_button(update)
-        return
-
-    max_user_answered_question_id = service.get_max_passed_question_id(user)
-    if max_user_answered_question_id < current_question_id:
+def _handle_step(update, step):
+    if step.status == service.GAME_RETRY:
         _handle_retry(update)
         return
 
-    max_question_id = service.get_max_question_id()
-    if max_user_answered_question_id == max_question_id:
-        _handle_win(update, user)
-        _release_inline_button(update)
-        return
-
-    _send_next_question(update, user, max_user_answered_question_id)
+    if step.status == service.GAME_LOSE:
+        _handle_lose(update, step)
+    elif step.status == service.GAME_WIN:
+        _handle_win(update, step)
+    elif step.status == service.GAME_NEXT:
+        _send_next_question(update, step)
     _release_inline_button(update)
 
 
 def _handle_retry(update):
-    retry_text = service.get_property(BOT_RETRY_TEXT, "Попробуйте еще раз")
-    _show_notification_if_possible(update, retry_text)
+    _show_notification_if_possible(update, _retry_text())
 
 
-def _send_next_question(update, user, current_question_id):
-    question = service.get_question(current_question_id + 1)
-    keyboard = _build_keyboard(question.question_id, {v.variant_id: v.text_value for v in question.variants}, service.get_available_hints(user))
-    _reply(update, question.text_value, reply_markup=keyboard)
+def _send_next_question(update, step):
+    _reply(update, step.question.text_value, reply_markup=_build_question_keyboard(step))
 
 
-def _handle_win(update, user):
-    win_text = service.get_property(BOT_WIN_TEXT, "Вы успешно ответили на все вопросы").format(player_place=service.get_user_place(user))
-    _reply(update, win_text)
+def _handle_win(update, step):
+    _reply(update, _win_text(step))
 
 
-def _handle_lose(update, user):
-    lose_text = service.get_property(BOT_LOSE_TEXT, "Игра закончена. Поздравляем! "
-                                                    "Из {questions_count} вопросов вы смогли правильно ответить на {question_id}").format(
-        questions_count=service.get_question_count(),
-        question_id=service.get_max_passed_question_id(user)
-    )
-    _reply(update, lose_text)
+def _handle_lose(update, step):
+    _reply(update, _lose_text(step))
 
 
-def _handle_public_help(update, user, question_id):
-    question = service.get_question(question_id)
-    grouped, total_answer_count = service.get_answer_stats(question_id)
-    answers_mapping = dict(grouped)
-    keyboard = _build_keyboard(
-        question.question_id,
-        {v.variant_id: '{}({}%)'.format(v.text_value, _calculate_distribution(answers_mapping.get(v.variant_id, 0), total_answer_count)) for v in
-         question.variants},
-        service.get_available_hints(user),
-        columns=1
-    )
-    update.effective_message.edit_reply_markup(reply_markup=keyboard)
-
-
-def _calculate_distribution(target_answers_count, total_answers_count):
-    return "{0:.2f}".format(target_answers_count / float(total_answers_count) * 100 if total_answers_count else 0)
+def _handle_public_help(update, step):
+    _edit_reply_markup(update, _build_public_help_keyboard(step))
 
 
-def _handle_fifty(update, user, question_id):
+def _handle_fifty(update, step):
     """
     :return: if callback_query answered
     """
-    message = update.effective_message
-    question = service.get_question(question_id)
-    variants_to_leave = len(question.variants) - int(len(question.variants) / 2)
-    if variants_to_leave <= 1:
-        text = service.get_property(BOT_FIFTY_FOR_TWO_TEXT, 'Orly ^O,o^')
-        return _show_notification_if_possible(text, update)
-
-    rest = [variant for variant in question.variants if variant.correct]
-    rest += random.sample([variant for variant in question.variants if not variant.correct], variants_to_leave - len(rest))
-    keyboard = _build_keyboard(question.question_id, {v.variant_id: v.text_value for v in rest}, service.get_available_hints(user))
-    message.edit_reply_markup(reply_markup=keyboard)
+    keyboard = _build_fifty_keyboard(step)
+    if not keyboard:
+        return _show_notification_if_possible(update, _fifty_for_two_text())
+    _edit_reply_markup(update, keyboard)
     return False
 
 
 def _show_notification_if_possible(update, text):
     if update.callback_query:
-        update.callback_query.answer(text='\n'.join(text.split('<br>')), parse_mode=ParseMode.HTML)
+        _outbox.answer_callback_query(update.callback_query.id, text=_to_telegram_text(text), parse_mode=ParseMode.HTML)
         return True
     return False
 
@@ -171,7 +135,7 @@ def _show_notification_if_possible(update, text):
 def _release_inline_button(update):
     # to release inline button
     if update.callback_query:
-        update.callback_query.answer()
+        _outbox.answer_callback_query(update.callback_query.id)
 
 
 def place_handler(_, update):
@@ -179,21 +143,115 @@ def place_handler(_, update):
     service.add_player(user, update.effective_message.chat_id, datetime.datetime.now())
     place = service.get_user_place(user)
     if place:
-        place_text = service.get_property(BOT_PLACE_TEXT, 'Сейчас Вы на {player_place}м месте').format(player_place=place)
-        _reply(update, place_text)
+        _reply(update, _place_text(place))
     else:
         start_handler(_, update)
 
 
 def help_handler(_, update):
-    help_text = service.get_property(BOT_HELP_TEXT, "Победить в нашей игре - легко!<br>Достаточно ответить на вопросы как можно быстрее, "
-                                                    "использовав при этом минимум подсказок<br>"
-                                                    "Если нужно повторить вопрос - просто поздоровайтесь с ботом")
-    _reply(update, help_text)
+    _reply(update, _help_text())
 
 
 def _reply(update, text, reply_markup=None):
-    update.effective_message.reply_text('\n'.join(text.split('<br>')), parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    _outbox.send_message(update.effective_message.chat_id, _to_telegram_text(text), parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+def _edit_reply_markup(update, reply_markup):
+    _outbox.edit_message_reply_markup(update.effective_message.chat_id, update.effective_message.message_id, reply_markup)
+
+
+def _to_telegram_text(text):
+    return '\n'.join(text.split('<br>'))
+
+
+def _retry_text():
+    return service.get_property(BOT_RETRY_TEXT, "Попробуйте еще раз")
+
+
+def _win_text(step):
+    return service.get_property(BOT_WIN_TEXT, "Вы успешно ответили на все вопросы").format(player_place=step.player_place)
+
+
+def _lose_text(step):
+    return service.get_property(BOT_LOSE_TEXT, "Игра закончена. Поздравляем! "
+                                               "Из {questions_count} вопросов вы смогли правильно ответить на {question_id}").format(
+        questions_count=step.question_count,
+        question_id=step.max_passed_question_id
+    )
+
+
+def _place_text(place):
+    return service.get_property(BOT_PLACE_TEXT, 'Сейчас Вы на {player_place}м месте').format(player_place=place)
+
+
+def _help_text():
+    return service.get_property(BOT_HELP_TEXT, "Победить в нашей игре - легко!<br>Достаточно ответить на вопросы как можно быстрее, "
+                                               "использовав при этом минимум подсказок<br>"
+                                               "Если нужно повторить вопрос - просто поздоровайтесь с ботом")
+
+
+def _hint_unavailable_text():
+    return service.get_property(BOT_HINT_UNAVAILABLE_TEXT, "Подсказка уже использована")
+
+
+def _fifty_for_two_text():
+    return service.get_property(BOT_FIFTY_FOR_TWO_TEXT, 'Orly ^O,o^')
+
+
+def _build_question_keyboard(step):
+    question = step.question
+    return _get_cached_keyboard(question, question.variants, step.hints)
+
+
+def _build_public_help_keyboard(step):
+    question = step.question
+    grouped, total_answer_count = step.answer_stats
+    answers_mapping = dict(grouped)
+    return _build_keyboard(
+        question.question_id,
+        {v.variant_id: '{}({}%)'.format(v.text_value, _calculate_distribution(answers_mapping.get(v.variant_id, 0), total_answer_count)) for v in
+         question.variants},
+        step.hints,
+        columns=1
+    )
+
+
+def _calculate_distribution(target_answers_count, total_answers_count):
+    return "{0:.2f}".format(target_answers_count / float(total_answers_count) * 100 if total_answers_count else 0)
+
+
+def _build_fifty_keyboard(step):
+    """
+    :return: keyboard with half of variants or None if there is nothing to hide
+    """
+    question = step.question
+    variants_to_leave = len(question.variants) - int(len(question.variants) / 2)
+    if variants_to_leave <= 1:
+        return None
+
+    rest = [variant for variant in question.variants if variant.correct]
+    rest += random.sample([variant for variant in question.variants if not variant.correct], variants_to_leave - len(rest))
+    return _get_cached_keyboard(question, rest, step.hints)
+
+
+def _get_cached_keyboard(question, variants, hints, columns=2):
+    """
+    Keyboards of the same variants and hints are shared, texts come from the catalog and hint titles are in the key
+    """
+    global _keyboard_cache
+    cached_catalog, keyboards = _keyboard_cache
+    catalog = service.get_catalog()
+    # the catalog itself and not its version, a reload after an edit that did not bump the version changes texts too
+    if cached_catalog is not catalog or len(keyboards) > _KEYBOARD_CACHE_SIZE:
+        keyboards = {}
+        _keyboard_cache = (catalog, keyboards)
+    key = (question.question_id, tuple(sorted(v.variant_id for v in variants)),
+           tuple((hint['hint_key'], hint['hint_title']) for hint in hints), columns)
+    keyboard = keyboards.get(key)
+    if keyboard is None:
+        keyboard = _build_keyboard(question.question_id, {v.variant_id: v.text_value for v in variants}, hints, columns)
+        keyboards[key] = keyboard
+    return keyboard
 
 
 def error(_, update, err):
@@ -202,9 +260,9 @@ def error(_, update, err):
 
 def _build_keyboard(question_id, key_text_variants, hints, columns=2):
     options = [InlineKeyboardButton('{}: {}'.format(variant_key, key_text_variants[variant_key]),
-                                    callback_data=json.dumps(('answer', question_id, variant_key)))
+                                    callback_data=dispatch.encode_answer_callback(question_id, variant_key))
                for variant_key in sorted(key_text_variants)]
-    hints = [InlineKeyboardButton(hint['hint_title'], callback_data=json.dumps(('hint', hint['hint_key'], question_id)))
+    hints = [InlineKeyboardButton(hint['hint_title'], callback_data=dispatch.encode_hint_callback(hint['hint_key'], question_id))
              for hint in hints]
     return InlineKeyboardMarkup(_build_menu(options, columns, footer_buttons=hints))
 
@@ -218,8 +276,53 @@ def _build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     return menu
 
 
+def _timed(handler):
+    return metrics.timed(metrics.HANDLER_SECONDS, handler=handler.__name__)(handler)
+
+
+def register_handlers(dispatcher, workers, sender):
+    """
+    Adds the game handlers to a telegram.ext.Dispatcher and makes it process updates of different users in parallel
+    :param sender: started outbox.Outbox the handlers queue their replies to
+    :return: the installed dispatch.UserDispatcher
+    """
+    global _outbox
+    _outbox = sender
+    dispatcher.add_handler(CommandHandler('help', _timed(help_handler)))
+    dispatcher.add_handler(CommandHandler('start', _timed(start_handler)))
+    dispatcher.add_handler(CommandHandler('place', _timed(place_handler)))
+    dispatcher.add_handler(CallbackQueryHandler(_timed(answer_button_handler), pattern=dispatch.ANSWER_CALLBACK_PATTERN))
+    dispatcher.add_handler(CallbackQueryHandler(_timed(hint_button_handler), pattern=dispatch.HINT_CALLBACK_PATTERN))
+    dispatcher.add_handler(MessageHandler(Filters.all, _timed(start_handler)))
+    dispatcher.add_error_handler(error)
+    return dispatch.install(dispatcher, workers, _release_inline_button, admission.Admission())
+
+
+def _start_webhook(updater):
+    coordinator = lease.Coordinator()
+    coordinator.start()
+    atexit.register(coordinator.stop)
+
+    def on_update(data, forwarded):
+        if not coordinator.route(data, forwarded):
+            return
+        update = Update.de_json(data, updater.bot)
+        if webhook.WEBHOOK_ACK_FIRST:
+            updater.update_queue.put(update)
+        else:
+            updater.dispatcher.process_update(update).result()
+
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+    server = webhook.create_server(on_update)
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    webhook.set_webhook(updater.bot)
+
+
 if __name__ == "__main__":
     service.init()
+    service.add_players_changed_listener(dispatch.forget_passed)
+    if BOT_METRICS_PORT:
+        metrics.start_server(BOT_METRICS_PORT)
     request_kwargs = {
         'proxy_url': os.environ['TG_PROXY_URL'], 'urllib3_proxy_kwargs': {}
         # Optional, if you need authentication:
@@ -228,14 +331,23 @@ if __name__ == "__main__":
         #     'password': 'PROXY_PASS',
         # }
     } if os.environ['TG_PROXY_URL'] else {}
-    updater = service.create_updater(os.environ['BOT_TOKEN'], os.environ['BOT_WORKERS'], request_kwargs)
-    updater.dispatcher.add_handler(CommandHandler('help', help_handler))
-    updater.dispatcher.add_handler(CommandHandler('start', start_handler))
-    updater.dispatcher.add_handler(CommandHandler('place', place_handler))
-    updater.dispatcher.add_handler(CallbackQueryHandler(answer_button_handler, pattern='\["answer"'))
-    updater.dispatcher.add_handler(CallbackQueryHandler(hint_button_handler, pattern='\["hint"'))
-    updater.dispatcher.add_handler(MessageHandler(Filters.all, start_handler))
-    updater.dispatcher.add_error_handler(error)
-
-    updater.start_polling()
-    updater.idle()
+    if os.environ.get('BOT_RUNTIME') == BOT_RUNTIME_ASYNCIO:
+        # asyncio runtime brings its own dependencies, threaded one does not need them
+        import async_bot
+
+        async_bot.run(os.environ['BOT_TOKEN'], os.environ['TG_PROXY_URL'] or None)
+    else:
+        updater = service.create_updater(os.environ['BOT_TOKEN'], os.environ['BOT_WORKERS'], request_kwargs)
+        sender = outbox.Outbox(service.create_bot(os.environ['BOT_TOKEN'], outbox.OUTBOX_WORKERS, request_kwargs))
+        sender.start()
+        atexit.register(sender.stop)
+        register_handlers(updater.dispatcher, os.environ['BOT_WORKERS'], sender)
+        recorder = recording.create_recorder()
+        if recorder:
+            recording.install(updater.dispatcher, recorder)
+
+        if webhook.is_webhook_mode():
+            _start_webhook(updater)
+        else:
+            updater.start_polling()
+        updater.idle()
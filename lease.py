@@ -0,0 +1,237 @@
+# coding=utf-8
+# several webhook bot instances behind a load balancer: each player is served by the one instance holding the player lease,
+# updates reaching other instances are forwarded to it
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+
+import loggers
+import metrics
+import service
+import webhook
+
+logger = loggers.logging.getLogger(__name__)
+
+LEASE_HEARTBEAT_SECONDS = float(os.environ.get('LEASE_HEARTBEAT_SECONDS') or 2)
+# an instance silent for this long loses its players to the instances receiving their updates
+LEASE_TTL_SECONDS = float(os.environ.get('LEASE_TTL_SECONDS') or 6)
+_DEAD_INSTANCE_CLEANUP_SECONDS = 3600
+_FORWARD_TIMEOUT_SECONDS = 5
+
+SHED_NO_LEASE = 'no_lease'
+
+
+def _default_address():
+    return 'http://{}:{}{}'.format(socket.gethostbyname(socket.gethostname()), webhook.WEBHOOK_PORT, webhook.WEBHOOK_PATH)
+
+
+class Coordinator(object):
+    """
+    Keeps the instance heartbeat and decides where an update of a player is processed
+    """
+
+    def __init__(self, instance_id=None, address=None, heartbeat_seconds=LEASE_HEARTBEAT_SECONDS, ttl_seconds=LEASE_TTL_SECONDS):
+        self.instance_id = instance_id or os.environ.get('BOT_INSTANCE_ID') or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.address = address or os.environ.get('BOT_INSTANCE_ADDRESS') or _default_address()
+        self._heartbeat_seconds = heartbeat_seconds
+        self._ttl_seconds = ttl_seconds
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # players whose lease this instance holds, forgotten when heartbeats were missed and others could take them
+        self._owned_player_ids = set()
+        self._last_beat_time = 0
+
+    def start(self):
+        service.set_lease_instance(self.instance_id)
+        self._beat()
+        threading.Thread(target=self._run_heartbeat, name='lease-heartbeat', daemon=True).start()
+        logger.info('Bot instance {} started at {}'.format(self.instance_id, self.address))
+
+    def stop(self):
+        """
+        Releases all leases so other instances take the players over at once
+        """
+        self._stopped.set()
+        service.drop_bot_instance(self.instance_id)
+
+    def _run_heartbeat(self):
+        while not self._stopped.wait(self._heartbeat_seconds):
+            try:
+                self._beat()
+            except Exception:
+                logger.warning('Heartbeat of {} failed'.format(self.instance_id), exc_info=True)
+                if time.time() - self._last_beat_time > self._ttl_seconds:
+                    self._forget_players()
+
+    def _beat(self):
+        service.beat_bot_instance(self.instance_id, self.address, _DEAD_INSTANCE_CLEANUP_SECONDS)
+        now = time.time()
+        if now - self._last_beat_time > self._ttl_seconds:
+            self._forget_players()
+        self._last_beat_time = now
+
+    def _forget_players(self):
+        with self._lock:
+            self._owned_player_ids.clear()
+
+    def route(self, data, forwarded=False):
+        """
+        Forwards the update to the instance holding the lease of its player, forwarded updates are processed only if this instance
+        still holds it. The update is dropped when the lease can not be taken nor the holder reached
+        :return: if the update is to be processed by this instance
+        """
+        user = Update.de_json(data, None).effective_user
+        if not user:
+            return True
+        player_id = str(user.id)
+        if time.time() - self._last_beat_time > self._ttl_seconds:
+            # heartbeats are late, the cached leases may have been taken over already
+            self._forget_players()
+        with self._lock:
+            if player_id in self._owned_player_ids and not forwarded:
+                return True
+
+        attempts = int(self._ttl_seconds / self._heartbeat_seconds) + 2
+        for attempt in range(attempts):
+            held, holder_address = service.acquire_player_lease(player_id, self.instance_id, self._ttl_seconds)
+            if held:
+                with self._lock:
+                    owned = player_id in self._owned_player_ids
+                    self._owned_player_ids.add(player_id)
+                if not owned:
+                    # the player could have played on another instance since this one cached the progress
+                    service.invalidate_player_progress([player_id])
+                return True
+            with self._lock:
+                self._owned_player_ids.discard(player_id)
+            if forwarded:
+                # the lease moved on while the update was forwarded, passing it further could bounce it between instances
+                logger.warning('Dropped update of player id={} forwarded by a former lease holder'.format(player_id))
+                metrics.SHED_UPDATES.inc(reason=SHED_NO_LEASE)
+                return False
+            if holder_address:
+                try:
+                    webhook.post_update(holder_address, json.dumps(data).encode('utf-8'), forwarded_by=self.instance_id,
+                                        timeout=_FORWARD_TIMEOUT_SECONDS)
+                    return False
+                except Exception as ex:
+                    # the holder is probably dead, its lease expires once heartbeats stop
+                    logger.warning('Forwarding to {} failed, ex={}'.format(holder_address, ex))
+                    self._stopped.wait(self._heartbeat_seconds)
+            # with no address the holder has just been dropped and the lease is free to take on the next attempt
+        logger.warning('Dropped update of player id={}, its lease could not be taken nor the holder reached'.format(player_id))
+        metrics.SHED_UPDATES.inc(reason=SHED_NO_LEASE)
+        return False
+
+
+def _run_selftest_instance(index, port, heartbeat_seconds, ttl_seconds, events):
+    service.init()
+    coordinator = Coordinator('selftest-{}'.format(index), 'http://127.0.0.1:{}{}'.format(port, webhook.WEBHOOK_PATH),
+                              heartbeat_seconds, ttl_seconds)
+    coordinator.start()
+
+    def on_update(data, forwarded):
+        if not coordinator.route(data, forwarded):
+            return
+        start_time = time.time()
+        time.sleep(random.uniform(0.005, 0.02))
+        events.put((data['message']['from']['id'], index, start_time, time.time(), data['sent_time']))
+
+    server = webhook.create_server(on_update, port)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    events.put(('started', index))
+    try:
+        server.serve_forever()
+    finally:
+        coordinator.stop()
+
+
+def _build_selftest_update(update_id, player_id):
+    return {'update_id': update_id, 'sent_time': time.time(),
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': '/place',
+                        'chat': {'id': player_id, 'type': 'private'},
+                        'from': {'id': player_id, 'is_bot': False, 'first_name': 'selftest'}}}
+
+
+def _post_selftest_updates(ports, player_ids, update_count):
+    def post(update_id):
+        player_id = random.choice(player_ids)
+        url = 'http://127.0.0.1:{}{}'.format(random.choice(ports), webhook.WEBHOOK_PATH)
+        webhook.post_update(url, json.dumps(_build_selftest_update(update_id, player_id)).encode('utf-8'))
+
+    with ThreadPoolExecutor(16) as executor:
+        list(executor.map(post, range(update_count)))
+
+
+def _collect_selftest_events(events, count):
+    collected = [events.get(timeout=60) for _ in range(count)]
+    by_player = {}
+    for player_id, index, start_time, end_time, sent_time in collected:
+        by_player.setdefault(player_id, []).append((start_time, end_time, index, sent_time))
+    overlaps = 0
+    for intervals in by_player.values():
+        intervals.sort()
+        for previous, current in zip(intervals, intervals[1:]):
+            if previous[2] != current[2] and current[0] < previous[1]:
+                overlaps += 1
+    return collected, by_player, overlaps
+
+
+def _selftest(instance_count, player_count, update_count, heartbeat_seconds, ttl_seconds):
+    """
+    Starts instances as separate processes over the real database and checks players are never processed by
+    two instances at once, then kills an instance and measures how fast its players are taken over
+    :return: (overlaps, updates of orphaned players sent, processed, overlaps after the kill)
+    """
+    ports = [18600 + index for index in range(instance_count)]
+    events = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_run_selftest_instance, args=(index, port, heartbeat_seconds, ttl_seconds, events))
+                 for index, port in enumerate(ports)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        events.get(timeout=60)
+
+    player_ids = [900000000 + index for index in range(player_count)]
+    _post_selftest_updates(ports, player_ids, update_count)
+    collected, by_player, overlaps = _collect_selftest_events(events, update_count)
+    moved = sum(1 for intervals in by_player.values() if len({index for _, _, index, _ in intervals}) > 1)
+    print('processed={} overlaps={} players_served_by_several_instances={}'.format(len(collected), overlaps, moved))
+
+    os.kill(processes[0].pid, signal.SIGKILL)
+    orphan_ids = [player_id for player_id, intervals in by_player.items() if intervals[0][2] == 0]
+    _post_selftest_updates(ports[1:], orphan_ids, len(orphan_ids))
+    taken_over, _, failover_overlaps = _collect_selftest_events(events, len(orphan_ids))
+    failover_seconds = max([end_time - sent_time for _, _, _, end_time, sent_time in taken_over] or [0])
+    print('orphaned players={} taken over, overlaps={} max failover={:.1f}s'.format(len(taken_over), failover_overlaps, failover_seconds))
+
+    for process in processes[1:]:
+        process.terminate()
+    for process in processes:
+        process.join()
+    return overlaps, len(orphan_ids), len(taken_over), failover_overlaps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bot instance coordination')
+    parser.add_argument('--selftest', action='store_true', help='run instances as local processes against the database')
+    parser.add_argument('--instances', type=int, default=3)
+    parser.add_argument('--players', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--heartbeat', type=float, default=1, help='heartbeat interval, seconds')
+    parser.add_argument('--ttl', type=float, default=3, help='lease ttl, seconds')
+    args = parser.parse_args()
+    if args.selftest:
+        _selftest(args.instances, args.players, args.updates, args.heartbeat, args.ttl)
+    else:
+        parser.print_help()
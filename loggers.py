@@ -1,6 +1,7 @@
 # coding=utf-8
 
 import logging
+import os
 
-logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.DEBUG)
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=os.environ.get('LOG_LEVEL') or 'INFO')
 logging = logging
@@ -0,0 +1,201 @@
+# coding=utf-8
+# in-process latency histograms and counters rendered in Prometheus text format, cheap enough to be updated on every update
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import loggers
+
+logger = loggers.logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+_metrics = []
+
+
+class Counter(object):
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.label_names), 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.label_names, key), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, label_names=(), buckets=_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [per bucket counts with +Inf last, sum]
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def totals(self):
+        """
+        :return: {label values: (count, sum)}
+        """
+        with self._lock:
+            return {key: (sum(counts), total) for key, (counts, total) in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.label_names + ('le',), key + (bound,)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.label_names, key), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.label_names, key), cumulative))
+        return lines
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in zip(names, values)) + '}'
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_SECONDS = Histogram('khsm_handler_seconds', 'Time to handle an update', ['handler'])
+UPDATE_QUERIES = Histogram('khsm_update_queries', 'SQL statements sent while handling an update', buckets=_COUNT_BUCKETS)
+SERVICE_SECONDS = Histogram('khsm_service_seconds', 'Time of a service function with its transaction', ['function'])
+POOL_WAIT_SECONDS = Histogram('khsm_db_pool_wait_seconds', 'Time to get a database connection from the pool', ['pool'])
+SQL_STATEMENTS = Counter('khsm_sql_statements_total', 'SQL statements sent')
+TELEGRAM_SECONDS = Histogram('khsm_telegram_api_seconds', 'Telegram Bot API call time', ['method'])
+TELEGRAM_ERRORS = Counter('khsm_telegram_api_errors_total', 'Failed Telegram Bot API calls', ['method'])
+SHED_UPDATES = Counter('khsm_shed_updates_total', 'Updates dropped without reaching handlers', ['reason'])
+OUTBOX_SECONDS = Histogram('khsm_outbox_seconds', 'Time from queueing a Telegram call until it is sent', ['method'])
+OUTBOX_COALESCED = Counter('khsm_outbox_coalesced_total', 'Queued markup edits replaced by a later edit of the same message')
+OUTBOX_RETRIES = Counter('khsm_outbox_retries_total', 'Queued Telegram calls retried after a flood limit or network error', ['method'])
+OUTBOX_DROPPED = Counter('khsm_outbox_dropped_total', 'Queued Telegram calls given up', ['method', 'reason'])
+
+
+def timed(histogram, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+# asyncio task or thread id -> [statements] of the update being handled there
+_query_counters = {}
+
+
+def _current_scope():
+    try:
+        task = _current_task()
+    except RuntimeError:
+        # no event loop in this thread
+        task = None
+    return task or threading.get_ident()
+
+
+@contextmanager
+def counting_queries():
+    """
+    Counts SQL statements sent by the current thread, or task of an event loop, into UPDATE_QUERIES
+    """
+    scope = _current_scope()
+    counter = _query_counters[scope] = [0]
+    try:
+        yield
+    finally:
+        _query_counters.pop(scope, None)
+        UPDATE_QUERIES.observe(counter[0])
+
+
+def count_query():
+    SQL_STATEMENTS.inc()
+    counter = _query_counters.get(_current_scope()) if _query_counters else None
+    if counter is not None:
+        counter[0] += 1
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_server(port, host='0.0.0.0'):
+    """
+    Serves /metrics of the process on its own thread
+    """
+    server = _ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Metrics are served at {}:{}/metrics'.format(host, port))
+    return server
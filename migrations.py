@@ -0,0 +1,366 @@
+# coding=utf-8
+# versioned schema changes applied in order by service.init() or from the command line, schema_version keeps the applied ones
+import argparse
+import datetime
+import re
+import sys
+import time
+from collections import namedtuple, OrderedDict
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import Column, Integer, String, DateTime, MetaData, Table, event, select, func
+
+import loggers
+import service
+
+logger = loggers.logging.getLogger(__name__)
+
+_MIGRATION_LOCK_KEY = 7302
+_MIGRATION_LOCK_POLL_SECONDS = 0.5
+_schema_version = Table('schema_version', MetaData(),
+                        Column('version', Integer, primary_key=True, nullable=False),
+                        Column('description', String(200), nullable=False),
+                        Column('applied_time', DateTime, nullable=False))
+
+# transactional False: applied on an autocommit connection, e.g. to build indexes concurrently
+Migration = namedtuple('Migration', ['version', 'description', 'apply', 'transactional'])
+# tables read whole into process caches or kept tiny, scanning them is fine
+_SMALL_TABLES = ('property', 'question', 'variant', 'catalog_version', 'season', 'bot_instance')
+_EXPLAINABLE_STATEMENT = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+_SEQ_SCAN = re.compile(r'Seq Scan on (\w+)')
+_PARTITION_SUFFIX = re.compile(r'_s\d+$')
+
+
+def migrate(engine):
+    """
+    Applies migrations the database has not seen yet, each in a transaction of its own
+    :return: versions applied
+    """
+    applied = []
+    with engine.connect() as lock_connection:
+        lock_connection = lock_connection.execution_options(isolation_level='AUTOCOMMIT')
+        # instances starting together apply every migration once. They poll instead of waiting for the lock, as a statement
+        # waiting for it would be a transaction that a concurrent index build of the instance holding the lock waits for
+        while not lock_connection.execute(select([func.pg_try_advisory_lock(_MIGRATION_LOCK_KEY)])).scalar():
+            time.sleep(_MIGRATION_LOCK_POLL_SECONDS)
+        try:
+            for migration in MIGRATIONS:
+                if migration.transactional:
+                    with engine.begin() as connection:
+                        applied_now = _apply(connection, migration)
+                else:
+                    with engine.connect() as connection:
+                        applied_now = _apply(connection.execution_options(isolation_level='AUTOCOMMIT'), migration)
+                if applied_now:
+                    applied.append(migration.version)
+        finally:
+            lock_connection.execute(select([func.pg_advisory_unlock(_MIGRATION_LOCK_KEY)]))
+    return applied
+
+
+def _apply(connection, migration):
+    """
+    :return: if the migration was applied now and not before
+    """
+    _schema_version.create(connection, checkfirst=True)
+    if connection.execute(select([_schema_version.c.version]).where(_schema_version.c.version == migration.version)).first():
+        return False
+    logger.info('Applying migration {} {}'.format(migration.version, migration.description))
+    migration.apply(connection)
+    connection.execute(_schema_version.insert().values(version=migration.version, description=migration.description,
+                                                       applied_time=datetime.datetime.now()))
+    return True
+
+
+def get_applied_versions(engine):
+    with engine.connect() as connection:
+        if not engine.dialect.has_table(connection, _schema_version.name):
+            return []
+        return [version for version, in connection.execute(select([_schema_version.c.version]).order_by(_schema_version.c.version))]
+
+
+def ensure_database(db_name):
+    """
+    Creates the database next to the configured one if it does not exist, e.g. a scratch one for benchmarks
+    """
+    parameters = service._build_parameters()
+    connection = psycopg2.connect(user=parameters['user'], password=parameters['passwd'], host=parameters['host'],
+                                  port=parameters['port'], dbname='postgres')
+    try:
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', (db_name,))
+        if not cursor.fetchone():
+            cursor.execute('CREATE DATABASE {}'.format(db_name))
+    finally:
+        connection.close()
+
+
+def _partition_legacy_tables(connection):
+    """
+    Turns answer and hint tables of a database from before seasons into partitions of season 1 to be attached by init_seasons.
+    Derived player_score and variant_stat are dropped to be recreated and recounted
+    """
+    for table in ('answer', 'hint'):
+        if _get_relkind(connection, table) != 'r':
+            continue
+        partition = service._partition_name(table, 1)
+        logger.info('Moving {} to partition {}'.format(table, partition))
+        connection.execute('ALTER TABLE {} RENAME TO {}'.format(table, partition))
+        # the partition gets the key and foreign keys of the partitioned table when attached
+        for constraint, in connection.execute("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%(partition)s) "
+                                              "AND contype IN ('p', 'f')", {'partition': partition}).fetchall():
+            connection.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(partition, constraint))
+        connection.execute('ALTER TABLE {} ADD COLUMN season_id integer NOT NULL DEFAULT 1'.format(partition))
+        connection.execute('ALTER TABLE {} ALTER COLUMN season_id DROP DEFAULT'.format(partition))
+    if _get_relkind(connection, 'player_score') == 'r':
+        connection.execute('DROP TABLE player_score')
+    if _get_relkind(connection, 'variant_stat') == 'r' and not connection.execute(
+            "SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'variant_stat' AND column_name = 'season_id')").scalar():
+        connection.execute('DROP TABLE variant_stat')
+
+
+def _get_relkind(connection, table):
+    """
+    :return: 'r' for a plain table, 'p' for a partitioned one, None if there is no such table
+    """
+    return connection.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%(table)s)', {'table': table}).scalar()
+
+
+# the schema of version 2 as it was written, later changes of the models go to new migrations
+_TABLES = [
+    """CREATE TABLE IF NOT EXISTS bot_instance (
+        instance_id VARCHAR(100) NOT NULL,
+        address VARCHAR(200) NOT NULL,
+        heartbeat_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (instance_id))""",
+    """CREATE TABLE IF NOT EXISTS broadcast_job (
+        job_id SERIAL NOT NULL,
+        message VARCHAR(4096) NOT NULL,
+        created_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        finished_time TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (job_id))""",
+    """CREATE TABLE IF NOT EXISTS catalog_version (
+        version SERIAL NOT NULL,
+        PRIMARY KEY (version))""",
+    """CREATE TABLE IF NOT EXISTS player (
+        player_id VARCHAR(100) NOT NULL,
+        player_name VARCHAR(100),
+        chat_id INTEGER,
+        registration_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (player_id))""",
+    """CREATE TABLE IF NOT EXISTS player_lease (
+        player_id VARCHAR(100) NOT NULL,
+        instance_id VARCHAR(100) NOT NULL,
+        acquired_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (player_id))""",
+    """CREATE TABLE IF NOT EXISTS property (
+        property_key VARCHAR(50) NOT NULL,
+        property_value VARCHAR(1000),
+        PRIMARY KEY (property_key))""",
+    """CREATE TABLE IF NOT EXISTS question (
+        question_id SERIAL NOT NULL,
+        text_value VARCHAR(1000) NOT NULL,
+        PRIMARY KEY (question_id))""",
+    """CREATE TABLE IF NOT EXISTS season (
+        season_id SERIAL NOT NULL,
+        title VARCHAR(200) NOT NULL,
+        started_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        archived_time TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (season_id))""",
+    """CREATE TABLE IF NOT EXISTS variant_stat (
+        season_id INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        variant_id VARCHAR(1) NOT NULL,
+        answer_count INTEGER NOT NULL,
+        PRIMARY KEY (season_id, question_id, variant_id))""",
+    """CREATE TABLE IF NOT EXISTS broadcast_recipient (
+        job_id INTEGER NOT NULL,
+        chat_id BIGINT NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        attempts INTEGER NOT NULL,
+        error VARCHAR(200),
+        PRIMARY KEY (job_id, chat_id),
+        FOREIGN KEY (job_id) REFERENCES broadcast_job (job_id))""",
+    """CREATE TABLE IF NOT EXISTS hint (
+        season_id INTEGER NOT NULL,
+        player_id VARCHAR(100) NOT NULL,
+        question_id INTEGER NOT NULL,
+        hint_key VARCHAR(50) NOT NULL,
+        tries INTEGER NOT NULL,
+        PRIMARY KEY (season_id, player_id, question_id, hint_key),
+        FOREIGN KEY (player_id) REFERENCES player (player_id),
+        FOREIGN KEY (question_id) REFERENCES question (question_id))
+        PARTITION BY LIST (season_id)""",
+    """CREATE TABLE IF NOT EXISTS player_score (
+        season_id INTEGER NOT NULL,
+        player_id VARCHAR(100) NOT NULL,
+        points INTEGER NOT NULL,
+        tries INTEGER NOT NULL,
+        hint_count INTEGER NOT NULL,
+        last_answer_time TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (season_id, player_id),
+        FOREIGN KEY (player_id) REFERENCES player (player_id))
+        PARTITION BY LIST (season_id)""",
+    """CREATE TABLE IF NOT EXISTS variant (
+        variant_id VARCHAR(1) NOT NULL,
+        question_id INTEGER NOT NULL,
+        text_value VARCHAR(1000) NOT NULL,
+        correct BOOLEAN NOT NULL,
+        PRIMARY KEY (variant_id, question_id),
+        FOREIGN KEY (question_id) REFERENCES question (question_id))""",
+    """CREATE TABLE IF NOT EXISTS answer (
+        season_id INTEGER NOT NULL,
+        player_id VARCHAR(100) NOT NULL,
+        question_id INTEGER NOT NULL,
+        variant_id VARCHAR(1) NOT NULL,
+        tries INTEGER NOT NULL,
+        passed BOOLEAN,
+        answer_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (season_id, player_id, question_id, variant_id),
+        FOREIGN KEY (question_id, variant_id) REFERENCES variant (question_id, variant_id),
+        FOREIGN KEY (player_id) REFERENCES player (player_id))
+        PARTITION BY LIST (season_id)""",
+]
+# (name, table, definition) as of version 3
+_INDEXES = [
+    ('ix_player_lease_instance_id', 'player_lease', '(instance_id)'),
+    ('broadcast_recipient_pending_idx', 'broadcast_recipient', "(job_id, chat_id) WHERE status = 'pending'"),
+    ('player_score_rating_idx', 'player_score', '(points DESC, tries, hint_count, last_answer_time, player_id)'),
+    ('answer_variant_idx', 'answer', '(question_id, variant_id)'),
+    ('answer_passed_idx', 'answer', '(season_id, player_id, question_id) WHERE passed = true'),
+]
+
+
+def _create_tables(connection):
+    # tables of databases created before migrations are kept as they are
+    for statement in _TABLES:
+        connection.execute(statement)
+
+
+def _create_indexes(connection):
+    """
+    Builds the indexes without blocking writes: CONCURRENTLY on plain tables, on partitioned ones concurrently per partition
+    and attached to an index created ON ONLY the partitioned table, which becomes valid once every partition has it
+    """
+    for name, table, definition in _INDEXES:
+        if _get_relkind(connection, table) != 'p':
+            _create_index_concurrently(connection, name, table, definition)
+            continue
+        if _is_index_valid(connection, name):
+            continue
+        connection.execute('CREATE INDEX IF NOT EXISTS {} ON ONLY {} {}'.format(name, table, definition))
+        for partition, in connection.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = to_regclass(%(table)s) '
+                                             'ORDER BY 1', {'table': table}).fetchall():
+            if connection.execute('SELECT EXISTS (SELECT 1 FROM pg_inherits JOIN pg_index ON indexrelid = inhrelid '
+                                  'WHERE inhparent = to_regclass(%(index)s) AND indrelid = to_regclass(%(partition)s))',
+                                  {'index': name, 'partition': partition}).scalar():
+                continue
+            partition_index = name.replace(table, partition, 1)
+            _create_index_concurrently(connection, partition_index, partition, definition)
+            connection.execute('ALTER INDEX {} ATTACH PARTITION {}'.format(name, partition_index))
+
+
+def _create_index_concurrently(connection, name, table, definition):
+    # an interrupted concurrent build leaves an invalid index behind
+    if _is_index_valid(connection, name) is False:
+        connection.execute('DROP INDEX CONCURRENTLY {}'.format(name))
+    connection.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}'.format(name, table, definition))
+
+
+def _is_index_valid(connection, name):
+    """
+    :return: None if there is no such index
+    """
+    return connection.execute('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%(index)s)', {'index': name}).scalar()
+
+
+MIGRATIONS = [
+    Migration(1, 'partition answer and hint by season', _partition_legacy_tables, True),
+    Migration(2, 'create tables', _create_tables, True),
+    Migration(3, 'hot path indexes', _create_indexes, False),
+]
+
+
+class _CheckUser(object):
+    id = -1
+    name = 'index check'
+
+
+def check_indexes(engine):
+    """
+    Plays a made up player through the game in a transaction rolled back at the end, then EXPLAINs every statement sent
+    with sequential scans disabled, so a table is still scanned only when no index fits
+    :return: [(statement, tables scanned)]
+    """
+    statements = OrderedDict()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if _EXPLAINABLE_STATEMENT.match(statement):
+            statements.setdefault(statement, parameters[0] if executemany else parameters)
+
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        session = service._Session(bind=connection)
+        try:
+            event.listen(connection, 'before_cursor_execute', capture)
+            try:
+                _play(session)
+            finally:
+                event.remove(connection, 'before_cursor_execute', capture)
+            connection.execute('SET LOCAL enable_seqscan = off')
+            return [(statement, _get_scanned_tables(connection, statement, parameters)) for statement, parameters in statements.items()]
+        finally:
+            service._run_rollback_callbacks(session)
+            session.close()
+            transaction.rollback()
+
+
+def _play(session):
+    user = _CheckUser()
+    now = datetime.datetime.now()
+    service.enter_game.__wrapped__(session, user, user.id, now)
+    question = service.get_question(1) if service.get_max_question_id() else None
+    if question:
+        service.use_hint.__wrapped__(session, user, service.PUBLIC_HELP_HINT_KEY, question.question_id)
+        wrong_variant_ids = [variant.variant_id for variant in question.variants if not variant.correct]
+        if wrong_variant_ids:
+            service.submit_answer.__wrapped__(session, user, question.question_id, wrong_variant_ids[0], now)
+        service.submit_answer.__wrapped__(session, user, question.question_id, sorted(question.correct_variant_ids)[0], now)
+    service.get_user_place.__wrapped__(session, user)
+    service.get_top.__wrapped__(session)
+    page, after = service.get_rating_page.__wrapped__(session, None, None, 1)
+    if after:
+        service.get_rating_page.__wrapped__(session, after, None, 1)
+    service.beat_bot_instance.__wrapped__(session, 'index-check', 'http://localhost/', 3600)
+    service.acquire_player_lease.__wrapped__(session, str(user.id), 'index-check', 6)
+    service.get_pending_broadcast_chat_ids.__wrapped__(session, 0, 100)
+
+
+def _get_scanned_tables(connection, statement, parameters):
+    plan = '\n'.join(line for line, in connection.exec_driver_sql('EXPLAIN ' + statement, parameters))
+    return sorted({_PARTITION_SUFFIX.sub('', table) for table in _SEQ_SCAN.findall(plan)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Database schema migrations')
+    parser.add_argument('--status', action='store_true', help='list applied migrations only')
+    parser.add_argument('--check', action='store_true', help='check the game queries use indexes')
+    args = parser.parse_args()
+    if args.status:
+        service.configure()
+        applied_versions = get_applied_versions(service.get_engine())
+        for migration in MIGRATIONS:
+            print('{} {} {}'.format(migration.version, 'applied' if migration.version in applied_versions else 'pending',
+                                    migration.description))
+        sys.exit(0)
+
+    service.init(background=False, migrate=migrate)
+    if args.check:
+        missing = 0
+        for statement, tables in check_indexes(service.get_engine()):
+            scanned = [table for table in tables if table not in _SMALL_TABLES]
+            missing += bool(scanned)
+            print('{:<20} {}'.format('SCAN ' + ','.join(scanned) if scanned else 'ok', ' '.join(statement.split())[:150]))
+        sys.exit(1 if missing else 0)
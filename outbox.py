@@ -0,0 +1,212 @@
+# coding=utf-8
+# replies of the handlers are queued and sent by sender threads with a connection pool of their own,
+# so a slow Telegram API or proxy holds senders instead of the workers handling updates
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, NetworkError, BadRequest, Unauthorized, TelegramError
+
+import broadcast
+import loggers
+import metrics
+
+logger = loggers.logging.getLogger(__name__)
+
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS') or 8)
+# the same Telegram limits as for broadcasts, see broadcast.py
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE') or 30)
+OUTBOX_CHAT_INTERVAL = float(os.environ.get('OUTBOX_CHAT_INTERVAL') or 1)
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS') or 3)
+# calls waiting to be sent, new ones are dropped over it
+OUTBOX_MAX_QUEUED = int(os.environ.get('OUTBOX_MAX_QUEUED') or 10000)
+_MAX_BACKOFF_SECONDS = 10
+# callback answers are not counted against the message limits
+_RATE_LIMITED_METHODS = ('send_message', 'edit_message_reply_markup')
+# a message timed out or broken after it was sent may have been delivered, sending it again would duplicate it;
+# edits and answers are safe to repeat
+_NOT_RETRIED_ONCE_SENT = ('send_message',)
+
+DROPPED_FULL = 'full'
+DROPPED_FAILED = 'failed'
+
+
+class _Call(object):
+    def __init__(self, method, kwargs, coalesce_key):
+        self.method = method
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.queued_time = time.time()
+        self.attempt = 0
+
+
+class _Lane(object):
+    """
+    Calls to one chat, sent one by one in order
+    """
+
+    def __init__(self, key, chat_id):
+        self.key = key
+        self.chat_id = chat_id
+        self.calls = deque()
+        # the first call is being sent and can not be changed
+        self.sending = False
+
+
+class Outbox(object):
+    """
+    Sends Bot API calls queued by handlers in order per chat, spaced by broadcast.RateLimiter.
+    A markup edit of a message still waiting in the queue is replaced by a later one, flood limits and network errors are retried
+    """
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS, rate=OUTBOX_RATE, chat_interval=OUTBOX_CHAT_INTERVAL,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, max_queued=OUTBOX_MAX_QUEUED):
+        self._bot = bot
+        self._workers = workers
+        self._limiter = broadcast.RateLimiter(rate, chat_interval)
+        self._max_attempts = max_attempts
+        self._max_queued = max_queued
+        self._condition = threading.Condition()
+        # heap of (due time, sequence, lane) of lanes waiting for their first call to be sent
+        self._due = []
+        self._sequence = itertools.count()
+        # lane key -> _Lane with calls, a lane is either in _due or taken by a sender
+        self._lanes = {}
+        self._queued = 0
+        self._stopped = False
+
+    def start(self):
+        for i in range(self._workers):
+            threading.Thread(target=self._run, name='outbox-{}'.format(i), daemon=True).start()
+
+    def stop(self, timeout=5):
+        """
+        Waits up to timeout seconds, None for no limit, for the queued calls to be sent and stops the senders
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not self._lanes, timeout)
+            self._stopped = True
+            self._condition.notify_all()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._put(chat_id, chat_id, 'send_message', dict(kwargs, chat_id=chat_id, text=text))
+
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup):
+        self._put(chat_id, chat_id, 'edit_message_reply_markup',
+                  {'chat_id': chat_id, 'message_id': message_id, 'reply_markup': reply_markup}, coalesce_key=message_id)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        # the button spins until it is answered, so answers do not wait behind messages of the chat
+        self._put(('callback', callback_query_id), None, 'answer_callback_query', dict(kwargs, callback_query_id=callback_query_id))
+
+    def _put(self, key, chat_id, method, kwargs, coalesce_key=None):
+        with self._condition:
+            lane = self._lanes.get(key)
+            if lane and coalesce_key is not None:
+                for call in itertools.islice(lane.calls, 1 if lane.sending else 0, None):
+                    if call.method == method and call.coalesce_key == coalesce_key:
+                        call.kwargs = kwargs
+                        metrics.OUTBOX_COALESCED.inc()
+                        return
+            if self._queued >= self._max_queued:
+                metrics.OUTBOX_DROPPED.inc(method=method, reason=DROPPED_FULL)
+                logger.warning('Outbox is full, dropped {} to chat_id={}'.format(method, chat_id))
+                return
+            self._queued += 1
+            if lane:
+                lane.calls.append(_Call(method, kwargs, coalesce_key))
+                return
+            lane = _Lane(key, chat_id)
+            lane.calls.append(_Call(method, kwargs, coalesce_key))
+            self._lanes[key] = lane
+            self._schedule(lane)
+
+    def _schedule(self, lane, not_before=None):
+        due_time = max(time.time(), not_before or 0)
+        if lane.calls[0].method in _RATE_LIMITED_METHODS:
+            due_time = max(due_time, self._limiter.reserve(lane.chat_id))
+        heapq.heappush(self._due, (due_time, next(self._sequence), lane))
+        self._condition.notify()
+
+    def _take_due(self):
+        """
+        :return: lane due to send its first call or None when stopped
+        """
+        while not self._stopped:
+            now = time.time()
+            if self._due and self._due[0][0] <= now:
+                lane = heapq.heappop(self._due)[2]
+                # due times were booked before a flood wait may have started, booking again spaces them after it
+                paused_until = self._limiter.paused_until()
+                if paused_until > now and lane.calls[0].method in _RATE_LIMITED_METHODS:
+                    due_time = max(paused_until, self._limiter.reserve(lane.chat_id))
+                    heapq.heappush(self._due, (due_time, next(self._sequence), lane))
+                    continue
+                lane.sending = True
+                return lane
+            self._condition.wait(self._due[0][0] - now if self._due else None)
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                lane = self._take_due()
+                if lane is None:
+                    return
+            call = lane.calls[0]
+            try:
+                retry_time = self._send(call)
+            except Exception:
+                logger.error('Error sending {} to chat_id={}'.format(call.method, lane.chat_id), exc_info=True)
+                metrics.OUTBOX_DROPPED.inc(method=call.method, reason=DROPPED_FAILED)
+                retry_time = None
+            with self._condition:
+                lane.sending = False
+                if retry_time is None:
+                    lane.calls.popleft()
+                    self._queued -= 1
+                if lane.calls:
+                    self._schedule(lane, retry_time)
+                else:
+                    del self._lanes[lane.key]
+                    self._condition.notify_all()
+
+    def _send(self, call):
+        """
+        :return: time to try the call again or None if it is done with
+        """
+        call.attempt += 1
+        try:
+            getattr(self._bot, call.method)(**call.kwargs)
+            metrics.OUTBOX_SECONDS.observe(time.time() - call.queued_time, method=call.method)
+            return None
+        except RetryAfter as ex:
+            self._limiter.pause(ex.retry_after)
+            retry_time = time.time() + ex.retry_after
+            error = ex
+        except (BadRequest, Unauthorized) as ex:
+            # message is not modified, query is too old, bot was blocked - retrying does not help
+            logger.info('Telegram refused {}, ex={}'.format(call.method, ex))
+            metrics.OUTBOX_DROPPED.inc(method=call.method, reason=DROPPED_FAILED)
+            return None
+        except NetworkError as ex:
+            if call.method in _NOT_RETRIED_ONCE_SENT and not broadcast.is_unsent(ex):
+                logger.warning('{} failed with {}, not retried as it may have been delivered'.format(call.method, type(ex).__name__))
+                metrics.OUTBOX_DROPPED.inc(method=call.method, reason=DROPPED_FAILED)
+                return None
+            retry_time = time.time() + random.uniform(0.5, 1) * min(2 ** call.attempt, _MAX_BACKOFF_SECONDS)
+            error = ex
+        except TelegramError as ex:
+            logger.warning('Error sending {}, ex={}'.format(call.method, ex))
+            metrics.OUTBOX_DROPPED.inc(method=call.method, reason=DROPPED_FAILED)
+            return None
+        if call.attempt >= self._max_attempts:
+            logger.warning('Gave up {} after {} attempts, ex={}'.format(call.method, call.attempt, type(error).__name__))
+            metrics.OUTBOX_DROPPED.inc(method=call.method, reason=DROPPED_FAILED)
+            return None
+        metrics.OUTBOX_RETRIES.inc(method=call.method)
+        return retry_time
@@ -0,0 +1,193 @@
+# coding=utf-8
+# question packs: the whole quiz content as JSON or CSV to move it in and out of the console
+import csv
+import io
+import json
+
+JSON_FORMAT = 'json'
+CSV_FORMAT = 'csv'
+FORMATS = (JSON_FORMAT, CSV_FORMAT)
+
+CSV_COLUMNS = ['question_id', 'question_text', 'variant_id', 'variant_text', 'correct']
+_TEXT_MAX_LENGTH = 1000
+_TRUE_VALUES = ('true', '1', 'yes', 'y', '+', '*')
+_FALSE_VALUES = ('false', '0', 'no', 'n', '-', '')
+
+
+class QuestionPackError(ValueError):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def parse(content, pack_format):
+    """
+    :param content: text of the pack
+    :return: validated questions as dicts with question_id (None for new ones), text_value and variants
+    """
+    if pack_format == JSON_FORMAT:
+        questions = _parse_json(content)
+    elif pack_format == CSV_FORMAT:
+        questions = _parse_csv(content)
+    else:
+        raise QuestionPackError(['Unknown pack format {}'.format(pack_format)])
+    return validate(questions)
+
+
+def _parse_json(content):
+    try:
+        pack = json.loads(content)
+    except ValueError as ex:
+        raise QuestionPackError(['Not a JSON: {}'.format(ex)])
+    questions = pack.get('questions') if isinstance(pack, dict) else pack
+    if not isinstance(questions, list):
+        raise QuestionPackError(['Expected a list of questions or {"questions": [...]}'])
+    return questions
+
+
+def _parse_csv(content):
+    reader = csv.DictReader(io.StringIO(content))
+    missing_columns = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing_columns:
+        raise QuestionPackError(['Missing CSV columns: {}'.format(', '.join(missing_columns))])
+    questions = []
+    errors = []
+    # rows of a question go one after another, new questions without id are told apart by their text
+    for line, row in enumerate(reader, start=2):
+        question_key = (_cell(row, 'question_id'), _cell(row, 'question_text'))
+        if not questions or questions[-1]['key'] != question_key:
+            questions.append({'key': question_key, 'question_id': question_key[0] or None, 'text_value': question_key[1], 'variants': []})
+        correct = _parse_correct(_cell(row, 'correct'))
+        if correct is None:
+            errors.append('Line {}: correct should be true or false'.format(line))
+        questions[-1]['variants'].append({'variant_id': _cell(row, 'variant_id'), 'text_value': _cell(row, 'variant_text'),
+                                          'correct': bool(correct)})
+    if errors:
+        raise QuestionPackError(errors)
+    for question in questions:
+        del question['key']
+    return questions
+
+
+def _cell(row, column):
+    # cells missing from a short row are None
+    return (row[column] or '').strip()
+
+
+def _parse_correct(value):
+    """
+    :return: True, False or None if value does not say
+    """
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, int):
+        return value == 1 if value in (0, 1) else None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in _TRUE_VALUES:
+            return True
+        if value in _FALSE_VALUES:
+            return False
+    return None
+
+
+def validate(questions):
+    errors = []
+    validated = []
+    question_ids = set()
+    for position, question in enumerate(questions, start=1):
+        if not isinstance(question, dict):
+            errors.append('Question #{}: expected an object'.format(position))
+            continue
+        question_errors = []
+        question_id = question.get('question_id')
+        if question_id is not None:
+            try:
+                question_id = int(question_id)
+            except (TypeError, ValueError):
+                question_errors.append('question_id should be a number')
+            else:
+                if question_id <= 0:
+                    question_errors.append('question_id should be positive')
+                elif question_id in question_ids:
+                    question_errors.append('question_id {} is repeated'.format(question_id))
+                question_ids.add(question_id)
+        text_value = _validate_text(question.get('text_value'), 'text_value', question_errors)
+
+        variants = []
+        variant_ids = set()
+        question_variants = question.get('variants') or []
+        if not isinstance(question_variants, list):
+            question_errors.append('variants should be a list')
+            question_variants = []
+        for variant in question_variants:
+            if not isinstance(variant, dict):
+                question_errors.append('variant should be an object')
+                continue
+            variant_id = str(variant.get('variant_id') or '')
+            if len(variant_id) != 1 or not variant_id.isalnum():
+                question_errors.append('variant_id "{}" should be a single letter or digit'.format(variant_id))
+            elif variant_id in variant_ids:
+                question_errors.append('variant_id {} is repeated'.format(variant_id))
+            variant_ids.add(variant_id)
+            correct = _parse_correct(variant.get('correct'))
+            if correct is None:
+                question_errors.append('correct of variant {} should be true or false'.format(variant_id))
+            variants.append({'variant_id': variant_id,
+                             'text_value': _validate_text(variant.get('text_value'), 'text of variant {}'.format(variant_id), question_errors),
+                             'correct': bool(correct)})
+        if len(variants) < 2:
+            question_errors.append('at least two variants are needed')
+        if not any(variant['correct'] for variant in variants):
+            question_errors.append('no correct variant')
+
+        if question_errors:
+            errors.extend('Question #{}: {}'.format(position, error) for error in question_errors)
+        else:
+            validated.append({'question_id': question_id, 'text_value': text_value,
+                              'variants': sorted(variants, key=lambda v: v['variant_id'])})
+    if not validated and not errors:
+        errors.append('No questions in the pack')
+    if errors:
+        raise QuestionPackError(errors)
+    return validated
+
+
+def _validate_text(text, name, errors):
+    text = str(text or '').strip()
+    if not text:
+        errors.append('{} is empty'.format(name))
+    elif len(text) > _TEXT_MAX_LENGTH:
+        errors.append('{} is longer than {} characters'.format(name, _TEXT_MAX_LENGTH))
+    return text
+
+
+def iter_json(questions):
+    """
+    Serializes questions one by one, each question is on its own line
+    """
+    yield '{"questions": [\n'
+    for position, question in enumerate(questions):
+        yield '{}{}'.format(',\n' if position else '', json.dumps(_to_dict(question), ensure_ascii=False))
+    yield '\n]}\n'
+
+
+def iter_csv(questions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for question in questions:
+        for variant in question.variants:
+            writer.writerow([question.question_id, question.text_value, variant.variant_id, variant.text_value,
+                             'true' if variant.correct else 'false'])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _to_dict(question):
+    return {'question_id': question.question_id,
+            'text_value': question.text_value,
+            'variants': [{'variant_id': variant.variant_id, 'text_value': variant.text_value, 'correct': variant.correct}
+                         for variant in question.variants]}
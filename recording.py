@@ -0,0 +1,123 @@
+# coding=utf-8
+# incoming updates written to JSONL with anonymised users for replay.py, one update per line with its receive time
+import atexit
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import loggers
+
+logger = loggers.logging.getLogger(__name__)
+
+# file to append received updates to, not set turns recording off
+BOT_RECORD_UPDATES = os.environ.get('BOT_RECORD_UPDATES')
+# ids of the same user stay the same across recordings made with the same salt
+BOT_RECORD_SALT = os.environ.get('BOT_RECORD_SALT')
+RECORDED_TIME_KEY = 'recorded_time'
+# anonymised ids stay within the 32 bit chat_id column
+_ANONYMOUS_ID_BASE = 1000000000
+_ANONYMOUS_ID_RANGE = 1000000000
+_RECORDED_UPDATE_KEYS = ('message', 'edited_message', 'callback_query')
+
+
+class Recorder(object):
+    def __init__(self, path, salt=None):
+        self._salt = (salt or os.urandom(16).hex()).encode('utf-8')
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, data):
+        """
+        :param data: update JSON as received from Telegram
+        """
+        update = self._anonymise(data)
+        if not update:
+            return
+        update[RECORDED_TIME_KEY] = time.time()
+        line = json.dumps(update, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _anonymise(self, data):
+        """
+        Keeps what the handlers look at: ids are replaced with keyed hashes, names dropped and texts other than commands blanked
+        """
+        for key in _RECORDED_UPDATE_KEYS:
+            if data.get(key):
+                return {'update_id': data['update_id'], key: self._anonymise_message(data[key]) if key != 'callback_query'
+                        else self._anonymise_callback_query(data[key])}
+        return None
+
+    def _anonymise_message(self, message):
+        text = message.get('text') or ''
+        anonymised = {'message_id': message['message_id'],
+                      'date': message['date'],
+                      'chat': {'id': self._anonymise_id(message['chat']['id']), 'type': message['chat'].get('type', 'private')}}
+        if message.get('from'):
+            anonymised['from'] = self._anonymise_user(message['from'])
+        if text.startswith('/'):
+            anonymised['text'] = text.split(maxsplit=1)[0]
+            anonymised['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(anonymised['text'])}]
+        elif text:
+            anonymised['text'] = 'text'
+        return anonymised
+
+    def _anonymise_callback_query(self, query):
+        anonymised = {'id': query['id'],
+                      'from': self._anonymise_user(query['from']),
+                      'chat_instance': query.get('chat_instance', ''),
+                      'data': query.get('data')}
+        if query.get('message'):
+            anonymised['message'] = self._anonymise_message(query['message'])
+        return anonymised
+
+    def _anonymise_user(self, user):
+        user_id = self._anonymise_id(user['id'])
+        return {'id': user_id, 'is_bot': user.get('is_bot', False), 'first_name': 'player {}'.format(user_id)}
+
+    def _anonymise_id(self, value):
+        digest = hmac.new(self._salt, str(value).encode('utf-8'), hashlib.sha256).digest()
+        return _ANONYMOUS_ID_BASE + int.from_bytes(digest[:8], 'big') % _ANONYMOUS_ID_RANGE
+
+
+def create_recorder(path=BOT_RECORD_UPDATES, salt=BOT_RECORD_SALT):
+    """
+    :return: Recorder closed at exit or None if recording is off
+    """
+    if not path:
+        return None
+    recorder = Recorder(path, salt)
+    atexit.register(recorder.close)
+    logger.info('Recording updates to {}'.format(path))
+    return recorder
+
+
+def install(dispatcher, recorder):
+    """
+    Makes a telegram.ext.Dispatcher record every update handed to it, before updates are coalesced or shed
+    """
+    process_update = dispatcher.process_update
+
+    def record_and_process(update):
+        if hasattr(update, 'to_dict'):
+            recorder.record(update.to_dict())
+        return process_update(update)
+
+    dispatcher.process_update = record_and_process
+
+
+def read_updates(lines):
+    """
+    :return: generator of (recorded_time or None, update JSON) of non-empty lines
+    """
+    for line in lines:
+        if line.strip():
+            data = json.loads(line)
+            yield data.pop(RECORDED_TIME_KEY, None), data
@@ -0,0 +1,245 @@
+# coding=utf-8
+# replays updates recorded with BOT_RECORD_UPDATES through the real dispatcher and handlers against a database of its own,
+# Telegram is faked. E.g. the start of a quiz ten times faster than it happened, with the questions exported when it was recorded:
+#   python replay.py updates.jsonl --questions questions.json --speed 10
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+import admission
+import bench
+import dispatch
+import khsm_bot
+import loggers
+import metrics
+import migrations
+import outbox
+import question_pack
+import recording
+import service
+
+logger = loggers.logging.getLogger(__name__)
+
+REPLAY_DB_NAME = os.environ.get('REPLAY_DB_NAME') or 'khsm_replay'
+_REPLAY_TOKEN = '000:replay'
+_SHED_REASONS = (admission.SHED_USER_RATE, admission.SHED_CONCURRENCY, dispatch.SHED_COALESCED, dispatch.SHED_STALE)
+
+
+def _fake_result(method, params, message_id):
+    if method == 'getMe':
+        return {'id': 1, 'is_bot': True, 'first_name': 'replay', 'username': 'replay_bot'}
+    if method == 'getMyCommands':
+        return []
+    if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+        return {'message_id': int(params.get('message_id') or message_id), 'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'}, 'text': params.get('text') or ''}
+    return True
+
+
+class _FakeRequest(service._TimedRequest):
+    """
+    Answers Bot API calls of the threaded runtime locally after api_latency seconds
+    """
+
+    def __init__(self, api_latency, **kwargs):
+        super().__init__(**kwargs)
+        self._api_latency = api_latency
+        self._message_ids = itertools.count(1)
+
+    def _request_wrapper(self, method, url, body=None, **kwargs):
+        if self._api_latency:
+            time.sleep(self._api_latency)
+        params = json.loads(body.decode('utf-8')) if body else {}
+        return json.dumps({'ok': True, 'result': _fake_result(url.rsplit('/', 1)[-1], params, next(self._message_ids))}).encode('utf-8')
+
+
+def reset(questions):
+    """
+    Empties the game tables and loads the question pack, so every replay of a recording starts from the same state
+    :param questions: validated questions the recorded callback data refers to
+    """
+    with service.get_engine().begin() as connection:
+        connection.execute(text('TRUNCATE player, player_lease, answer, hint, player_score, variant_stat, variant, question CASCADE'))
+    service.import_questions(questions)
+    service.reload_catalog()
+
+
+def _route(update):
+    """
+    :return: name of what the update asks for, handlers are told apart by it
+    """
+    if update.callback_query:
+        data = dispatch.parse_callback_data(update.callback_query.data)
+        return data[0] if data else 'callback'
+    text = update.effective_message.text if update.effective_message else None
+    if text and text.startswith('/') and len(text) > 1:
+        return text[1:].split(maxsplit=1)[0].split('@')[0].lower()
+    return 'message'
+
+
+def _pace(started, first_time, recorded_time, speed):
+    """
+    :return: seconds to wait until the update is due, 0 speed replays as fast as possible
+    """
+    if not speed or recorded_time is None or first_time is None:
+        return 0
+    return started + (recorded_time - first_time) / speed - time.time()
+
+
+def replay_threaded(updates, speed, workers, api_latency):
+    """
+    :return: {route: [seconds from receiving an update until it was handled or dropped]}
+    """
+    bot = Bot(_REPLAY_TOKEN, request=_FakeRequest(api_latency, con_pool_size=workers + 4))
+    updater = Updater(bot=bot, workers=workers)
+    sender = outbox.Outbox(Bot(_REPLAY_TOKEN, request=_FakeRequest(api_latency, con_pool_size=outbox.OUTBOX_WORKERS)))
+    sender.start()
+    khsm_bot.register_handlers(updater.dispatcher, workers, sender)
+    latencies = {}
+    futures = []
+    started = time.time()
+    first_time = None
+    for recorded_time, data in updates:
+        first_time = recorded_time if first_time is None else first_time
+        delay = _pace(started, first_time, recorded_time, speed)
+        if delay > 0:
+            time.sleep(delay)
+        update = Update.de_json(data, bot)
+        route_latencies = latencies.setdefault(_route(update), [])
+        received = time.perf_counter()
+        future = updater.dispatcher.process_update(update)
+        future.add_done_callback(lambda _, received=received, route_latencies=route_latencies:
+                                 route_latencies.append(time.perf_counter() - received))
+        futures.append(future)
+    for future in futures:
+        future.result()
+    sender.stop(timeout=None)
+    return latencies
+
+
+def replay_asyncio(updates, speed, api_latency):
+    # asyncio runtime brings its own dependencies, threaded one does not need them
+    import aservice
+    import async_bot
+
+    class FakeAsyncBot(async_bot.AsyncBot):
+        def __init__(self):
+            super().__init__(_REPLAY_TOKEN)
+            self._message_ids = itertools.count(1)
+
+        async def start(self):
+            pass
+
+        async def close(self):
+            pass
+
+        async def call(self, method, **params):
+            with metrics.TELEGRAM_SECONDS.time(method=method):
+                if api_latency:
+                    await asyncio.sleep(api_latency)
+            return _fake_result(method, params, next(self._message_ids))
+
+    async def run():
+        bot = FakeAsyncBot()
+        latencies = {}
+        tasks = []
+        started = time.time()
+        first_time = None
+        for recorded_time, data in updates:
+            first_time = recorded_time if first_time is None else first_time
+            delay = _pace(started, first_time, recorded_time, speed)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            route_latencies = latencies.setdefault(_route(Update.de_json(copy.deepcopy(data), None)), [])
+            received = time.perf_counter()
+            task = asyncio.ensure_future(async_bot.process_update(bot, data))
+            task.add_done_callback(lambda _, received=received, route_latencies=route_latencies:
+                                   route_latencies.append(time.perf_counter() - received))
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        return latencies
+
+    aservice.init()
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def build_report(latencies, elapsed):
+    count = sum(len(route_latencies) for route_latencies in latencies.values())
+    queries_count, queries_sum = metrics.UPDATE_QUERIES.totals().get((), (0, 0))
+    report = OrderedDict([('updates', count),
+                          ('seconds', round(elapsed, 3)),
+                          ('updates_per_second', round(count / elapsed, 1) if elapsed else None),
+                          ('queries_per_update', round(queries_sum / float(queries_count), 2) if queries_count else 0),
+                          ('sql_statements', metrics.SQL_STATEMENTS.get()),
+                          ('telegram_calls', sum(calls for calls, _ in metrics.TELEGRAM_SECONDS.totals().values())),
+                          ('shed', OrderedDict((reason, metrics.SHED_UPDATES.get(reason=reason)) for reason in _SHED_REASONS))])
+    outbox_totals = metrics.OUTBOX_SECONDS.totals().values()
+    outbox_count = sum(count for count, _ in outbox_totals)
+    outbox_sum = sum(total for _, total in outbox_totals)
+    report['outbox'] = OrderedDict([('sent', outbox_count),
+                                    ('mean_wait_ms', round(outbox_sum / outbox_count * 1000, 3) if outbox_count else 0),
+                                    ('coalesced', metrics.OUTBOX_COALESCED.get())])
+    report['routes'] = OrderedDict()
+    for route, route_latencies in sorted(latencies.items()):
+        route_latencies = sorted(route_latencies)
+        report['routes'][route] = OrderedDict([('updates', len(route_latencies)),
+                                               ('p50_ms', round(bench.percentile(route_latencies, 0.5) * 1000, 3)),
+                                               ('p99_ms', round(bench.percentile(route_latencies, 0.99) * 1000, 3))])
+    report['handlers'] = OrderedDict(
+        (handler, OrderedDict([('calls', calls), ('mean_ms', round(total / calls * 1000, 3))]))
+        for (handler,), (calls, total) in sorted(metrics.HANDLER_SECONDS.totals().items()) if calls)
+    return report
+
+
+def _print_report(report):
+    print('{updates} updates in {seconds}s, {updates_per_second} updates/s, {queries_per_update} queries per update, '
+          '{telegram_calls} Telegram calls'.format(**report))
+    print('shed: {}'.format(', '.join('{} {}'.format(reason, shed) for reason, shed in report['shed'].items())))
+    print('outbox: {sent} sent, {mean_wait_ms} ms mean wait, {coalesced} edits coalesced'.format(**report['outbox']))
+    print('{:<12} {:>8} {:>10} {:>10}'.format('route', 'updates', 'p50 ms', 'p99 ms'))
+    for route, result in report['routes'].items():
+        print('{:<12} {:>8} {:>10} {:>10}'.format(route, result['updates'], result['p50_ms'], result['p99_ms']))
+    print('{:<24} {:>8} {:>10}'.format('handler', 'calls', 'mean ms'))
+    for handler, result in report['handlers'].items():
+        print('{:<24} {:>8} {:>10}'.format(handler, result['calls'], result['mean_ms']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays recorded updates against the {} database'.format(REPLAY_DB_NAME))
+    parser.add_argument('updates', help='JSONL file recorded with BOT_RECORD_UPDATES')
+    parser.add_argument('--questions', required=True,
+                        help='question pack in JSON or CSV exported from the console when the updates were recorded')
+    parser.add_argument('--speed', type=float, default=1, help='times faster than recorded, 0 for as fast as possible')
+    parser.add_argument('--runtime', choices=['threaded', khsm_bot.BOT_RUNTIME_ASYNCIO], default='threaded')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BOT_WORKERS') or 4))
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds each faked Telegram call takes')
+    parser.add_argument('--output', help='file to write the report to as JSON')
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8-sig') as questions_file:
+        pack = question_pack.parse(questions_file.read(), args.questions.rsplit('.', 1)[-1].lower())
+    migrations.ensure_database(REPLAY_DB_NAME)
+    os.environ['DB_NAME'] = REPLAY_DB_NAME
+    service.init()
+    reset(pack)
+    with open(args.updates, encoding='utf-8') as updates_file:
+        recorded_updates = list(recording.read_updates(updates_file))
+    replay_started = time.time()
+    if args.runtime == khsm_bot.BOT_RUNTIME_ASYNCIO:
+        replay_latencies = replay_asyncio(recorded_updates, args.speed, args.api_latency)
+    else:
+        replay_latencies = replay_threaded(recorded_updates, args.speed, args.workers, args.api_latency)
+    replay_report = build_report(replay_latencies, time.time() - replay_started)
+    _print_report(replay_report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(replay_report, output, indent=2)
@@ -0,0 +1,4 @@
+#!/bin/bash
+# lets db-replica of docker-compose.replica.yml clone and follow the database, runs on the first start of db only
+auth_method=$(awk '$1 == "host" && $2 == "all" && $3 == "all" && $4 == "all" {print $5}' "$PGDATA/pg_hba.conf" | tail -1)
+echo "host replication all all ${auth_method:-md5}" >> "$PGDATA/pg_hba.conf"
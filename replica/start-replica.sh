@@ -0,0 +1,14 @@
+#!/bin/bash
+# hot standby of db, cloned from it on the first start and following it by streaming replication
+set -e
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    mkdir -p "$PGDATA"
+    chown postgres "$PGDATA"
+    chmod 700 "$PGDATA"
+    until gosu postgres pg_basebackup -h db -U "$DB_USER" -D "$PGDATA" -R -X stream; do
+        echo 'Waiting for db to accept replication'
+        rm -rf "${PGDATA:?}"/*
+        sleep 2
+    done
+fi
+exec gosu postgres postgres -c hot_standby=on -c hot_standby_feedback=on
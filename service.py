@@ -1,18 +1,103 @@
 # coding=utf-8
+import atexit
+import builtins
+import datetime
+import functools
 import os
+import random
+import select as select_
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from telegram import Bot
 from telegram.ext import Updater
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, DateTime, ForeignKeyConstraint, and_, or_
+from telegram.utils.request import Request
+from sqlalchemy import Column, ForeignKey, Integer, BigInteger, String, Boolean, DateTime, ForeignKeyConstraint, Index, and_, or_, select, func, \
+    tuple_, distinct, bindparam, literal, event
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import DBAPIError, OperationalError
 from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql.functions import count, max, dense_rank, sum as sum_, coalesce
 
 import loggers
+import metrics
+import question_pack
 
 logger = loggers.logging.getLogger(__name__)
+sql_logger = loggers.logging.getLogger('khsm.sql')
+
+# share of SQL statements logged with their parameters, 0 turns the logging off
+SQL_LOG_SAMPLE_RATE = float(os.environ.get('SQL_LOG_SAMPLE_RATE') or 0)
 
 _Base = declarative_base()
 _Session = sessionmaker(expire_on_commit=False)
+_ROLLBACK_CALLBACKS = 'rollback_callbacks'
+
+# optional streaming replica for read only functions, see with_session(read_only=True)
+DB_REPLICA_HOST = os.environ.get('DB_REPLICA_HOST')
+# reads of a player this soon after a write of the player go to the primary, should be above the usual replica lag
+REPLICA_LAG_SECONDS = float(os.environ.get('REPLICA_LAG_SECONDS') or 5)
+_REPLICA_RETRY_SECONDS = 30
+_REPLICA_CONNECT_TIMEOUT_SECONDS = 3
+_ReplicaSession = sessionmaker(expire_on_commit=False)
+_replica_failed_time = 0
+_recent_writes_lock = threading.Lock()
+# player_id -> time of the last write of the player, oldest first
+_recent_writes = OrderedDict()
+
+# with the refresher started, caches past their TTL are served as they are and reloaded by it instead of the caller
+_cache_refresher_started = False
+_CACHE_REFRESH_POLL_SECONDS = 1
+
+# instance of lease.Coordinator, writes of a player are done only while it holds the player lease; None without leases
+_lease_instance_id = None
+
+PROPERTY_CHANNEL = 'property_changed'
+_PROPERTY_CACHE_TTL = float(os.environ.get('PROPERTY_CACHE_TTL') or 60)
+_LISTEN_POLL_SECONDS = 5
+# (loaded_time, {property_key: property_value}), replaced as a whole on reload
+_property_cache = (0, {})
+
+CATALOG_CHANNEL = 'catalog_changed'
+_CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL') or 60)
+CatalogVariant = namedtuple('CatalogVariant', ['variant_id', 'text_value', 'correct'])
+CatalogQuestion = namedtuple('CatalogQuestion', ['question_id', 'text_value', 'variants', 'correct_variant_ids'])
+# questions are indexed by question_id, gaps are None
+Catalog = namedtuple('Catalog', ['version', 'questions', 'max_question_id', 'question_count'])
+_catalog = Catalog(None, (), None, 0)
+_catalog_loaded_time = 0
+
+SEASON_CHANNEL = 'season_changed'
+_SEASON_CACHE_TTL = float(os.environ.get('SEASON_CACHE_TTL') or 60)
+# rows of a season are kept in partitions of these tables named <table>_s<season_id>
+_SEASON_PARTITIONED_TABLES = ('answer', 'hint', 'player_score')
+_SEASON_LOCK_KEY = 7301
+# (loaded_time, season_id) of the season being played, the latest started one
+_active_season = (0, None)
+
+PLAYER_CHANNEL = 'player_changed'
+_PLAYER_CACHE_SIZE = int(os.environ.get('PLAYER_CACHE_SIZE') or 10000)
+_PLAYER_CACHE_TTL = float(os.environ.get('PLAYER_CACHE_TTL') or 300)
+# progress of a player as the game checks see it, cached per player and changed in place by the writes
+PlayerProgress = namedtuple('PlayerProgress', ['season_id', 'max_passed_question_id', 'overdraft', 'last_answer_question_id',
+                                               'last_answer_passed', 'used_hint_keys'])
+_player_cache_lock = threading.Lock()
+# player_id -> (loaded_time, PlayerProgress), least recently used first
+_player_cache = OrderedDict()
+# functions called with ids of players whose game was reset, None for all players, see add_players_changed_listener
+_players_changed_listeners = []
+
+VARIANT_STAT_FLUSH_SECONDS = float(os.environ.get('VARIANT_STAT_FLUSH_SECONDS') or 2)
+_variant_stat_lock = threading.Lock()
+# (season_id, question_id, variant_id) -> answers recorded by this process and not yet added to variant_stat
+_variant_stat_deltas = {}
 
 BOT_TOP_LIMIT = 'bot_top_limit'
 BOT_ANSWER_TRY_LIMIT = 'bot_answer_try_limit'
@@ -25,57 +110,224 @@ PUBLIC_HELP_HINT_KEY = 'public_help'
 AVAILABLE_HINTS = [{'hint_key': FIFTY_HINT_KEY, 'title_key': FIFTY_HINT_TITLE_TEXT},
                    {'hint_key': PUBLIC_HELP_HINT_KEY, 'title_key': PUBLIC_HELP_HINT_TITLE_TEXT}]
 
+GAME_OVERDRAFTED = 'overdrafted'
+GAME_STALE = 'stale'
+GAME_RETRY = 'retry'
+GAME_LOSE = 'lose'
+GAME_WIN = 'win'
+GAME_NEXT = 'next'
+HINT_UNAVAILABLE = 'hint_unavailable'
+HINT_USED = 'hint_used'
+# results after which the question can not be answered again, repeated taps on its keyboard are stale
+QUESTION_CLOSED_STATUSES = (GAME_NEXT, GAME_WIN, GAME_LOSE, GAME_OVERDRAFTED)
+
+GameStep = namedtuple('GameStep', ['status', 'question', 'hints', 'max_passed_question_id', 'question_count', 'player_place'])
+GameStep.__new__.__defaults__ = (None, None, None, None, None)
+HintStep = namedtuple('HintStep', ['status', 'question', 'hints', 'answer_stats'])
+HintStep.__new__.__defaults__ = (None, None, None)
+
+BROADCAST_PENDING = 'pending'
+BROADCAST_SENT = 'sent'
+BROADCAST_FAILED = 'failed'
+
+
+class _TimedRequest(Request):
+    """
+    Request recording Telegram Bot API latency per method
+    """
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        try:
+            with metrics.TELEGRAM_SECONDS.time(method=method):
+                return super().post(url, data, timeout=timeout)
+        except Exception:
+            metrics.TELEGRAM_ERRORS.inc(method=method)
+            raise
+
 
 def create_updater(token, workers, request_kwargs):
-    return Updater(token, request_kwargs=request_kwargs, workers=int(workers))
+    # the same connection pool size Updater gives its own Request
+    request = _TimedRequest(**dict({'con_pool_size': int(workers) + 4}, **request_kwargs))
+    return Updater(bot=Bot(token, request=request), workers=int(workers))
+
+
+def create_bot(token, con_pool_size, request_kwargs):
+    return Bot(token, request=_TimedRequest(con_pool_size=int(con_pool_size), **request_kwargs))
 
 
-def with_session():
+def with_session(read_only=False, player_id=None):
+    """
+    :param read_only: the function only reads and can be served by the replica, the primary serves it when the replica fails
+    :param player_id: function of the arguments giving the player whose own recent writes the read has to see
+    """
+
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            sess = _Session(autocommit=True, autoflush=True)
-            try:
-                sess.begin()
-                result = func(sess, *args, **kwargs)
-                sess.commit()
-                return result
-            except Exception as e:
-                if sess is not None:
-                    sess.rollback()
-                logger.error('Error', exc_info=True)
-                raise e
-
+            with metrics.SERVICE_SECONDS.time(function=func.__name__):
+                try:
+                    if read_only and _is_replica_readable(player_id(*args, **kwargs) if player_id else None):
+                        try:
+                            return _run_in_session(_ReplicaSession, func, args, kwargs)
+                        except DBAPIError as ex:
+                            if not is_replica_failure(ex):
+                                raise
+                            _on_replica_failure()
+                    return _run_in_session(_Session, func, args, kwargs)
+                except Exception as e:
+                    logger.error('Error', exc_info=True)
+                    raise e
+
+        wrapper.read_only = read_only
+        wrapper.player_id = player_id
         return wrapper
 
     return decorator
 
 
+def _run_in_session(session_factory, func, args, kwargs):
+    sess = session_factory(autocommit=True, autoflush=True)
+    try:
+        sess.begin()
+        result = func(sess, *args, **kwargs)
+        sess.commit()
+        return result
+    except Exception:
+        _run_rollback_callbacks(sess)
+        sess.rollback()
+        raise
+
+
+def has_replica():
+    return _ReplicaSession.kw.get('bind') is not None
+
+
+def _is_replica_readable(player_id=None):
+    if not has_replica() or time.time() - _replica_failed_time < _REPLICA_RETRY_SECONDS:
+        return False
+    if player_id is None:
+        return True
+    with _recent_writes_lock:
+        written_time = _recent_writes.get(player_id)
+    return written_time is None or time.time() - written_time > REPLICA_LAG_SECONDS
+
+
+def is_replica_failure(ex):
+    return isinstance(ex, OperationalError) or ex.connection_invalidated
+
+
+def _on_replica_failure():
+    global _replica_failed_time
+    _replica_failed_time = time.time()
+    logger.warning('Replica failed, reads go to the primary for {}s'.format(_REPLICA_RETRY_SECONDS), exc_info=True)
+
+
+def _remember_player_write(player_id):
+    if not has_replica():
+        return
+    now = time.time()
+    with _recent_writes_lock:
+        _recent_writes.pop(player_id, None)
+        _recent_writes[player_id] = now
+        while now - next(iter(_recent_writes.values())) > REPLICA_LAG_SECONDS:
+            _recent_writes.popitem(last=False)
+
+
+def _on_rollback(session, callback):
+    session.info.setdefault(_ROLLBACK_CALLBACKS, []).append(callback)
+
+
+def _run_rollback_callbacks(session):
+    # called before rollback releases the row locks the callbacks were registered under
+    for callback in session.info.pop(_ROLLBACK_CALLBACKS, ()):
+        callback()
+
+
 def _id_from(user):
     return str(user.id)
 
 
-@with_session()
-def get_property(session, property_key, default_value):
-    return _get_property(session, property_key, default_value)
+def get_property(property_key, default_value):
+    return _lookup_property(_get_cached_properties(), property_key, default_value)
 
 
 def _get_property(session, property_key, default_value):
-    prop = session.query(Property).filter(Property.property_key == property_key).first()
-    return prop.property_value if prop else default_value
+    return _lookup_property(_get_cached_properties(session), property_key, default_value)
+
+
+def _lookup_property(properties, property_key, default_value):
+    return properties[property_key] if property_key in properties else default_value
+
+
+def _is_expired(loaded_time, ttl):
+    return not _cache_refresher_started and time.time() - loaded_time > ttl
+
+
+def start_cache_refresher():
+    """
+    Reloads properties, the catalog and the active season in a thread of its own once their TTL runs out, callers get
+    the loaded ones meanwhile. For the asyncio runtime, a reload by a caller would wait for the database on the event loop
+    """
+    global _cache_refresher_started
+    if _cache_refresher_started:
+        return
+    _cache_refresher_started = True
+    threading.Thread(target=_refresh_caches_forever, name='cache-refresh', daemon=True).start()
+
+
+def _refresh_caches_forever():
+    while True:
+        time.sleep(_CACHE_REFRESH_POLL_SECONDS)
+        try:
+            now = time.time()
+            if now - _property_cache[0] > _PROPERTY_CACHE_TTL:
+                reload_properties()
+            if now - _catalog_loaded_time > _CATALOG_CACHE_TTL:
+                reload_catalog()
+            if now - _active_season[0] > _SEASON_CACHE_TTL:
+                reload_active_season()
+        except Exception:
+            logger.warning('Refreshing caches failed', exc_info=True)
+
+
+def _get_cached_properties(session=None):
+    loaded_time, properties = _property_cache
+    if _is_expired(loaded_time, _PROPERTY_CACHE_TTL):
+        properties = _load_properties(session) if session else reload_properties()
+    return properties
+
+
+@with_session()
+def reload_properties(session):
+    return _load_properties(session)
+
+
+def _load_properties(session):
+    global _property_cache
+    properties = {prop.property_key: prop.property_value for prop in session.query(Property)}
+    _property_cache = (time.time(), properties)
+    return properties
 
 
 @with_session()
 def add_player(session, user, chat_id, registration_time):
+    _check_lease(session, _id_from(user))
     return _add_player(session, user, user.name, chat_id, registration_time)
 
 
 def _add_player(session, user, name, chat_id, registration_time):
     player_id = _id_from(user)
-    existing_player = _get_player_query(session, player_id).first()
-    if existing_player:
-        return existing_player
-    player = Player(player_id, name, chat_id, registration_time)
-    session.add(player)
+    player = _get_player_query(session, player_id).first()
+    if not player:
+        player = Player(player_id, name, chat_id, registration_time)
+        session.add(player)
+        session.flush()
+    # players of earlier seasons get into the rating of the active one when they come back
+    if session.execute(pg_insert(PlayerScore.__table__)
+                       .values(season_id=_get_active_season_id(), player_id=player_id, points=0, tries=0, hint_count=0)
+                       .on_conflict_do_nothing()).rowcount:
+        _remember_player_write(player_id)
     return player
 
 
@@ -85,36 +337,118 @@ def _get_player_query(session, player_id):
 
 @with_session()
 def is_overdrafted(session, user):
-    player_id = _id_from(user)
+    return _is_overdrafted(session, _id_from(user))
+
+
+def _is_overdrafted(session, player_id):
     try_limit = int(_get_property(session, BOT_ANSWER_TRY_LIMIT, 2))
-    overdraft = _get_tries_overdraft(session, player_id)
-    return overdraft >= (try_limit if _is_last_answer_passed(session, player_id) else try_limit - 1)
+    progress = _get_player_progress(session, player_id)
+    return progress.overdraft >= (try_limit if progress.last_answer_passed else try_limit - 1)
+
+
+def _get_player_progress(session, player_id):
+    season_id = _get_active_season_id()
+    with _player_cache_lock:
+        cached = _player_cache.get(player_id)
+        if cached and cached[1].season_id == season_id and time.time() - cached[0] <= _PLAYER_CACHE_TTL:
+            _player_cache.move_to_end(player_id)
+            return cached[1]
+    return _load_player_progress(session, player_id, season_id)
+
+
+def _load_player_progress(session, player_id, season_id):
+    max_passed_question_id, tries, answers, last_answer_question_id = session.query(
+        max(Answer.question_id).filter(Answer.passed == True), coalesce(sum_(Answer.tries), 0), count(Answer.answer_time),
+        max(Answer.question_id)).filter(and_(Answer.season_id == season_id, Answer.player_id == player_id)).one()
+    last_answer_passed = session.query(Answer.passed).filter(
+        and_(Answer.season_id == season_id, Answer.player_id == player_id, Answer.question_id == last_answer_question_id)).scalar()
+    used_hint_keys = frozenset(hint_key for hint_key, in session.query(Hint.hint_key).filter(
+        and_(Hint.season_id == season_id, Hint.player_id == player_id)))
+    progress = PlayerProgress(season_id, max_passed_question_id or 0, tries - answers, last_answer_question_id or 0,
+                              bool(last_answer_passed), used_hint_keys)
+    _cache_player_progress(player_id, progress)
+    return progress
+
+
+def _cache_player_progress(player_id, progress):
+    with _player_cache_lock:
+        _player_cache[player_id] = (time.time(), progress)
+        _player_cache.move_to_end(player_id)
+        while len(_player_cache) > _PLAYER_CACHE_SIZE:
+            _player_cache.popitem(last=False)
+
+
+def _update_player_progress(session, player_id, progress):
+    """
+    Writes through the progress changed by the current transaction, it is dropped if the transaction fails
+    """
+    _cache_player_progress(player_id, progress)
+    _on_rollback(session, lambda: invalidate_player_progress([player_id]))
 
 
-def _is_last_answer_passed(session, player_id):
-    return session.query(Answer.passed).filter(Answer.player_id == player_id).order_by(Answer.question_id.desc()).limit(1).scalar()
+def invalidate_player_progress(player_ids=None):
+    """
+    :param player_ids: None to forget all players
+    """
+    with _player_cache_lock:
+        if player_ids is None:
+            _player_cache.clear()
+            return
+        for player_id in player_ids:
+            _player_cache.pop(player_id, None)
 
 
-@with_session()
-def get_max_question_id(session):
-    return session.query(max(Question.question_id)).scalar()
+def add_players_changed_listener(listener):
+    """
+    :param listener: called with ids of players whose data was cleared by any process, None for all players e.g. on a new season
+    """
+    _players_changed_listeners.append(listener)
+
+
+def _on_players_changed(player_ids):
+    invalidate_player_progress(player_ids)
+    for listener in _players_changed_listeners:
+        listener(player_ids)
+
+
+def get_catalog():
+    """
+    :return: Catalog loaded last, every reload gives a new one even if catalog_version did not change
+    """
+    return _get_catalog()
+
+
+def get_max_question_id():
+    return _get_catalog().max_question_id
 
 
 @with_session()
 def get_max_passed_question_id(session, user):
-    max_passed_question_for_user = session.query(max(Question.question_id)).join(Variant).join(Answer).filter(
-        and_(Answer.player_id == _id_from(user), Answer.passed == True)).scalar()
-    return max_passed_question_for_user if max_passed_question_for_user else 0
+    return _get_max_passed_question_id(session, _id_from(user))
 
 
-@with_session()
-def get_question(session, question_id):
-    return session.query(Question).filter(Question.question_id == question_id).one()
+def _get_max_passed_question_id(session, player_id):
+    return _get_player_progress(session, player_id).max_passed_question_id
+
+
+def get_question(question_id):
+    return _get_question(_get_catalog(), question_id)
+
+
+def _get_question(catalog, question_id):
+    question = catalog.questions[question_id] if 0 < question_id < len(catalog.questions) else None
+    if question is None:
+        raise NoResultFound('No question with id={}'.format(question_id))
+    return question
 
 
 @with_session()
 def get_available_hints(session, user):
-    used_hint_keys = [hint_key for hint_key, in session.query(Hint.hint_key).filter(Hint.player_id == _id_from(user)).all()]
+    return _get_available_hints(session, _id_from(user))
+
+
+def _get_available_hints(session, player_id):
+    used_hint_keys = _get_player_progress(session, player_id).used_hint_keys
     return [{'hint_key': hint['hint_key'], 'hint_title': _get_property(session, hint['title_key'], 'unknown')}
             for hint in AVAILABLE_HINTS if hint['hint_key'] not in used_hint_keys]
 
@@ -124,84 +458,370 @@ def add_answer(session, user, question_id, variant_id, answer_time):
     """
     :return: if question passed or if more tries available
     """
-    player_id = _id_from(user)
-    answer = session.query(Answer).join(Variant).filter(and_(Answer.player_id == player_id, Variant.question_id == question_id)).first()
+    return _add_answer(session, _id_from(user), question_id, variant_id, answer_time)
+
+
+def _add_answer(session, player_id, question_id, variant_id, answer_time):
+    progress = _get_player_progress(session, player_id)
+    season_id = progress.season_id
+    answer = session.query(Answer).filter(
+        and_(Answer.season_id == season_id, Answer.player_id == player_id, Answer.question_id == question_id)).first()
     try_limit = int(_get_property(session, BOT_ANSWER_TRY_LIMIT, 2))
     if answer:
         answer.answer_time = answer_time
     else:
-        answer = Answer(player_id, question_id, variant_id, answer_time)
+        answer = Answer(season_id, player_id, question_id, variant_id, answer_time)
         session.add(answer)
+        _count_variant_answer(session, season_id, question_id, variant_id)
 
+    was_passed, previous_tries = bool(answer.passed), answer.tries
     answer.tries += 1
-    overdraft = _get_tries_overdraft(session, player_id)
-    answer.passed = _is_variant_correct(session, question_id, variant_id) and overdraft < try_limit
+    # the first try of a question does not count as overdraft
+    overdraft = progress.overdraft + (1 if previous_tries else 0)
+    answer.passed = _is_variant_correct(question_id, variant_id) and overdraft < try_limit
+    max_passed_question_id = progress.max_passed_question_id
+    if answer.passed:
+        max_passed_question_id = builtins.max(max_passed_question_id, question_id)
+    elif was_passed:
+        max_passed_question_id = session.query(max(Answer.question_id)).filter(
+            and_(Answer.season_id == season_id, Answer.player_id == player_id, Answer.passed == True)).scalar() or 0
+    last_answer = question_id >= progress.last_answer_question_id
+    _update_player_progress(session, player_id, progress._replace(
+        max_passed_question_id=max_passed_question_id,
+        overdraft=overdraft,
+        last_answer_question_id=question_id if last_answer else progress.last_answer_question_id,
+        last_answer_passed=answer.passed if last_answer else progress.last_answer_passed))
+    if answer.passed or was_passed:
+        _update_player_score(session, season_id, player_id,
+                             points=int(answer.passed) - int(was_passed),
+                             tries=(answer.tries if answer.passed else 0) - (previous_tries if was_passed else 0),
+                             last_answer_time=answer_time if answer.passed else None)
     # exists one more try
     return answer.passed or overdraft < try_limit - 1
 
 
-def _get_tries_overdraft(session, player_id):
-    tries, answers = session.query(coalesce(sum_(Answer.tries), 0), count(Answer.answer_time)).filter(Answer.player_id == player_id).first()
-    return tries - answers
-
-
-def _is_variant_correct(session, question_id, variant_id):
-    return session.query(Variant.correct).filter(Variant.question_id == question_id, Variant.variant_id == variant_id).scalar()
+def _is_variant_correct(question_id, variant_id):
+    question = get_question(question_id)
+    return variant_id in question.correct_variant_ids
 
 
 @with_session()
 def add_hint(session, user, hint_key, question_id):
-    player_id = _id_from(user)
-    hint = session.query(Hint).filter(and_(Hint.player_id == player_id, Hint.hint_key == hint_key)).first()
+    return _add_hint(session, _id_from(user), hint_key, question_id)
+
+
+def _add_hint(session, player_id, hint_key, question_id):
+    progress = _get_player_progress(session, player_id)
+    hint = session.query(Hint).filter(
+        and_(Hint.season_id == progress.season_id, Hint.player_id == player_id, Hint.hint_key == hint_key)).first()
     if hint:
         hint.tries += 1
         hint.question_id = question_id
     else:
-        hint = Hint(player_id, question_id, hint_key, 1)
+        hint = Hint(progress.season_id, player_id, question_id, hint_key, 1)
         session.add(hint)
+        _update_player_score(session, progress.season_id, player_id, hint_count=1)
+        _update_player_progress(session, player_id, progress._replace(used_hint_keys=progress.used_hint_keys | {hint_key}))
 
     hint_try_limit = int(_get_property(session, BOT_HINT_TRY_LIMIT, 1))
     return hint.tries <= hint_try_limit
 
 
-@with_session()
+@with_session(read_only=True)
 def get_answer_stats(session, question_id):
-    answers_distribution = session.query(Answer.variant_id, count('*').label('cnt')).select_from(Answer).join(Variant).join(Question).filter(
-        Question.question_id == question_id).group_by(Answer.variant_id).all()
+    return _get_answer_stats(session, question_id)
+
+
+def _get_answer_stats(session, question_id):
+    season_id = _get_active_season_id()
+    answer_counts = dict(session.query(VariantStat.variant_id, VariantStat.answer_count).filter(
+        and_(VariantStat.season_id == season_id, VariantStat.question_id == question_id)))
+    with _variant_stat_lock:
+        for (delta_season_id, delta_question_id, variant_id), delta in _variant_stat_deltas.items():
+            if delta_season_id == season_id and delta_question_id == question_id:
+                answer_counts[variant_id] = answer_counts.get(variant_id, 0) + delta
+    answers_distribution = [(variant_id, answer_count) for variant_id, answer_count in sorted(answer_counts.items()) if answer_count > 0]
     return answers_distribution, sum([row[1] for row in answers_distribution])
 
 
+def _count_variant_answer(session, season_id, question_id, variant_id, delta=1):
+    """
+    Buffers the change of a variant answer count until the next flush, it is taken back if the transaction fails
+    """
+    _add_variant_stat_deltas({(season_id, question_id, variant_id): delta})
+    _on_rollback(session, lambda: _add_variant_stat_deltas({(season_id, question_id, variant_id): -delta}))
+
+
+def _add_variant_stat_deltas(deltas):
+    with _variant_stat_lock:
+        for key, delta in deltas.items():
+            _variant_stat_deltas[key] = _variant_stat_deltas.get(key, 0) + delta
+
+
+def flush_variant_stats():
+    global _variant_stat_deltas
+    with _variant_stat_lock:
+        deltas, _variant_stat_deltas = _variant_stat_deltas, {}
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    try:
+        _save_variant_stat_deltas(deltas)
+    except Exception:
+        # kept for the next flush
+        _add_variant_stat_deltas(deltas)
+        raise
+
+
+@with_session()
+def _save_variant_stat_deltas(session, deltas):
+    _apply_variant_stat_deltas(session, deltas)
+
+
+def _apply_variant_stat_deltas(session, deltas):
+    table = VariantStat.__table__
+    statement = pg_insert(table).values(season_id=bindparam('stat_season_id'), question_id=bindparam('stat_question_id'),
+                                        variant_id=bindparam('stat_variant_id'), answer_count=bindparam('delta'))
+    # sorted to take row locks in the same order in every process
+    session.execute(statement.on_conflict_do_update(index_elements=[table.c.season_id, table.c.question_id, table.c.variant_id],
+                                                    set_={'answer_count': table.c.answer_count + statement.excluded.answer_count}),
+                    [{'stat_season_id': season_id, 'stat_question_id': question_id, 'stat_variant_id': variant_id, 'delta': delta}
+                     for (season_id, question_id, variant_id), delta in sorted(deltas.items())])
+
+
+def _flush_variant_stats_forever():
+    while True:
+        time.sleep(VARIANT_STAT_FLUSH_SECONDS)
+        try:
+            flush_variant_stats()
+        except Exception:
+            logger.warning('Variant stats flush failed', exc_info=True)
+
+
 @with_session()
+def rebuild_variant_stats(session):
+    """
+    Recounts variant_stat of the active season from answer. Answers of running bots not flushed yet are counted twice until
+    the next rebuild, so it is meant for repairs between rounds
+    """
+    season_id = _get_active_season_id()
+    session.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(VariantStat.__tablename__))
+    session.query(VariantStat).filter(VariantStat.season_id == season_id).delete(synchronize_session=False)
+    session.execute(VariantStat.__table__.insert().from_select(
+        ['season_id', 'question_id', 'variant_id', 'answer_count'],
+        select([Answer.season_id, Answer.question_id, Answer.variant_id, count('*')]).where(Answer.season_id == season_id)
+        .group_by(Answer.season_id, Answer.question_id, Answer.variant_id)))
+
+
+@with_session()
+def add_missing_variant_stats(session):
+    """
+    Fills variant_stat for answers recorded before it existed
+    """
+    season_id = _get_active_season_id()
+    if session.query(VariantStat.question_id).filter(VariantStat.season_id == season_id).first() is None \
+            and session.query(Answer.player_id).filter(Answer.season_id == season_id).first() is not None:
+        rebuild_variant_stats.__wrapped__(session)
+
+
+@with_session(read_only=True, player_id=_id_from)
 def get_user_place(session, user):
-    position_field, rating_query = _build_rating_query(session)
-    return rating_query.from_self(position_field).filter(Player.player_id == _id_from(user)).scalar()
+    return _get_user_place(session, _id_from(user))
+
+
+def _get_user_place(session, player_id):
+    score = session.query(PlayerScore).filter(
+        and_(PlayerScore.season_id == _get_active_season_id(), PlayerScore.player_id == player_id)).first()
+    if not score:
+        return None
+    return _count_ranked_ahead(session, score.points, score.tries, score.hint_count, score.last_answer_time) + 1
+
+
+def _count_ranked_ahead(session, points, tries, hint_count, last_answer_time):
+    # dense rank is the number of distinct rating keys ahead plus one
+    return session.query(count(distinct(tuple_(PlayerScore.points, PlayerScore.tries, PlayerScore.hint_count, PlayerScore.last_answer_time)))) \
+        .filter(and_(PlayerScore.season_id == _get_active_season_id(), _ranked_ahead(points, tries, hint_count, last_answer_time))) \
+        .scalar()
+
+
+def _ranked_ahead(points, tries, hint_count, last_answer_time):
+    # row comparison against NULL is NULL, players without answer time go last
+    earlier_time = PlayerScore.last_answer_time != None if last_answer_time is None \
+        else PlayerScore.last_answer_time < last_answer_time
+    return and_(PlayerScore.points >= points,
+                or_(PlayerScore.points > points,
+                    tuple_(PlayerScore.tries, PlayerScore.hint_count) < tuple_(tries, hint_count),
+                    and_(PlayerScore.tries == tries, PlayerScore.hint_count == hint_count, earlier_time)))
+
+
+def _ranked_after(points, tries, hint_count, last_answer_time, player_id):
+    if last_answer_time is None:
+        later_time = and_(PlayerScore.last_answer_time == None, PlayerScore.player_id > player_id)
+    else:
+        later_time = or_(PlayerScore.last_answer_time == None,
+                         PlayerScore.last_answer_time > last_answer_time,
+                         and_(PlayerScore.last_answer_time == last_answer_time, PlayerScore.player_id > player_id))
+    # the bound on points lets player_score_rating_idx start the scan at the cursor
+    return and_(PlayerScore.points <= points,
+                or_(PlayerScore.points < points,
+                    tuple_(PlayerScore.tries, PlayerScore.hint_count) > tuple_(tries, hint_count),
+                    and_(PlayerScore.tries == tries, PlayerScore.hint_count == hint_count, later_time)))
+
+
+@with_session()
+def enter_game(session, user, chat_id, registration_time):
+    """
+    Registers player if needed and resolves what to show him
+    :return: GameStep
+    """
+    player_id = _id_from(user)
+    _check_lease(session, player_id)
+    _add_player(session, user, user.name, chat_id, registration_time)
+    session.flush()
+    _lock_player(session, player_id)
+    if _is_overdrafted(session, player_id):
+        return _lose_step(session, player_id)
+    return _next_step(session, player_id, _get_max_passed_question_id(session, player_id))
+
+
+@with_session()
+def submit_answer(session, user, question_id, variant_id, answer_time):
+    """
+    Checks, records and resolves an answer in a single transaction holding the player row lock
+    :return: GameStep
+    """
+    player_id = _id_from(user)
+    _check_lease(session, player_id)
+    if not _lock_player(session, player_id):
+        return GameStep(GAME_STALE)
+    if _is_overdrafted(session, player_id):
+        return GameStep(GAME_OVERDRAFTED)
+    if _get_max_passed_question_id(session, player_id) >= question_id:
+        return GameStep(GAME_STALE)
+
+    if not _add_answer(session, player_id, question_id, variant_id, answer_time):
+        return _lose_step(session, player_id)
+
+    max_passed_question_id = _get_max_passed_question_id(session, player_id)
+    if max_passed_question_id < question_id:
+        return GameStep(GAME_RETRY)
+    return _next_step(session, player_id, max_passed_question_id)
+
+
+@with_session()
+def use_hint(session, user, hint_key, question_id):
+    """
+    Checks and records a hint in a single transaction holding the player row lock
+    :return: HintStep
+    """
+    player_id = _id_from(user)
+    _check_lease(session, player_id)
+    if not _lock_player(session, player_id):
+        return HintStep(GAME_STALE)
+    if _is_overdrafted(session, player_id):
+        return HintStep(GAME_OVERDRAFTED)
+    if _get_max_passed_question_id(session, player_id) >= question_id:
+        return HintStep(GAME_STALE)
+
+    if not _add_hint(session, player_id, hint_key, question_id):
+        return HintStep(HINT_UNAVAILABLE)
+
+    answer_stats = _get_answer_stats(session, question_id) if hint_key == PUBLIC_HELP_HINT_KEY else None
+    return HintStep(HINT_USED,
+                    question=get_question(question_id),
+                    hints=_get_available_hints(session, player_id),
+                    answer_stats=answer_stats)
+
+
+def _lock_player(session, player_id):
+    return _get_player_query(session, player_id).with_for_update().first()
+
+
+def _next_step(session, player_id, max_passed_question_id):
+    catalog = _get_catalog()
+    if max_passed_question_id == catalog.max_question_id:
+        return GameStep(GAME_WIN, player_place=_get_user_place(session, player_id))
+    return GameStep(GAME_NEXT,
+                    question=_get_question(catalog, max_passed_question_id + 1),
+                    hints=_get_available_hints(session, player_id))
+
+
+def _lose_step(session, player_id):
+    return GameStep(GAME_LOSE,
+                    max_passed_question_id=_get_max_passed_question_id(session, player_id),
+                    question_count=get_question_count())
 
 
 def _build_rating_query(session):
-    passed_answers_query = session.query(Answer.player_id,
-                                         count('*').label('points'),
-                                         sum_(Answer.tries).label('tries'),
-                                         max(Answer.answer_time).label('last_answer_time')).filter(Answer.passed == True) \
-        .group_by(Answer.player_id).subquery()
-    hint_count_query = session.query(Hint.player_id, count('*').label('hint_count')).group_by(Hint.player_id).subquery()
-
-    position_field = dense_rank().over(order_by=[passed_answers_query.c.points.desc().nullslast(),
-                                                 passed_answers_query.c.tries.nullslast(),
-                                                 hint_count_query.c.hint_count.nullsfirst(),
-                                                 passed_answers_query.c.last_answer_time.nullslast()]).label('position')
-
-    return position_field, session.query(position_field,
-                                         Player,
-                                         passed_answers_query.c.points,
-                                         passed_answers_query.c.tries,
-                                         hint_count_query.c.hint_count,
-                                         passed_answers_query.c.last_answer_time) \
-        .select_from(Player) \
-        .outerjoin(passed_answers_query, Player.player_id == passed_answers_query.c.player_id) \
-        .outerjoin(hint_count_query, Player.player_id == hint_count_query.c.player_id).order_by(position_field)
+    position_field = dense_rank().over(order_by=_rating_order()).label('position')
+    return position_field, _query_season_scores(session,
+                                                position_field,
+                                                Player,
+                                                PlayerScore.points,
+                                                PlayerScore.tries,
+                                                PlayerScore.hint_count,
+                                                PlayerScore.last_answer_time) \
+        .order_by(*(_rating_order() + [PlayerScore.player_id]))
+
+
+def _query_season_scores(session, *entities):
+    return session.query(*entities) \
+        .select_from(PlayerScore) \
+        .join(Player, Player.player_id == PlayerScore.player_id) \
+        .filter(PlayerScore.season_id == _get_active_season_id())
+
+
+def _rating_order():
+    # must match player_score_rating_idx
+    return [PlayerScore.points.desc(), PlayerScore.tries, PlayerScore.hint_count, PlayerScore.last_answer_time.nullslast()]
+
+
+def _update_player_score(session, season_id, player_id, points=0, tries=0, hint_count=0, last_answer_time=None):
+    table = PlayerScore.__table__
+    statement = pg_insert(table).values(season_id=season_id, player_id=player_id, points=points, tries=tries, hint_count=hint_count,
+                                        last_answer_time=last_answer_time)
+    values = {'points': table.c.points + points,
+              'tries': table.c.tries + tries,
+              'hint_count': table.c.hint_count + hint_count}
+    if last_answer_time:
+        values['last_answer_time'] = func.greatest(table.c.last_answer_time, last_answer_time)
+    # a player can answer a question of the season started after the last /start
+    session.execute(statement.on_conflict_do_update(index_elements=[table.c.season_id, table.c.player_id], set_=values))
+    _remember_player_write(player_id)
 
 
 @with_session()
+def add_missing_player_scores(session):
+    """
+    Creates player_score rows of the active season for players that have none, e.g. inserted by hand or registered before
+    scores existed. Players registered before the season start are only taken if they played in it
+    """
+    season = session.query(Season).filter(Season.season_id == _get_active_season_id()).one()
+    answers_query = session.query(Answer.player_id,
+                                  count('*').filter(Answer.passed == True).label('points'),
+                                  sum_(Answer.tries).filter(Answer.passed == True).label('tries'),
+                                  max(Answer.answer_time).filter(Answer.passed == True).label('last_answer_time')) \
+        .filter(Answer.season_id == season.season_id).group_by(Answer.player_id).subquery()
+    hint_count_query = session.query(Hint.player_id, count('*').label('hint_count')) \
+        .filter(Hint.season_id == season.season_id).group_by(Hint.player_id).subquery()
+    missing_scores_query = session.query(literal(season.season_id),
+                                         Player.player_id,
+                                         coalesce(answers_query.c.points, 0),
+                                         coalesce(answers_query.c.tries, 0),
+                                         coalesce(hint_count_query.c.hint_count, 0),
+                                         answers_query.c.last_answer_time) \
+        .outerjoin(answers_query, Player.player_id == answers_query.c.player_id) \
+        .outerjoin(hint_count_query, Player.player_id == hint_count_query.c.player_id) \
+        .outerjoin(PlayerScore, and_(PlayerScore.season_id == season.season_id, Player.player_id == PlayerScore.player_id)) \
+        .filter(and_(PlayerScore.player_id == None,
+                     or_(Player.registration_time >= season.started_time,
+                         answers_query.c.player_id != None,
+                         hint_count_query.c.player_id != None)))
+    session.execute(PlayerScore.__table__.insert().from_select(
+        ['season_id', 'player_id', 'points', 'tries', 'hint_count', 'last_answer_time'], missing_scores_query))
+
+
+@with_session(read_only=True)
 def get_top(session, limited=True):
     position_field, rating_query = _build_rating_query(session)
     if limited:
@@ -210,6 +830,137 @@ def get_top(session, limited=True):
     return rating_query.all()
 
 
+RatingRow = namedtuple('RatingRow', ['position', 'player_id', 'player_name', 'chat_id', 'points', 'tries', 'hint_count',
+                                     'last_answer_time'])
+_RATING_CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+@with_session(read_only=True)
+def get_rating_page(session, after=None, search=None, limit=100):
+    """
+    Page of the rating seeking past the last row of the previous page instead of skipping rows
+    :param after: cursor of the previous page
+    :param search: part of player name or whole player id
+    :return: list of RatingRow, cursor of the next page or None
+    """
+    rating_query = _filter_player_search(_query_season_scores(session,
+                                                              Player.player_id,
+                                                              Player.player_name,
+                                                              Player.chat_id,
+                                                              PlayerScore.points,
+                                                              PlayerScore.tries,
+                                                              PlayerScore.hint_count,
+                                                              PlayerScore.last_answer_time), search)
+    if after:
+        rating_query = rating_query.filter(_ranked_after(*_decode_rating_cursor(after)))
+    rows = rating_query.order_by(*(_rating_order() + [PlayerScore.player_id])).limit(limit + 1).all()
+
+    page = []
+    position = None
+    rating_key = None
+    for row in rows[:limit]:
+        if rating_key != (row.points, row.tries, row.hint_count, row.last_answer_time):
+            rating_key = (row.points, row.tries, row.hint_count, row.last_answer_time)
+            # found players are not next to each other in the rating, each of them is placed on its own
+            position = position + 1 if position and not search else _count_ranked_ahead(session, *rating_key) + 1
+        page.append(RatingRow(position, *row))
+    return page, _encode_rating_cursor(page[-1]) if len(rows) > limit else None
+
+
+def _encode_rating_cursor(row):
+    last_answer_time = row.last_answer_time.strftime(_RATING_CURSOR_TIME_FORMAT) if row.last_answer_time else ''
+    return '_'.join([str(row.points), str(row.tries), str(row.hint_count), last_answer_time, row.player_id])
+
+
+def _decode_rating_cursor(cursor):
+    """
+    :raise ValueError: if the cursor is malformed
+    """
+    points, tries, hint_count, last_answer_time, player_id = cursor.split('_', 4)
+    return int(points), int(tries), int(hint_count), \
+        datetime.datetime.strptime(last_answer_time, _RATING_CURSOR_TIME_FORMAT) if last_answer_time else None, player_id
+
+
+def _filter_player_search(query, search):
+    if not search:
+        return query
+    return query.filter(or_(Player.player_id == search, func.lower(Player.player_name).contains(search.lower(), autoescape=True)))
+
+
+@with_session(read_only=True)
+def get_matching_player_ids(session, search):
+    """
+    :return: ids of all rating players matching the search of get_rating_page
+    """
+    return [player_id for player_id, in _filter_player_search(_query_season_scores(session, PlayerScore.player_id), search)]
+
+
+EXPORT_RATING = 'rating'
+EXPORT_ANSWERS = 'answers'
+EXPORT_HINTS = 'hints'
+EXPORT_TABLES = (EXPORT_RATING, EXPORT_ANSWERS, EXPORT_HINTS)
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+
+
+def get_export_columns(table):
+    if table == EXPORT_RATING:
+        return ['position', 'player_id', 'player_name', 'points', 'tries', 'hint_count', 'last_answer_time']
+    if table == EXPORT_ANSWERS:
+        return ['player_id', 'question_id', 'variant_id', 'tries', 'passed', 'answer_time']
+    if table == EXPORT_HINTS:
+        return ['player_id', 'question_id', 'hint_key', 'tries']
+    raise ValueError('Unknown export table {}'.format(table))
+
+
+def iter_export_rows(table, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Reads the table of the active season over a server-side cursor in a session of its own, only batch_size rows are held at a time.
+    The session lives until the generator is exhausted or closed
+    :return: generator of row tuples in get_export_columns order
+    """
+    session = _begin_read_session()
+    try:
+        if table == EXPORT_RATING:
+            position_field, rating_query = _build_rating_query(session)
+            rows = ((position, player.player_id, player.player_name, points, tries, hint_count, last_answer_time)
+                    for position, player, points, tries, hint_count, last_answer_time in
+                    rating_query.execution_options(stream_results=True).yield_per(batch_size))
+        elif table == EXPORT_ANSWERS:
+            rows = session.query(Answer.player_id, Answer.question_id, Answer.variant_id, Answer.tries, Answer.passed, Answer.answer_time) \
+                .filter(Answer.season_id == _get_active_season_id()) \
+                .order_by(Answer.player_id, Answer.question_id, Answer.variant_id) \
+                .execution_options(stream_results=True).yield_per(batch_size)
+        else:
+            rows = session.query(Hint.player_id, Hint.question_id, Hint.hint_key, Hint.tries) \
+                .filter(Hint.season_id == _get_active_season_id()) \
+                .order_by(Hint.player_id, Hint.question_id, Hint.hint_key) \
+                .execution_options(stream_results=True).yield_per(batch_size)
+        for row in rows:
+            yield tuple(row)
+    finally:
+        # nothing is written, also ends a read abandoned half way
+        session.rollback()
+        session.close()
+
+
+def _begin_read_session():
+    if _is_replica_readable():
+        session = _ReplicaSession(autocommit=True)
+        session.begin()
+        try:
+            # connects at once so a failed replica is noticed before any row is read
+            session.connection()
+            return session
+        except DBAPIError as ex:
+            session.close()
+            if not is_replica_failure(ex):
+                raise
+            _on_replica_failure()
+    session = _Session(autocommit=True)
+    session.begin()
+    return session
+
+
 @with_session()
 def get_properties(session):
     return session.query(Property).order_by(Property.property_key)
@@ -220,12 +971,38 @@ def save_properties(session, properties):
     props = session.query(Property).filter(Property.property_key.in_(properties.keys())).all()
     for prop in props:
         prop.property_value = properties[prop.property_key]
+    _notify(session, PROPERTY_CHANNEL)
+
+
+def _notify(session, channel, payload=''):
+    # delivered to listeners on commit only
+    session.execute(select([func.pg_notify(channel, payload)]))
 
 
 @with_session()
 def clear_data(session, player_ids):
-    session.query(Answer).filter(Answer.player_id.in_(player_ids)).delete(synchronize_session=False)
-    session.query(Hint).filter(Hint.player_id.in_(player_ids)).delete(synchronize_session=False)
+    """
+    Resets the game of the players in the active season, starting a new season resets everybody at once
+    """
+    season_id = _get_active_season_id()
+    deleted_answers = session.execute(Answer.__table__.delete().where(and_(Answer.season_id == season_id, Answer.player_id.in_(player_ids)))
+                                      .returning(Answer.question_id, Answer.variant_id))
+    deltas = {}
+    for question_id, variant_id in deleted_answers:
+        deltas[(season_id, question_id, variant_id)] = deltas.get((season_id, question_id, variant_id), 0) - 1
+    if deltas:
+        _apply_variant_stat_deltas(session, deltas)
+    session.query(Hint).filter(and_(Hint.season_id == season_id, Hint.player_id.in_(player_ids))).delete(synchronize_session=False)
+    session.query(PlayerScore).filter(and_(PlayerScore.season_id == season_id, PlayerScore.player_id.in_(player_ids))).update(
+        {PlayerScore.points: 0, PlayerScore.tries: 0, PlayerScore.hint_count: 0, PlayerScore.last_answer_time: None}, synchronize_session=False)
+    invalidate_player_progress(player_ids)
+    _notify_players_changed(session, player_ids)
+
+
+def _notify_players_changed(session, player_ids):
+    payload = ','.join(player_ids)
+    # notification payload is limited to 8000 bytes, empty one means all players
+    _notify(session, PLAYER_CHANNEL, payload if len(payload) < 7900 else '')
 
 
 @with_session()
@@ -237,6 +1014,8 @@ def get_player(session, player_id):
 def rename_player(session, player_id, player_name):
     player = session.query(Player).filter(Player.player_id == player_id).one()
     player.player_name = player_name
+    invalidate_player_progress([player_id])
+    _notify_players_changed(session, [player_id])
 
 
 @with_session()
@@ -244,21 +1023,370 @@ def get_questions(session):
     return session.query(Question).order_by(Question.question_id).all()
 
 
-@with_session()
-def get_question_count(session):
-    return session.query(count(Question.question_id)).scalar()
+def get_question_count():
+    return _get_catalog().question_count
 
 
 @with_session()
 def update_questions(session, update):
-    for question in update:
+    """
+    :param update: dicts with question_id, text_value and variants with variant_id and text_value
+    """
+    update = list(update)
+    question_table = Question.__table__
+    variant_table = Variant.__table__
+    session.execute(question_table.update().where(question_table.c.question_id == bindparam('update_question_id'))
+                    .values(text_value=bindparam('text_value')),
+                    [{'update_question_id': int(question['question_id']), 'text_value': question['text_value']} for question in update])
+    variants = [{'update_question_id': int(question['question_id']), 'update_variant_id': variant['variant_id'],
+                 'text_value': variant['text_value']} for question in update for variant in question['variants']]
+    if variants:
+        session.execute(variant_table.update().where(and_(variant_table.c.question_id == bindparam('update_question_id'),
+                                                          variant_table.c.variant_id == bindparam('update_variant_id')))
+                        .values(text_value=bindparam('text_value')), variants)
+    _bump_catalog_version(session)
+
+
+@with_session()
+def import_questions(session, questions):
+    """
+    Adds and replaces questions of a validated pack in one transaction, questions without id are appended after the last one.
+    Variants missing in the pack are removed unless somebody has answered them
+    :return: ids of the imported questions
+    :raise QuestionPackError: if a removed variant has answers or question ids would have gaps
+    """
+    question_table = Question.__table__
+    variant_table = Variant.__table__
+    # nobody else takes ids while the pack is applied
+    session.execute('LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE'.format(Question.__tablename__))
+    next_question_id = builtins.max([session.query(max(Question.question_id)).scalar() or 0] +
+                                    [question['question_id'] or 0 for question in questions]) + 1
+    question_rows = []
+    variant_rows = []
+    for question in questions:
         question_id = question['question_id']
-        db_question = session.query(Question).filter(Question.question_id == question_id).one()
-        db_question.text_value = question['text_value']
-        for variant in question['variants']:
-            variant_id = variant['variant_id']
-            db_variant = session.query(Variant).filter(and_(Variant.question_id == question_id, Variant.variant_id == variant_id)).one()
-            db_variant.text_value = variant['text_value']
+        if question_id is None:
+            question_id = next_question_id
+            next_question_id += 1
+        question_rows.append({'question_id': question_id, 'text_value': question['text_value']})
+        variant_rows.extend({'question_id': question_id, 'variant_id': variant['variant_id'], 'text_value': variant['text_value'],
+                             'correct': variant['correct']} for variant in question['variants'])
+    question_ids = [row['question_id'] for row in question_rows]
+
+    kept_variant_keys = [(row['question_id'], row['variant_id']) for row in variant_rows]
+    answered = session.query(Answer.question_id, Answer.variant_id).filter(and_(
+        Answer.question_id.in_(question_ids), ~tuple_(Answer.question_id, Answer.variant_id).in_(kept_variant_keys))) \
+        .distinct().order_by(Answer.question_id, Answer.variant_id).all()
+    if answered:
+        raise question_pack.QuestionPackError(['Variant {} of question {} has answers and can not be removed'.format(variant_id, question_id)
+                                               for question_id, variant_id in answered])
+    session.execute(variant_table.delete().where(and_(
+        variant_table.c.question_id.in_(question_ids),
+        ~tuple_(variant_table.c.question_id, variant_table.c.variant_id).in_(kept_variant_keys))))
+
+    statement = pg_insert(question_table).values(question_rows)
+    session.execute(statement.on_conflict_do_update(index_elements=[question_table.c.question_id],
+                                                    set_={'text_value': statement.excluded.text_value}))
+    statement = pg_insert(variant_table).values(variant_rows)
+    session.execute(statement.on_conflict_do_update(index_elements=[variant_table.c.question_id, variant_table.c.variant_id],
+                                                    set_={'text_value': statement.excluded.text_value,
+                                                          'correct': statement.excluded.correct}))
+    # the game goes through questions by id one by one
+    present_question_ids = {question_id for question_id, in session.query(Question.question_id)}
+    missing_question_ids = sorted(set(range(1, builtins.max(present_question_ids) + 1)) - present_question_ids)
+    if missing_question_ids:
+        raise question_pack.QuestionPackError(['Questions should be numbered without gaps, missing ids: {}'.format(
+            ', '.join(str(question_id) for question_id in missing_question_ids[:20]))])
+    # explicit ids do not move the serial sequence psql inserts rely on
+    session.execute(select([func.setval(func.pg_get_serial_sequence(Question.__tablename__, 'question_id'),
+                                        select([max(Question.question_id)]).scalar_subquery())]))
+    _bump_catalog_version(session)
+    return question_ids
+
+
+def _bump_catalog_version(session):
+    session.flush()
+    catalog_version = session.query(CatalogVersion).with_for_update().first()
+    if catalog_version:
+        catalog_version.version += 1
+    else:
+        catalog_version = CatalogVersion(1)
+        session.add(catalog_version)
+    _notify(session, CATALOG_CHANNEL, str(catalog_version.version))
+
+
+def _get_catalog():
+    if _is_expired(_catalog_loaded_time, _CATALOG_CACHE_TTL):
+        reload_catalog()
+    return _catalog
+
+
+@with_session()
+def reload_catalog(session, version=None):
+    """
+    Swaps in a new catalog snapshot unless the loaded one is already at the notified version
+    """
+    global _catalog, _catalog_loaded_time
+    if version is not None and _catalog.version is not None and int(version) <= _catalog.version:
+        return _catalog
+    catalog_version = session.query(CatalogVersion.version).scalar() or 0
+    questions = {}
+    for question in session.query(Question).order_by(Question.question_id):
+        variants = tuple(CatalogVariant(variant.variant_id, variant.text_value, variant.correct) for variant in question.variants)
+        questions[question.question_id] = CatalogQuestion(question.question_id, question.text_value, variants,
+                                                          frozenset(variant.variant_id for variant in variants if variant.correct))
+    max_question_id = builtins.max(questions) if questions else None
+    _catalog = Catalog(catalog_version,
+                       tuple(questions.get(question_id) for question_id in range((max_question_id or 0) + 1)),
+                       max_question_id,
+                       len(questions))
+    _catalog_loaded_time = time.time()
+    return _catalog
+
+
+def get_active_season_id():
+    return _get_active_season_id()
+
+
+def _get_active_season_id():
+    loaded_time, season_id = _active_season
+    if _is_expired(loaded_time, _SEASON_CACHE_TTL):
+        season_id = reload_active_season()
+    return season_id
+
+
+@with_session()
+def reload_active_season(session):
+    global _active_season
+    season_id = session.query(max(Season.season_id)).scalar()
+    _active_season = (time.time(), season_id)
+    return season_id
+
+
+def _on_season_changed(payload):
+    reload_active_season()
+    _on_players_changed(None)
+
+
+@with_session()
+def get_seasons(session):
+    return session.query(Season).order_by(Season.season_id.desc()).all()
+
+
+@with_session()
+def start_season(session, title, started_time):
+    """
+    Makes a new season the active one. Its partitions are created empty, nothing is copied or deleted
+    :return: id of the season
+    """
+    _lock_seasons(session)
+    season = Season(title, started_time)
+    session.add(season)
+    session.flush()
+    _attach_season_partitions(session, season.season_id)
+    _notify(session, SEASON_CHANNEL, str(season.season_id))
+    return season.season_id
+
+
+@with_session()
+def archive_season(session, season_id):
+    """
+    Detaches partitions of a finished season, its rows are kept in tables <table>_s<season_id> outside the game tables
+    """
+    season = _get_finished_season(session, season_id)
+    for table in _SEASON_PARTITIONED_TABLES:
+        partition = _partition_name(table, season_id)
+        if _is_partition_attached(session, partition):
+            session.execute('ALTER TABLE {} DETACH PARTITION {}'.format(table, partition))
+    season.archived_time = season.archived_time or datetime.datetime.now()
+
+
+@with_session()
+def drop_season(session, season_id):
+    """
+    Drops all rows of a finished season with its partitions
+    """
+    season = _get_finished_season(session, season_id)
+    session.execute('DROP TABLE IF EXISTS {}'.format(', '.join(_partition_name(table, season_id) for table in _SEASON_PARTITIONED_TABLES)))
+    session.query(VariantStat).filter(VariantStat.season_id == season_id).delete(synchronize_session=False)
+    session.delete(season)
+
+
+def _get_finished_season(session, season_id):
+    _lock_seasons(session)
+    season = session.query(Season).filter(Season.season_id == season_id).one()
+    if season_id == session.query(max(Season.season_id)).scalar():
+        raise ValueError('Season {} is being played, start a new one first'.format(season_id))
+    return season
+
+
+def _lock_seasons(session):
+    session.execute(select([func.pg_advisory_xact_lock(_SEASON_LOCK_KEY)]))
+
+
+def _partition_name(table, season_id):
+    return '{}_s{}'.format(table, int(season_id))
+
+
+def _is_partition_attached(session, partition):
+    return session.execute('SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:partition))',
+                           {'partition': partition}).scalar()
+
+
+def _attach_season_partitions(session, season_id):
+    for table in _SEASON_PARTITIONED_TABLES:
+        partition = _partition_name(table, season_id)
+        if session.execute('SELECT to_regclass(:partition)', {'partition': partition}).scalar() is None:
+            session.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({})'.format(partition, table, int(season_id)))
+        elif not _is_partition_attached(session, partition):
+            session.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})'.format(table, partition, int(season_id)))
+
+
+@with_session()
+def init_seasons(session):
+    """
+    Creates the first season if there is none and makes sure partitions of the active season are in place
+    """
+    _lock_seasons(session)
+    season_id = session.query(max(Season.season_id)).scalar()
+    if season_id is None:
+        # tables made partitions by migrations._partition_legacy_tables belong to season 1
+        season_id = 1
+        started_time = session.query(func.min(Player.registration_time)).scalar() or datetime.datetime.now()
+        session.execute(Season.__table__.insert().values(season_id=season_id, title='Season 1', started_time=started_time))
+        session.execute("SELECT setval(pg_get_serial_sequence('season', 'season_id'), :season_id)", {'season_id': season_id})
+    _attach_season_partitions(session, season_id)
+
+
+@with_session()
+def create_broadcast_job(session, message, chat_ids, created_time, search=None):
+    """
+    :param search: if given, recipients are all rating players matching it as in get_rating_page instead of chat_ids
+    :return: id of the job with all recipients pending
+    """
+    job = BroadcastJob(message, created_time)
+    session.add(job)
+    session.flush()
+    if search is not None:
+        matching_chat_ids = _filter_player_search(_query_season_scores(session, literal(job.job_id), Player.chat_id,
+                                                                       literal(BROADCAST_PENDING), literal(0))
+                                                  .filter(Player.chat_id != None), search).distinct()
+        session.execute(BroadcastRecipient.__table__.insert().from_select(['job_id', 'chat_id', 'status', 'attempts'], matching_chat_ids))
+    elif chat_ids:
+        session.execute(BroadcastRecipient.__table__.insert(),
+                        [{'job_id': job.job_id, 'chat_id': int(chat_id), 'status': BROADCAST_PENDING, 'attempts': 0}
+                         for chat_id in set(chat_ids)])
+    return job.job_id
+
+
+@with_session()
+def get_broadcast_job(session, job_id):
+    """
+    :return: job, {recipient status: count}, failed chat ids
+    """
+    job = session.query(BroadcastJob).filter(BroadcastJob.job_id == job_id).one()
+    counts = dict(session.query(BroadcastRecipient.status, count('*')).filter(BroadcastRecipient.job_id == job_id)
+                  .group_by(BroadcastRecipient.status).all())
+    failed_chat_ids = [chat_id for chat_id, in session.query(BroadcastRecipient.chat_id).filter(
+        and_(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == BROADCAST_FAILED)).order_by(BroadcastRecipient.chat_id)]
+    return job, counts, failed_chat_ids
+
+
+@with_session()
+def get_unfinished_broadcast_job_ids(session):
+    return [job_id for job_id, in session.query(BroadcastJob.job_id).filter(BroadcastJob.finished_time == None)
+            .order_by(BroadcastJob.job_id)]
+
+
+@with_session()
+def get_pending_broadcast_chat_ids(session, job_id, limit):
+    return [chat_id for chat_id, in session.query(BroadcastRecipient.chat_id).filter(
+        and_(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == BROADCAST_PENDING))
+            .order_by(BroadcastRecipient.chat_id).limit(limit)]
+
+
+@with_session()
+def save_broadcast_results(session, job_id, results):
+    """
+    :param results: dicts with chat_id, status, attempts and error
+    """
+    table = BroadcastRecipient.__table__
+    session.execute(table.update().where(and_(table.c.job_id == job_id, table.c.chat_id == bindparam('result_chat_id')))
+                    .values(status=bindparam('status'), attempts=bindparam('attempts'), error=bindparam('error')),
+                    [{'result_chat_id': result['chat_id'], 'status': result['status'], 'attempts': result['attempts'],
+                      'error': result['error']} for result in results])
+
+
+@with_session()
+def finish_broadcast_job(session, job_id, finished_time):
+    session.query(BroadcastJob).filter(BroadcastJob.job_id == job_id).update({BroadcastJob.finished_time: finished_time},
+                                                                            synchronize_session=False)
+
+
+class LeaseLostError(Exception):
+    """
+    The player lease was taken by another instance, the update is left to it
+    """
+
+
+@with_session()
+def beat_bot_instance(session, instance_id, address, dead_after_seconds):
+    """
+    Registers the instance or prolongs its heartbeat, instances silent for dead_after_seconds are removed with their leases
+    """
+    table = BotInstance.__table__
+    session.execute(pg_insert(table).values(instance_id=instance_id, address=address, heartbeat_time=func.now())
+                    .on_conflict_do_update(index_elements=[table.c.instance_id],
+                                           set_={'address': address, 'heartbeat_time': func.now()}))
+    dead_instance_ids = select([BotInstance.instance_id]).where(
+        BotInstance.heartbeat_time < func.now() - datetime.timedelta(seconds=dead_after_seconds))
+    session.query(PlayerLease).filter(PlayerLease.instance_id.in_(dead_instance_ids)).delete(synchronize_session=False)
+    session.query(BotInstance).filter(BotInstance.instance_id.in_(dead_instance_ids)).delete(synchronize_session=False)
+
+
+@with_session()
+def drop_bot_instance(session, instance_id):
+    session.query(PlayerLease).filter(PlayerLease.instance_id == instance_id).delete(synchronize_session=False)
+    session.query(BotInstance).filter(BotInstance.instance_id == instance_id).delete(synchronize_session=False)
+
+
+@with_session()
+def acquire_player_lease(session, player_id, instance_id, ttl_seconds):
+    """
+    Takes the lease of a player if nobody holds it or the holder missed heartbeats for ttl_seconds
+    :return: (True, None) if instance_id holds the lease, otherwise (False, address of the holder or None if it has just gone)
+    """
+    table = PlayerLease.__table__
+    alive_instance_ids = select([BotInstance.instance_id]).where(
+        BotInstance.heartbeat_time > func.now() - datetime.timedelta(seconds=ttl_seconds))
+    statement = pg_insert(table).values(player_id=player_id, instance_id=instance_id, acquired_time=func.now())
+    statement = statement.on_conflict_do_update(index_elements=[table.c.player_id],
+                                                set_={'instance_id': instance_id, 'acquired_time': func.now()},
+                                                where=or_(table.c.instance_id == instance_id,
+                                                           table.c.instance_id.notin_(alive_instance_ids)))
+    if session.execute(statement.returning(table.c.instance_id)).first():
+        return True, None
+    return False, session.query(BotInstance.address).join(PlayerLease, PlayerLease.instance_id == BotInstance.instance_id) \
+        .filter(PlayerLease.player_id == player_id).scalar()
+
+
+def set_lease_instance(instance_id):
+    global _lease_instance_id
+    _lease_instance_id = instance_id
+
+
+def _check_lease(session, player_id):
+    """
+    Fences writes of a player to the instance holding its lease, the lease row stays locked till commit so it is not taken over meanwhile
+    :raise LeaseLostError: if another instance took the lease since the update was routed here
+    """
+    if _lease_instance_id is None:
+        return
+    held = session.query(PlayerLease.player_id) \
+        .filter(PlayerLease.player_id == player_id, PlayerLease.instance_id == _lease_instance_id) \
+        .with_for_update(read=True).first()
+    if not held:
+        raise LeaseLostError('Lease of player id={} is not held by {}'.format(player_id, _lease_instance_id))
 
 
 class Player(_Base):
@@ -277,6 +1405,40 @@ class Player(_Base):
         self.registration_time = registration_time
 
 
+class Season(_Base):
+    """
+    Round of the game, the latest started one is played. Its answers, hints and scores are kept in partitions of their own
+    """
+    __tablename__ = 'season'
+    season_id = Column(Integer, primary_key=True, nullable=False)
+
+    title = Column(String(200), nullable=False)
+    started_time = Column(DateTime, nullable=False)
+    # partitions of an archived season are detached from the game tables and kept as they are
+    archived_time = Column(DateTime)
+
+    def __init__(self, title, started_time):
+        self.title = title
+        self.started_time = started_time
+
+
+class PlayerScore(_Base):
+    """
+    Rating aggregates of passed answers and hints maintained on every write
+    """
+    __tablename__ = 'player_score'
+    season_id = Column(Integer, primary_key=True, nullable=False)
+    player_id = Column(String(100), ForeignKey(Player.player_id), primary_key=True, nullable=False)
+
+    points = Column(Integer, nullable=False)
+    tries = Column(Integer, nullable=False)
+    hint_count = Column(Integer, nullable=False)
+    last_answer_time = Column(DateTime)
+
+    __table_args__ = (Index('player_score_rating_idx', points.desc(), tries, hint_count, last_answer_time, player_id),
+                      {'postgresql_partition_by': 'LIST (season_id)'})
+
+
 class Question(_Base):
     __tablename__ = 'question'
     question_id = Column(Integer, primary_key=True, nullable=False)
@@ -298,6 +1460,7 @@ class Variant(_Base):
 
 class Answer(_Base):
     __tablename__ = 'answer'
+    season_id = Column(Integer, primary_key=True, nullable=False)
     player_id = Column(String(100), ForeignKey(Player.player_id), primary_key=True, nullable=False)
     question_id = Column(Integer, primary_key=True, nullable=False)
     variant_id = Column(String(1), primary_key=True, nullable=False)
@@ -306,14 +1469,20 @@ class Answer(_Base):
     passed = Column(Boolean)
     answer_time = Column(DateTime, nullable=False)
 
-    def __init__(self, player_id, question_id, variant_id, answer_time):
+    def __init__(self, season_id, player_id, question_id, variant_id, answer_time):
+        self.season_id = season_id
         self.player_id = player_id
         self.question_id = question_id
         self.variant_id = variant_id
         self.answer_time = answer_time
         self.tries = 0
 
-    __table_args__ = (ForeignKeyConstraint((question_id, variant_id), [Variant.question_id, Variant.variant_id]),)
+    __table_args__ = (ForeignKeyConstraint((question_id, variant_id), [Variant.question_id, Variant.variant_id]),
+                      # max passed question of a player
+                      Index('answer_passed_idx', season_id, player_id, question_id, postgresql_where=passed == True),
+                      # foreign key checks of variant changes and answered variants of imported questions
+                      Index('answer_variant_idx', question_id, variant_id),
+                      {'postgresql_partition_by': 'LIST (season_id)'})
 
     # relations inited later
     # variant = None
@@ -321,17 +1490,89 @@ class Answer(_Base):
 
 class Hint(_Base):
     __tablename__ = 'hint'
+    season_id = Column(Integer, primary_key=True, nullable=False)
     player_id = Column(String(100), ForeignKey(Player.player_id), primary_key=True, nullable=False)
     question_id = Column(Integer, ForeignKey(Question.question_id), primary_key=True, nullable=False)
     hint_key = Column(String(50), primary_key=True, nullable=False)
     tries = Column(Integer, nullable=False)
 
-    def __init__(self, player_id, question_id, hint_key, tries):
+    def __init__(self, season_id, player_id, question_id, hint_key, tries):
+        self.season_id = season_id
         self.player_id = player_id
         self.question_id = question_id
         self.hint_key = hint_key
         self.tries = tries
 
+    __table_args__ = ({'postgresql_partition_by': 'LIST (season_id)'},)
+
+
+class CatalogVersion(_Base):
+    __tablename__ = 'catalog_version'
+    version = Column(Integer, primary_key=True, nullable=False)
+
+    def __init__(self, version):
+        self.version = version
+
+
+class BroadcastJob(_Base):
+    __tablename__ = 'broadcast_job'
+    job_id = Column(Integer, primary_key=True, nullable=False)
+
+    message = Column(String(4096), nullable=False)
+    created_time = Column(DateTime, nullable=False)
+    finished_time = Column(DateTime)
+
+    def __init__(self, message, created_time):
+        self.message = message
+        self.created_time = created_time
+
+
+class BroadcastRecipient(_Base):
+    __tablename__ = 'broadcast_recipient'
+    job_id = Column(Integer, ForeignKey(BroadcastJob.job_id), primary_key=True, nullable=False)
+    chat_id = Column(BigInteger, primary_key=True, nullable=False)
+
+    status = Column(String(20), nullable=False)
+    attempts = Column(Integer, nullable=False)
+    error = Column(String(200))
+
+    # sent recipients are not walked over again by every next batch
+    __table_args__ = (Index('broadcast_recipient_pending_idx', job_id, chat_id, postgresql_where=status == 'pending'),)
+
+
+class BotInstance(_Base):
+    """
+    Running bot instance, it is alive while heartbeat_time keeps moving
+    """
+    __tablename__ = 'bot_instance'
+    instance_id = Column(String(100), primary_key=True, nullable=False)
+
+    address = Column(String(200), nullable=False)
+    heartbeat_time = Column(DateTime(timezone=True), nullable=False)
+
+
+class PlayerLease(_Base):
+    """
+    The only instance processing updates of a player, taken over when its instance dies
+    """
+    __tablename__ = 'player_lease'
+    player_id = Column(String(100), primary_key=True, nullable=False)
+
+    instance_id = Column(String(100), nullable=False, index=True)
+    acquired_time = Column(DateTime(timezone=True), nullable=False)
+
+
+class VariantStat(_Base):
+    """
+    Number of players whose first answer to the question in the season was the variant, shown by the public help hint
+    """
+    __tablename__ = 'variant_stat'
+    season_id = Column(Integer, primary_key=True, nullable=False)
+    question_id = Column(Integer, primary_key=True, nullable=False)
+    variant_id = Column(String(1), primary_key=True, nullable=False)
+
+    answer_count = Column(Integer, nullable=False)
+
 
 class Property(_Base):
     __tablename__ = 'property'
@@ -344,7 +1585,10 @@ class Property(_Base):
         self.property_value = property_value
 
 
-def init():
+def configure():
+    """
+    Maps relations and binds sessions to the database without touching it
+    """
     # relations
     Question.variants = relationship(Variant, order_by=Variant.variant_id, lazy='joined')
     # Answer.variant = relationship(Variant, uselist=False, lazy='dynamic', primaryjoin=and_(Answer.question_id == Variant.question_id,
@@ -353,9 +1597,106 @@ def init():
     engine = create_engine('postgresql+psycopg2://{user}:{passwd}@{host}:{port}/{db}'.format(**_build_parameters()),
                            isolation_level='READ_COMMITTED',
                            encoding='utf8',
-                           echo=True)
+                           poolclass=_TimedQueuePool)
+    instrument_engine(engine)
     _Session.configure(bind=engine)
-    _Base.metadata.create_all(engine)
+    if DB_REPLICA_HOST:
+        replica_engine = create_engine('postgresql+psycopg2://{user}:{passwd}@{host}:{port}/{db}'.format(**_build_replica_parameters()),
+                                       isolation_level='READ_COMMITTED',
+                                       encoding='utf8',
+                                       poolclass=_TimedReplicaPool,
+                                       connect_args={'connect_timeout': _REPLICA_CONNECT_TIMEOUT_SECONDS})
+        instrument_engine(replica_engine)
+        _ReplicaSession.configure(bind=replica_engine)
+
+
+class _TimedQueuePool(QueuePool):
+    _pool_name = 'sync'
+
+    def _do_get(self):
+        with metrics.POOL_WAIT_SECONDS.time(pool=self._pool_name):
+            return super()._do_get()
+
+
+class _TimedReplicaPool(_TimedQueuePool):
+    _pool_name = 'replica'
+
+
+def instrument_engine(engine):
+    """
+    Counts statements of the engine and logs a sample of them, see SQL_LOG_SAMPLE_RATE
+    """
+    event.listen(engine, 'before_cursor_execute', _on_cursor_execute)
+
+
+def _on_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.count_query()
+    if SQL_LOG_SAMPLE_RATE and random.random() < SQL_LOG_SAMPLE_RATE:
+        sql_logger.info('{} {!r}'.format(statement, parameters))
+
+
+def get_engine():
+    return _Session.kw['bind']
+
+
+def init(background=True, migrate=None):
+    """
+    :param background: False for command line tools, they neither listen to changes of other processes nor buffer variant stats
+    :param migrate: function applying migrations to the engine, migrations.migrate if not given
+    """
+    configure()
+    if migrate is None:
+        # migrations uses this module, importing it on top would make an import cycle
+        import migrations
+        migrate = migrations.migrate
+    migrate(get_engine())
+    init_seasons()
+    reload_active_season()
+    add_missing_player_scores()
+    add_missing_variant_stats()
+    reload_properties()
+    reload_catalog()
+    if background:
+        _start_listener()
+        threading.Thread(target=_flush_variant_stats_forever, name='variant-stat-flush', daemon=True).start()
+        atexit.register(flush_variant_stats)
+
+
+def _listen(handlers):
+    while True:
+        connection = None
+        try:
+            parameters = _build_parameters()
+            connection = psycopg2.connect(user=parameters['user'], password=parameters['passwd'], host=parameters['host'],
+                                          port=parameters['port'], dbname=parameters['db'])
+            connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = connection.cursor()
+            for channel in handlers:
+                cursor.execute('LISTEN {}'.format(channel))
+            # anything could have changed while not listening
+            for handler in handlers.values():
+                handler(None)
+            while True:
+                if select_.select([connection], [], [], _LISTEN_POLL_SECONDS) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notification = connection.notifies.pop(0)
+                    handlers[notification.channel](notification.payload)
+        except Exception:
+            logger.warning('Listener failed, reconnecting', exc_info=True)
+            time.sleep(_LISTEN_POLL_SECONDS)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+def _start_listener():
+    handlers = {PROPERTY_CHANNEL: lambda payload: reload_properties(),
+                CATALOG_CHANNEL: lambda payload: reload_catalog(payload or None),
+                SEASON_CHANNEL: _on_season_changed,
+                PLAYER_CHANNEL: lambda payload: _on_players_changed(payload.split(',') if payload else None)}
+    threading.Thread(target=_listen, args=(handlers,), name='db-listener', daemon=True).start()
 
 
 def _build_parameters():
@@ -364,3 +1705,8 @@ def _build_parameters():
             'host': os.environ['DB_HOST'],
             'port': int(os.environ['DB_PORT']),
             'db': os.environ['DB_NAME']}
+
+
+def _build_replica_parameters():
+    parameters = _build_parameters()
+    return dict(parameters, host=DB_REPLICA_HOST, port=int(os.environ.get('DB_REPLICA_PORT') or parameters['port']))
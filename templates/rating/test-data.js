@@ -1,5 +1,6 @@
 window.QUIZ_RESULTS = [
     {
+        'id': '1537176390',
         'place': 1,
         'name': 'Вениамин',
         'points': 134,
@@ -9,6 +10,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176390
     },
     {
+        'id': '1537176389',
         'place': 2,
         'name': 'Hacker',
         'points': 132,
@@ -18,6 +20,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176389
     },
     {
+        'id': '1537176388',
         'place': 3,
         'name': 'Константин Константинович Константинопольский',
         'points': 129,
@@ -27,6 +30,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176388
     },
     {
+        'id': '1537176387',
         'place': 4,
         'name': 'A',
         'points': 127,
@@ -36,6 +40,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176387
     },
     {
+        'id': '1537176386',
         'place': 5,
         'name': 'Владимир Белов',
         'points': 127,
@@ -45,6 +50,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176386
     },
     {
+        'id': '1537176385',
         'place': 6,
         'name': 'AntonValentinov87',
         'points': 122,
@@ -54,6 +60,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176385
     },
     {
+        'id': '1537176384',
         'place': 7,
         'name': 'Nataly',
         'points': 118,
@@ -63,6 +70,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176384
     },
     {
+        'id': '1537176383',
         'place': 8,
         'name': 'Сергей Геннадьевич',
         'points': 117,
@@ -72,6 +80,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176383
     },
     {
+        'id': '1537176382',
         'place': 9,
         'name': 'Даша',
         'points': 116,
@@ -81,6 +90,7 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176382
     },
     {
+        'id': '1537176381',
         'place': 10,
         'name': 'Коля',
         'points': 109,
@@ -90,3 +100,4 @@ window.QUIZ_RESULTS = [
         'chat_id': 1537176381
     },
 ];
+window.QUIZ_RESULTS_VERSION = 1;
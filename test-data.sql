@@ -33,28 +33,28 @@ INSERT INTO player(player_id, player_name, chat_id, registration_time) VALUES
     ('eleven', 'eleven', 11, current_timestamp),
     ('twelve', 'twelve', 12, current_timestamp);
 
-INSERT INTO hint(player_id, question_id, hint_key, tries) VALUES
-    ('two', 1, 'test_hint', 1);
+INSERT INTO hint(season_id, player_id, question_id, hint_key, tries) VALUES
+    (1, 'two', 1, 'test_hint', 1);
 
-INSERT INTO answer(player_id, question_id, variant_id, tries, passed, answer_time) VALUES
+INSERT INTO answer(season_id, player_id, question_id, variant_id, tries, passed, answer_time) VALUES
 -- expected rating: four, five, three, two, one, seven, six
 --   has +1 tries
-    ('one', 1, 'A', 1, true, current_timestamp - interval '1 day'),
-    ('one', 2, 'E', 2, true, current_timestamp - interval '1 day'),
+    (1, 'one', 1, 'A', 1, true, current_timestamp - interval '1 day'),
+    (1, 'one', 2, 'E', 2, true, current_timestamp - interval '1 day'),
 --   used hint
-    ('two', 1, 'A', 1, true, current_timestamp),
-    ('two', 2, 'E', 1, true, current_timestamp),
+    (1, 'two', 1, 'A', 1, true, current_timestamp),
+    (1, 'two', 2, 'E', 1, true, current_timestamp),
 --   answered later
-    ('three', 1, 'A', 1, true, current_timestamp),
-    ('three', 2, 'E', 1, true, current_timestamp),
+    (1, 'three', 1, 'A', 1, true, current_timestamp),
+    (1, 'three', 2, 'E', 1, true, current_timestamp),
 --  leader
-    ('four', 1, 'A', 1, true, current_timestamp - interval '2 days'),
-    ('four', 2, 'E', 1, true, current_timestamp - interval '2 days'),
+    (1, 'four', 1, 'A', 1, true, current_timestamp - interval '2 days'),
+    (1, 'four', 2, 'E', 1, true, current_timestamp - interval '2 days'),
 --  answered earlier
-    ('five', 1, 'A', 1, true, current_timestamp - interval '1 day'),
-    ('five', 2, 'E', 1, true, current_timestamp - interval '1 day'),
+    (1, 'five', 1, 'A', 1, true, current_timestamp - interval '1 day'),
+    (1, 'five', 2, 'E', 1, true, current_timestamp - interval '1 day'),
 --  failed last answer, answered later
-    ('six', 1, 'A', 1, true, current_timestamp),
-    ('six', 2, 'E', 1, true, current_timestamp),
+    (1, 'six', 1, 'A', 1, true, current_timestamp),
+    (1, 'six', 2, 'E', 1, true, current_timestamp),
 --  no last answer
-    ('seven', 1, 'A', 1, true, current_timestamp - interval '1 day');
+    (1, 'seven', 1, 'A', 1, true, current_timestamp - interval '1 day');
@@ -0,0 +1,40 @@
+# coding=utf-8
+# modules of the bot are top level ones, tests import them from the repository root
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+import service
+
+# scratch database next to the configured one, the game database is never touched by tests
+TEST_DB_NAME = os.environ.get('TEST_DB_NAME') or 'khsm_test'
+
+
+@pytest.fixture(scope='session')
+def database():
+    """
+    Migrated TEST_DB_NAME database on the server of the DB_* variables, tests using it are skipped when it can not be reached
+    """
+    try:
+        migrations.ensure_database(TEST_DB_NAME)
+        # instance processes started by tests inherit it
+        os.environ['DB_NAME'] = TEST_DB_NAME
+        service.init(background=False)
+    except Exception as ex:
+        pytest.skip('No database: {}'.format(ex))
+
+
+@pytest.fixture
+def player_ids(database):
+    """
+    Ids of players a test creates, deleted with their scores and leases afterwards
+    """
+    created_ids = []
+    yield created_ids
+    with service.get_engine().begin() as connection:
+        for model in (service.PlayerScore, service.PlayerLease, service.Player):
+            connection.execute(model.__table__.delete().where(model.player_id.in_(created_ids)))
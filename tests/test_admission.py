@@ -0,0 +1,41 @@
+# coding=utf-8
+import admission
+import metrics
+import service
+
+
+def _set_properties(monkeypatch, **properties):
+    monkeypatch.setattr(service, 'get_property', lambda key, default_value=None: properties.get(key, default_value))
+
+
+def test_user_rate(monkeypatch):
+    _set_properties(monkeypatch, bot_user_rate='0.001', bot_user_burst='2')
+    limiter = admission.Admission()
+    shed_before = metrics.SHED_UPDATES.get(reason=admission.SHED_USER_RATE)
+    assert limiter.enter(1) is None
+    assert limiter.enter(1) is None
+    assert limiter.enter(1) == admission.SHED_USER_RATE
+    assert limiter.enter(2) is None
+    assert metrics.SHED_UPDATES.get(reason=admission.SHED_USER_RATE) == shed_before + 1
+
+
+def test_updates_without_user_are_not_rate_limited(monkeypatch):
+    _set_properties(monkeypatch, bot_user_rate='0.001', bot_user_burst='1')
+    limiter = admission.Admission()
+    for _ in range(5):
+        assert limiter.enter(None) is None
+
+
+def test_concurrency(monkeypatch):
+    _set_properties(monkeypatch, bot_user_rate='0', bot_max_concurrent_updates='2')
+    limiter = admission.Admission()
+    assert limiter.enter(1) is None
+    assert limiter.enter(1) is None
+    assert limiter.enter(2) == admission.SHED_CONCURRENCY
+    limiter.leave()
+    assert limiter.enter(2) is None
+
+
+def test_malformed_property_falls_back_to_default(monkeypatch):
+    _set_properties(monkeypatch, bot_user_burst='many')
+    assert admission._get_limit(admission.BOT_USER_BURST, 5) == 5
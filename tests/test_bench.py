@@ -0,0 +1,22 @@
+# coding=utf-8
+import bench
+
+
+def _results(p50_ms, queries):
+    return {'1000': {'get_top': {'p50_ms': p50_ms, 'p99_ms': p50_ms * 2, 'queries': queries}}}
+
+
+def test_compare_within_threshold():
+    assert bench.compare(_results(10, 2), _results(14, 2.4), 1.5) == []
+
+
+def test_compare_finds_slower_functions():
+    assert bench.compare(_results(10, 2), _results(16, 2), 1.5) == ['1000 players get_top: p50 16ms, was 10ms']
+
+
+def test_compare_finds_more_queries():
+    assert bench.compare(_results(10, 2), _results(10, 3), 1.5) == ['1000 players get_top: 3 queries, was 2']
+
+
+def test_compare_skips_functions_missing_from_baseline():
+    assert bench.compare({}, _results(100, 100), 1.5) == []
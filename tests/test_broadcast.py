@@ -0,0 +1,66 @@
+# coding=utf-8
+import time
+
+from telegram.error import NetworkError, TimedOut
+from telegram.utils.request import urllib3
+
+import broadcast
+import service
+
+
+def test_rate_limiter_spaces_calls():
+    limiter = broadcast.RateLimiter(10, 1)
+    first = limiter.reserve(1)
+    second = limiter.reserve(2)
+    third = limiter.reserve(3)
+    assert abs(second - first - 0.1) < 0.01
+    assert abs(third - second - 0.1) < 0.01
+
+
+def test_rate_limiter_spaces_calls_to_a_chat():
+    limiter = broadcast.RateLimiter(100, 1)
+    first = limiter.reserve(1)
+    assert limiter.reserve(1) >= first + 1
+    assert limiter.reserve(2) < first + 1
+
+
+def test_rate_limiter_pause():
+    limiter = broadcast.RateLimiter(100, 0)
+    started = time.time()
+    limiter.pause(5)
+    assert limiter.paused_until() >= started + 5
+    assert limiter.reserve(1) >= limiter.paused_until()
+
+
+class _Bot(object):
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = 0
+
+    def send_message(self, chat_id, text):
+        self.sent += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def _connection_refused():
+    try:
+        raise urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+    except urllib3.exceptions.NewConnectionError:
+        try:
+            raise NetworkError('urllib3 HTTPError')
+        except NetworkError as ex:
+            return ex
+
+
+def test_send_is_not_repeated_after_timeout():
+    bot = _Bot([TimedOut()])
+    result = broadcast.BroadcastEngine(bot, workers=1, rate=1000, chat_interval=0)._send(1, 'message')
+    assert (result['status'], result['attempts'], bot.sent) == (service.BROADCAST_FAILED, 1, 1)
+
+
+def test_send_is_repeated_when_not_connected():
+    bot = _Bot([_connection_refused()])
+    assert broadcast.is_unsent(_connection_refused())
+    result = broadcast.BroadcastEngine(bot, workers=1, rate=1000, chat_interval=0)._send(1, 'message')
+    assert (result['status'], result['attempts'], bot.sent) == (service.BROADCAST_SENT, 2, 2)
@@ -0,0 +1,57 @@
+# coding=utf-8
+from types import SimpleNamespace
+
+import dispatch
+
+
+def _tap(data):
+    return SimpleNamespace(callback_query=SimpleNamespace(data=data))
+
+
+def test_parse_callback_data():
+    assert dispatch.parse_callback_data(dispatch.encode_answer_callback(3, 'b')) == (dispatch.ANSWER_CALLBACK, 3, 'b')
+    assert dispatch.parse_callback_data(dispatch.encode_hint_callback('fifty', 7)) == (dispatch.HINT_CALLBACK, 'fifty', 7)
+
+
+def test_parse_callback_data_of_json_keyboards():
+    assert dispatch.parse_callback_data('["answer", "3", "b"]') == (dispatch.ANSWER_CALLBACK, 3, 'b')
+    assert dispatch.parse_callback_data('["hint", "fifty", 7]') == (dispatch.HINT_CALLBACK, 'fifty', 7)
+
+
+def test_parse_callback_data_of_garbage():
+    for data in (None, '', 'a:1', 'x:1:b', 'a:one:b', 'h:fifty:seven', '["answer", 1]', '[not json'):
+        assert dispatch.parse_callback_data(data) is None
+
+
+def test_callback_key_tells_variants_apart():
+    assert dispatch.callback_key(_tap('a:3:b')) == (dispatch.ANSWER_CALLBACK, 'b', 3)
+    assert dispatch.callback_key(_tap('a:3:b')) != dispatch.callback_key(_tap('a:3:c'))
+    assert dispatch.callback_key(_tap('h:fifty:3')) == (dispatch.HINT_CALLBACK, 'fifty', 3)
+    assert dispatch.callback_key(SimpleNamespace(callback_query=None)) is None
+
+
+def test_is_stale():
+    user_id = 'stale-test'
+    assert not dispatch.is_stale(user_id, dispatch.callback_key(_tap('a:3:b')))
+    dispatch.remember_passed(user_id, 3)
+    assert dispatch.is_stale(user_id, dispatch.callback_key(_tap('a:3:b')))
+    assert dispatch.is_stale(user_id, dispatch.callback_key(_tap('h:fifty:2')))
+    assert not dispatch.is_stale(user_id, dispatch.callback_key(_tap('a:4:b')))
+    assert not dispatch.is_stale(user_id, None)
+
+
+def test_is_stale_expires(monkeypatch):
+    user_id = 'expired-test'
+    dispatch.remember_passed(user_id, 3)
+    monkeypatch.setattr(dispatch, '_PASSED_TTL_SECONDS', 0)
+    assert not dispatch.is_stale(user_id, dispatch.callback_key(_tap('a:3:b')))
+
+
+def test_forget_passed():
+    dispatch.remember_passed(11, 3)
+    dispatch.remember_passed(12, 3)
+    dispatch.forget_passed(['11'])
+    assert not dispatch.is_stale(11, dispatch.callback_key(_tap('a:3:b')))
+    assert dispatch.is_stale(12, dispatch.callback_key(_tap('a:3:b')))
+    dispatch.forget_passed()
+    assert not dispatch.is_stale(12, dispatch.callback_key(_tap('a:3:b')))
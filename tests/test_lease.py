@@ -0,0 +1,51 @@
+# coding=utf-8
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import lease
+import service
+
+
+@pytest.fixture
+def instances(database):
+    instance_ids = ['test-a', 'test-b']
+    for instance_id in instance_ids:
+        service.beat_bot_instance(instance_id, 'http://{}/'.format(instance_id), 3600)
+    yield instance_ids
+    service.set_lease_instance(None)
+    for instance_id in instance_ids:
+        service.drop_bot_instance(instance_id)
+
+
+def test_lease_is_held_by_one_instance(instances, player_ids):
+    player_ids.append('800000001')
+    assert service.acquire_player_lease('800000001', 'test-a', 6) == (True, None)
+    assert service.acquire_player_lease('800000001', 'test-b', 6) == (False, 'http://test-a/')
+    service.drop_bot_instance('test-a')
+    assert service.acquire_player_lease('800000001', 'test-b', 6) == (True, None)
+
+
+def test_writes_are_fenced_by_the_lease(instances, player_ids):
+    user = SimpleNamespace(id=800000002, name='lease test')
+    player_ids.append(str(user.id))
+    service.acquire_player_lease(str(user.id), 'test-b', 6)
+    service.set_lease_instance('test-a')
+    with pytest.raises(service.LeaseLostError):
+        service.add_player(user, user.id, datetime.datetime.now())
+    service.drop_bot_instance('test-b')
+    assert service.acquire_player_lease(str(user.id), 'test-a', 6) == (True, None)
+    service.add_player(user, user.id, datetime.datetime.now())
+
+
+def test_instances_as_processes(player_ids):
+    player_ids.extend(str(900000000 + index) for index in range(20))
+    try:
+        overlaps, orphaned, taken_over, failover_overlaps = lease._selftest(3, 20, 300, 0.5, 1.5)
+    finally:
+        # the killed instance could not drop itself
+        service.drop_bot_instance('selftest-0')
+    assert overlaps == 0
+    assert taken_over == orphaned
+    assert failover_overlaps == 0
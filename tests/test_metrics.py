@@ -0,0 +1,36 @@
+# coding=utf-8
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def histogram():
+    histogram = metrics.Histogram('test_seconds', 'Test "time"', ['method'], buckets=(1, 2))
+    yield histogram
+    metrics._metrics.remove(histogram)
+
+
+def test_histogram_render(histogram):
+    for value in (0.5, 1.5, 3):
+        histogram.observe(value, method='send')
+    assert histogram.render() == [
+        '# HELP test_seconds Test "time"',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{method="send",le="1"} 1',
+        'test_seconds_bucket{method="send",le="2"} 2',
+        'test_seconds_bucket{method="send",le="+Inf"} 3',
+        'test_seconds_sum{method="send"} 5.0',
+        'test_seconds_count{method="send"} 3',
+    ]
+    assert histogram.totals() == {('send',): (3, 5.0)}
+
+
+def test_histogram_bounds_are_inclusive(histogram):
+    histogram.observe(1, method='send')
+    assert 'test_seconds_bucket{method="send",le="1"} 1' in histogram.render()
+
+
+def test_label_values_are_escaped(histogram):
+    histogram.observe(1, method='a"b\\c')
+    assert 'test_seconds_count{method="a\\"b\\\\c"} 1' in histogram.render()
@@ -0,0 +1,117 @@
+# coding=utf-8
+import threading
+
+from telegram.error import RetryAfter, TimedOut, NetworkError
+from telegram.utils.request import urllib3
+
+import metrics
+import outbox
+
+
+class _Bot(object):
+    def __init__(self, errors=None):
+        # method -> errors raised by its first calls
+        self.errors = errors or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __getattr__(self, method):
+        def call(**kwargs):
+            with self.lock:
+                self.calls.append((method, kwargs))
+                errors = self.errors.get(method)
+                if errors:
+                    raise errors.pop(0)
+        return call
+
+
+def _connection_refused():
+    try:
+        raise urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+    except urllib3.exceptions.NewConnectionError:
+        try:
+            raise NetworkError('urllib3 HTTPError')
+        except NetworkError as ex:
+            return ex
+
+
+def _send_all(bot, put, **kwargs):
+    sender = outbox.Outbox(bot, **dict({'workers': 4, 'rate': 1000, 'chat_interval': 0}, **kwargs))
+    put(sender)
+    sender.start()
+    sender.stop(timeout=10)
+    return bot.calls
+
+
+def test_calls_to_a_chat_keep_order():
+    def put(sender):
+        for index in range(20):
+            sender.send_message(1, 'first {}'.format(index))
+            sender.send_message(2, 'second {}'.format(index))
+
+    calls = _send_all(_Bot(), put)
+    for chat_id, prefix in ((1, 'first'), (2, 'second')):
+        texts = [kwargs['text'] for _, kwargs in calls if kwargs['chat_id'] == chat_id]
+        assert texts == ['{} {}'.format(prefix, index) for index in range(20)]
+
+
+def test_queued_markup_edits_are_coalesced():
+    coalesced_before = metrics.OUTBOX_COALESCED.get()
+
+    def put(sender):
+        sender.send_message(1, 'question')
+        sender.edit_message_reply_markup(1, 10, 'first')
+        sender.edit_message_reply_markup(1, 11, 'other')
+        sender.edit_message_reply_markup(1, 10, 'second')
+        sender.send_message(1, 'next')
+
+    calls = _send_all(_Bot(), put)
+    assert [(method, kwargs.get('text') or kwargs.get('reply_markup')) for method, kwargs in calls] == [
+        ('send_message', 'question'), ('edit_message_reply_markup', 'second'), ('edit_message_reply_markup', 'other'),
+        ('send_message', 'next')]
+    assert metrics.OUTBOX_COALESCED.get() == coalesced_before + 1
+
+
+def test_flood_wait_is_retried_in_order():
+    bot = _Bot({'send_message': [RetryAfter(0.2)]})
+
+    def put(sender):
+        sender.send_message(1, 'first')
+        sender.send_message(1, 'second')
+
+    calls = _send_all(bot, put)
+    assert [kwargs['text'] for _, kwargs in calls] == ['first', 'first', 'second']
+
+
+def test_timed_out_message_is_not_sent_again():
+    bot = _Bot({'send_message': [TimedOut()], 'edit_message_reply_markup': [TimedOut()]})
+
+    def put(sender):
+        sender.send_message(1, 'first')
+        sender.edit_message_reply_markup(1, 10, 'markup')
+
+    calls = _send_all(bot, put)
+    assert [method for method, _ in calls] == ['send_message', 'edit_message_reply_markup', 'edit_message_reply_markup']
+
+
+def test_full_outbox_drops_calls():
+    dropped_before = metrics.OUTBOX_DROPPED.get(method='send_message', reason=outbox.DROPPED_FULL)
+
+    def put(sender):
+        for index in range(3):
+            sender.send_message(1, str(index))
+
+    calls = _send_all(_Bot(), put, max_queued=2)
+    assert [kwargs['text'] for _, kwargs in calls] == ['0', '1']
+    assert metrics.OUTBOX_DROPPED.get(method='send_message', reason=outbox.DROPPED_FULL) == dropped_before + 1
+
+
+def test_message_is_sent_again_when_not_connected():
+    bot = _Bot({'send_message': [_connection_refused(), NetworkError('Bad Gateway')]})
+
+    def put(sender):
+        sender.send_message(1, 'first')
+        sender.send_message(1, 'second')
+
+    calls = _send_all(bot, put)
+    assert [kwargs['text'] for _, kwargs in calls] == ['first', 'first', 'second']
@@ -0,0 +1,76 @@
+# coding=utf-8
+import pytest
+
+import question_pack
+
+
+def _question(question_id=None, variants=None):
+    return {'question_id': question_id, 'text_value': 'Question {}'.format(question_id),
+            'variants': variants if variants is not None else [{'variant_id': 'b', 'text_value': 'B', 'correct': 'no'},
+                                                               {'variant_id': 'a', 'text_value': 'A', 'correct': 'yes'}]}
+
+
+def _errors(questions):
+    with pytest.raises(question_pack.QuestionPackError) as error:
+        question_pack.validate(questions)
+    return error.value.errors
+
+
+def test_validate():
+    validated = question_pack.validate([_question('1'), _question()])
+    assert [question['question_id'] for question in validated] == [1, None]
+    assert validated[0]['variants'] == [{'variant_id': 'a', 'text_value': 'A', 'correct': True},
+                                        {'variant_id': 'b', 'text_value': 'B', 'correct': False}]
+
+
+def test_validate_collects_errors_of_all_questions():
+    errors = _errors([_question(1), _question(1), _question(0), 'question', _question(2, variants={'a': 'A'})])
+    assert errors == ['Question #2: question_id 1 is repeated',
+                      'Question #3: question_id should be positive',
+                      'Question #4: expected an object',
+                      'Question #5: variants should be a list',
+                      'Question #5: at least two variants are needed',
+                      'Question #5: no correct variant']
+
+
+def test_validate_variants():
+    errors = _errors([_question(1, [{'variant_id': 'ab', 'text_value': 'A', 'correct': True},
+                                    {'variant_id': 'c', 'text_value': '', 'correct': 'maybe'},
+                                    'variant'])])
+    assert errors == ['Question #1: variant_id "ab" should be a single letter or digit',
+                      'Question #1: correct of variant c should be true or false',
+                      'Question #1: text of variant c is empty',
+                      'Question #1: variant should be an object']
+
+
+def test_validate_empty_pack():
+    assert _errors([]) == ['No questions in the pack']
+
+
+def test_parse_csv():
+    content = ('question_id,question_text,variant_id,variant_text,correct\n'
+               '1,Question 1,a,A,+\n'
+               '1,Question 1,b,B,\n'
+               ',New question,a,A,0\n'
+               ',New question,b,B,1\n')
+    validated = question_pack.parse(content, question_pack.CSV_FORMAT)
+    assert [question['question_id'] for question in validated] == [1, None]
+    assert [variant['correct'] for variant in validated[1]['variants']] == [False, True]
+
+
+def test_parse_csv_with_short_rows_and_unknown_values():
+    content = ('question_id,question_text,variant_id,variant_text,correct\n'
+               '1,Question 1,a,A,maybe\n'
+               '1,Question 1,b\n')
+    with pytest.raises(question_pack.QuestionPackError) as error:
+        question_pack.parse(content, question_pack.CSV_FORMAT)
+    assert error.value.errors == ['Line 2: correct should be true or false']
+
+
+def test_parse_json_and_unknown_format():
+    assert question_pack.parse('{"questions": [{"text_value": "Q", "variants": [{"variant_id": "a", "text_value": "A", '
+                               '"correct": 1}, {"variant_id": "b", "text_value": "B", "correct": 0}]}]}',
+                               question_pack.JSON_FORMAT)[0]['text_value'] == 'Q'
+    for content, pack_format in (('{', question_pack.JSON_FORMAT), ('{"questions": 1}', question_pack.JSON_FORMAT), ('', 'xml')):
+        with pytest.raises(question_pack.QuestionPackError):
+            question_pack.parse(content, pack_format)
@@ -0,0 +1,48 @@
+# coding=utf-8
+import recording
+
+
+def _message(user_id, text):
+    return {'update_id': 10, 'message': {'message_id': 5, 'date': 1600000000, 'text': text,
+                                         'chat': {'id': user_id, 'type': 'private', 'first_name': 'Ivan'},
+                                         'from': {'id': user_id, 'is_bot': False, 'first_name': 'Ivan', 'username': 'ivan'}}}
+
+
+def _record(tmp_path, salt, updates):
+    path = tmp_path / 'updates-{}.jsonl'.format(salt)
+    recorder = recording.Recorder(str(path), salt)
+    for update in updates:
+        recorder.record(update)
+    recorder.close()
+    with open(str(path), encoding='utf-8') as lines:
+        return list(recording.read_updates(lines))
+
+
+def test_messages_are_anonymised(tmp_path):
+    (recorded_time, command), (_, text) = _record(tmp_path, 'salt', [_message(42, '/start ref'), _message(42, 'Ivan here')])
+    assert recorded_time
+    message = command['message']
+    assert message['text'] == '/start'
+    assert message['entities'] == [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+    assert message['from']['id'] != 42 and message['chat']['id'] == message['from']['id']
+    assert 'Ivan' not in str(command) and 'ivan' not in str(command)
+    assert text['message']['text'] == 'text'
+
+
+def test_ids_are_stable_for_a_salt(tmp_path):
+    first = _record(tmp_path, 'first', [_message(42, '/start'), _message(42, '/place'), _message(43, '/start')])
+    second = _record(tmp_path, 'second', [_message(42, '/start')])
+    ids = [data['message']['from']['id'] for _, data in first]
+    assert ids[0] == ids[1] != ids[2]
+    assert second[0][1]['message']['from']['id'] != ids[0]
+    assert all(recording._ANONYMOUS_ID_BASE <= user_id < recording._ANONYMOUS_ID_BASE + recording._ANONYMOUS_ID_RANGE
+               for user_id in ids)
+
+
+def test_callback_queries_keep_data(tmp_path):
+    query = {'update_id': 11, 'callback_query': {'id': '7', 'data': 'a:1:b', 'chat_instance': '1', 'message': _message(42, 'Question')['message'],
+                                                 'from': {'id': 42, 'is_bot': False, 'first_name': 'Ivan'}}}
+    (_, recorded), = _record(tmp_path, 'salt', [query, {'update_id': 12, 'poll': {}}])
+    assert recorded['callback_query']['data'] == 'a:1:b'
+    assert recorded['callback_query']['from']['first_name'] != 'Ivan'
+    assert recorded['callback_query']['message']['text'] == 'text'
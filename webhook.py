@@ -0,0 +1,111 @@
+# coding=utf-8
+import hmac
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+import loggers
+
+logger = loggers.logging.getLogger(__name__)
+
+BOT_UPDATE_MODE_WEBHOOK = 'webhook'
+BOT_UPDATE_MODE = os.environ.get('BOT_UPDATE_MODE') or 'polling'
+# public https address Telegram posts updates to, its path is served locally
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or ''
+WEBHOOK_PATH = urlparse(WEBHOOK_URL).path or '/'
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN') or '0.0.0.0'
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT') or 8443)
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN') or ''
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS') or 40)
+# answer Telegram before the update is handled, otherwise after the handler finished
+WEBHOOK_ACK_FIRST = (os.environ.get('WEBHOOK_ACK_FIRST') or 'true').lower() == 'true'
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# set by a bot instance passing an update to the instance holding the player lease
+FORWARDED_HEADER = 'X-Khsm-Forwarded-By'
+
+
+def is_webhook_mode():
+    return BOT_UPDATE_MODE == BOT_UPDATE_MODE_WEBHOOK
+
+
+def is_authorized(secret_token_header):
+    return not WEBHOOK_SECRET_TOKEN or hmac.compare_digest(secret_token_header or '', WEBHOOK_SECRET_TOKEN)
+
+
+def set_webhook(bot):
+    bot.set_webhook(url=WEBHOOK_URL, max_connections=WEBHOOK_MAX_CONNECTIONS, secret_token=WEBHOOK_SECRET_TOKEN or None)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    on_update = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != WEBHOOK_PATH:
+            self._respond(404)
+            return
+        if not is_authorized(self.headers.get(SECRET_TOKEN_HEADER)):
+            self._respond(403)
+            return
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self._respond(400)
+            return
+
+        forwarded = bool(self.headers.get(FORWARDED_HEADER))
+        if WEBHOOK_ACK_FIRST:
+            self._respond(200)
+            self.on_update(data, forwarded)
+        else:
+            self.on_update(data, forwarded)
+            self._respond(200)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def create_server(on_update, port=WEBHOOK_PORT):
+    """
+    HTTP server passing every accepted update JSON and whether it was forwarded by another instance to on_update,
+    each connection is served in its own thread
+    """
+    handler = type('WebhookRequestHandler', (_WebhookRequestHandler,), {'on_update': staticmethod(on_update)})
+    return _ThreadingHTTPServer((WEBHOOK_LISTEN, port), handler)
+
+
+def post_update(url, body, secret_token=WEBHOOK_SECRET_TOKEN, forwarded_by=None, timeout=10):
+    headers = {'Content-Type': 'application/json', SECRET_TOKEN_HEADER: secret_token}
+    if forwarded_by:
+        headers[FORWARDED_HEADER] = forwarded_by
+    with urlopen(Request(url, data=body, method='POST', headers=headers), timeout=timeout) as response:
+        return response.status
+
+
+def post_updates(url, lines, secret_token=WEBHOOK_SECRET_TOKEN):
+    for line in lines:
+        if not line.strip():
+            continue
+        print(post_update(url, line.strip().encode('utf-8'), secret_token))
+
+
+if __name__ == '__main__':
+    # python webhook.py http://localhost:8443/telegram updates.jsonl - posts recorded updates to a running bot
+    with open(sys.argv[2], encoding='utf-8') as updates_file:
+        post_updates(sys.argv[1], updates_file)